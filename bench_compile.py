@@ -0,0 +1,103 @@
+"""
+Steady-state training throughput of PELICANClassifier in eager mode and under torch.compile (--compile).
+
+Batches are synthetic jets with a random number of constituents, collated with collate_fn(..., trim=True, buckets=...)
+as in the training scripts with --nobj-buckets, so the compiled model only sees one shape per bucket.
+The first pass over the batches (which compiles the model for every shape) is not timed.
+
+Example:
+    python bench_compile.py --batch-size 64 --nobj 80 --buckets 40 60 80
+"""
+import argparse
+import logging
+import time
+
+import torch
+
+from src.models import PELICANClassifier
+from src.dataloaders import collate_fn
+
+logger = logging.getLogger(__name__)
+
+
+def make_batches(num_batches, batch_size, nobj, buckets, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    batches = []
+    for _ in range(num_batches):
+        # The multiplicity range changes from batch to batch, so that all the buckets are used
+        top = int(torch.randint(nobj // 4, nobj + 1, (1,), generator=generator))
+        events = []
+        for b in range(batch_size):
+            n = int(torch.randint(top // 2, top + 1, (1,), generator=generator))
+            p3 = torch.randn(n, 3, generator=generator)
+            E = p3.norm(dim=-1, keepdim=True) + 0.1 * torch.rand(n, 1, generator=generator)
+            Pmu = torch.zeros(nobj, 4)
+            Pmu[:n] = torch.cat([E, p3], dim=-1)
+            events.append({'Pmu': Pmu, 'Nobj': torch.tensor(n), 'is_signal': torch.tensor(b % 2)})
+        batches.append(collate_fn(events, nobj=nobj, trim=True, buckets=buckets))
+    return batches
+
+
+def build_model(args, seed=0):
+    torch.manual_seed(seed)
+    return PELICANClassifier(1, args.num_channels_scalar, [[args.num_channels_m]] * args.num_layers, [args.num_channels_2to2] * args.num_layers,
+                             [args.num_channels_m], [args.num_channels_m, args.num_channels_2to2], config=args.config, config_out=args.config,
+                             batchnorm='b', check_nan=False, dtype=torch.float)
+
+
+def train_steps(model, optimizer, batches):
+    for batch in batches:
+        optimizer.zero_grad(set_to_none=True)
+        predict = model(batch)['predict']
+        loss = torch.nn.functional.cross_entropy(predict, batch['is_signal'].long())
+        loss.backward()
+        optimizer.step()
+
+
+def throughput(model, batches, repeats):
+    model.train()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+    start = time.perf_counter()
+    train_steps(model, optimizer, batches)
+    warmup_time = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(repeats):
+        train_steps(model, optimizer, batches)
+    elapsed = time.perf_counter() - start
+    num_events = repeats * sum(len(batch['Nobj']) for batch in batches)
+    return num_events / elapsed, warmup_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the training throughput of PELICANClassifier with and without torch.compile.')
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--nobj', type=int, default=32, help='Padded number of particles per event (default: 32)')
+    parser.add_argument('--buckets', nargs='*', type=int, default=[16, 24, 32], help='--nobj-buckets of the training scripts (default: 16 24 32)')
+    parser.add_argument('--num-batches', type=int, default=8, help='Number of distinct batches (default: 8)')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed passes over the batches, after an untimed warmup pass (default: 3)')
+    parser.add_argument('--num-layers', type=int, default=3)
+    parser.add_argument('--num-channels-m', type=int, default=30)
+    parser.add_argument('--num-channels-2to2', type=int, default=20)
+    parser.add_argument('--num-channels-scalar', type=int, default=10)
+    parser.add_argument('--config', type=str, default='M')
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads (default: torch default)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    batches = make_batches(args.num_batches, args.batch_size, args.nobj, args.buckets)
+    shapes = sorted({tuple(batch['Pmu'].shape[:2]) for batch in batches})
+    print(f'{len(shapes)} distinct batch shapes: {shapes}')
+
+    eager, _ = throughput(build_model(args), batches, args.repeats)
+    print(f'eager:    {eager:10.1f} events/s')
+
+    model = build_model(args)
+    model.compile(dynamic=False)
+    compiled, warmup_time = throughput(model, batches, args.repeats)
+    print(f'compiled: {compiled:10.1f} events/s  (x{compiled / eager:.2f}, warmup incl. compilation {warmup_time:.1f} s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""
+Training throughput of PELICANClassifier on CPU with 1 to N data-parallel processes on one node (gloo backend),
+as with `torchrun --nproc-per-node N train_pelican_classifier.py --cpu`.
+
+Every rank trains on its own synthetic batches of --batch-size jets (so the global batch grows with the number of ranks)
+and gets its block of the cores from partition_cpus, as init_cuda does under torchrun. The first pass over the batches
+is not timed.
+
+Example:
+    python bench_ddp.py --ranks 1 2 4 8 --batch-size 32 --nobj 40
+"""
+import argparse
+import os
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+
+from bench_compile import make_batches, build_model, train_steps
+from src.trainer import partition_cpus
+
+
+def worker(rank, world_size, args, results):
+    os.environ['MASTER_ADDR'] = 'localhost'
+    os.environ['MASTER_PORT'] = str(args.port)
+    partition_cpus(rank, world_size, num_threads=args.threads, pin=args.pin_cpus)
+    dist.init_process_group(backend='gloo', rank=rank, world_size=world_size)
+    batches = make_batches(args.num_batches, args.batch_size, args.nobj, args.buckets, seed=rank)
+    # Some parameters of the small benchmark model get no gradient
+    model = DistributedDataParallel(build_model(args), find_unused_parameters=True)
+    model.train()
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+    train_steps(model, optimizer, batches)
+    dist.barrier()
+    start = time.perf_counter()
+    for _ in range(args.repeats):
+        train_steps(model, optimizer, batches)
+    dist.barrier()
+    elapsed = time.perf_counter() - start
+    num_events = torch.tensor([args.repeats * sum(len(batch['Nobj']) for batch in batches)])
+    dist.all_reduce(num_events)
+    if rank == 0:
+        results.put((num_events.item() / elapsed, torch.get_num_threads()))
+    dist.destroy_process_group()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the scaling of CPU data-parallel training (gloo) on one node.')
+    parser.add_argument('--ranks', nargs='+', type=int, default=[1, 2, 4], help='Numbers of processes (default: 1 2 4)')
+    parser.add_argument('--batch-size', type=int, default=16, help='Jets per batch and rank (default: 16)')
+    parser.add_argument('--nobj', type=int, default=32, help='Padded number of particles per event (default: 32)')
+    parser.add_argument('--buckets', nargs='*', type=int, default=[16, 24, 32], help='--nobj-buckets of the training scripts (default: 16 24 32)')
+    parser.add_argument('--num-batches', type=int, default=4, help='Number of distinct batches per rank (default: 4)')
+    parser.add_argument('--repeats', type=int, default=3, help='Timed passes over the batches, after an untimed warmup pass (default: 3)')
+    parser.add_argument('--num-layers', type=int, default=3)
+    parser.add_argument('--num-channels-m', type=int, default=30)
+    parser.add_argument('--num-channels-2to2', type=int, default=20)
+    parser.add_argument('--num-channels-scalar', type=int, default=10)
+    parser.add_argument('--config', type=str, default='M')
+    parser.add_argument('--threads', type=int, default=0, help='Intra-op threads per rank (0 to split the cores evenly) (default: 0)')
+    parser.add_argument('--pin-cpus', action=argparse.BooleanOptionalAction, default=True, help='Pin each rank to its cores (default: True)')
+    parser.add_argument('--port', type=int, default=29512)
+    args = parser.parse_args()
+
+    print(f'{"ranks":>6} {"threads":>8} {"events/s":>10} {"speedup":>8} {"efficiency":>10}')
+    base = None
+    for world_size in args.ranks:
+        results = mp.get_context('spawn').SimpleQueue()
+        mp.spawn(worker, args=(world_size, args, results), nprocs=world_size)
+        throughput, threads = results.get()
+        base = base or throughput
+        print(f'{world_size:>6} {threads:>8} {throughput:10.1f} {throughput / base:8.2f} {throughput / base / world_size:10.2f}')
+
+
+if __name__ == '__main__':
+    main()
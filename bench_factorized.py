@@ -0,0 +1,69 @@
+"""
+Forward + backward time of a factorized Eq2to2 layer (factorize=True) with the three ways of contracting its coefficients:
+
+    stacked:   the dense C_in x C_out x basis coefficients contracted with the B x C_in x basis x N x N stack,
+               as done for fused=False before the two-stage contraction
+    fused:     the dense coefficients contracted with the sources of the basis operators (fused=True)
+    two-stage: the factors contracted one at a time (fused=False, Eq2to2._two_stage)
+
+Example:
+    python bench_factorized.py --widths 8 16 32 64 --config sM
+"""
+import argparse
+import time
+
+import torch
+
+from src.layers import Eq2to2
+from src.layers.perm_equiv_layers import eops_2_to_2, multi_aggregate_2, _as_pairs
+
+
+def stacked(layer, inputs, nobj):
+    # The stacked path of Eq2to2.forward, which fused=False now only takes for unfactorized or ineligible layers
+    d = {'s': 'sum', 'm': 'mean', 'x': 'max', 'n': 'min'}
+    coefs = layer.coefs00.unsqueeze(1) * layer.coefs10.unsqueeze(-1) + layer.coefs01.unsqueeze(0) * layer.coefs11.unsqueeze(-1)
+    aggregates = multi_aggregate_2(_as_pairs(inputs), nobj, layer.average_nobj, [d[char.lower()] for char in layer.config])
+    ops = []
+    for i, char in enumerate(layer.config):
+        mult = layer._nobj_mult(i, nobj) if char.isupper() else None
+        ops.append(eops_2_to_2(inputs, nobj, layer.average_nobj, aggregation=d[char.lower()], skip_order_zero=i>0, aggregates=aggregates[d[char.lower()]], mult=mult))
+    return torch.einsum('dsb,ndbij->nijs', coefs, torch.cat(ops, dim=2))
+
+
+def timeit(function, layer, repeats):
+    for step in range(repeats + 1):
+        if step == 1:
+            start = time.perf_counter()
+        layer.zero_grad(set_to_none=True)
+        function().square().mean().backward()
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the contraction of the factorized Eq2to2 coefficients.')
+    parser.add_argument('--widths', nargs='+', type=int, default=[8, 16, 32, 64], help='C_in = C_out (default: 8 16 32 64)')
+    parser.add_argument('--batch-size', type=int, default=32)
+    parser.add_argument('--nobj', type=int, default=40)
+    parser.add_argument('--config', type=str, default='M')
+    parser.add_argument('--repeats', type=int, default=5, help='Timed iterations, after an untimed one (default: 5)')
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads (default: torch default)')
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    nobj = torch.randint(args.nobj // 2, args.nobj + 1, (args.batch_size,))
+    print(f'{"width":>6} {"stacked":>10} {"fused":>10} {"two-stage":>10}   (ms per forward + backward)')
+    for width in args.widths:
+        torch.manual_seed(0)
+        inputs = torch.randn(args.batch_size, args.nobj, args.nobj, width)
+        layer = Eq2to2(width, width, config=args.config, factorize=True, fused=False)
+        fused = Eq2to2(width, width, config=args.config, factorize=True, fused=True)
+        fused.load_state_dict(layer.state_dict())
+        times = [timeit(lambda: stacked(layer, inputs, nobj), layer, args.repeats),
+                 timeit(lambda: fused(inputs, nobj=nobj), fused, args.repeats),
+                 timeit(lambda: layer(inputs, nobj=nobj), layer, args.repeats)]
+        print(f'{width:>6} ' + ' '.join(f'{1000 * t:10.1f}' for t in times))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+"""
+Step time of the custom optimizers of src/trainer/optimizers.py with the per-parameter loop (foreach=False) and with
+torch._foreach_* ops (foreach=True), on the parameters of a PELICANClassifier with random gradients.
+
+Both copies of each optimizer see the same gradients, so the last column (the largest difference between the parameters
+after all the steps) checks that the two paths apply the same update. Gradient noise and dropout of DemonRanger are
+disabled for that comparison, since the foreach path draws them in one go.
+
+With --check, nothing is timed: the two paths are compared with torch.testing.assert_close (parameters and states after
+all the steps) for every combination of CHECK_FLAGS and AVERAGING that an optimizer takes, and the runs with the noise of
+NOISE are compared in distribution (statistics of their deviations from the noiseless runs).
+
+Example:
+    python bench_optim.py --num-layers 5 --steps 50 --optimizers DemonRanger HyperProp
+    python bench_optim.py --check --num-layers 2 --steps 12
+"""
+import argparse
+import inspect
+import itertools
+import math
+import time
+import warnings
+
+import torch
+
+from src.models import PELICANClassifier
+from src.trainer import optimizers
+
+OPTIMIZERS = {'LRangerMod': {},
+              'DemonRanger': {'use_grad_noise': False, 'dropout': 0.},
+              'HyperRanger': {},
+              'HyperRangerMod': {},
+              'HDQHSGDW': {},
+              'HyperProp': {}}
+
+# Flags whose combinations --check runs (with the optimizers that take them)
+CHECK_FLAGS = ('amsgrad', 'AdaMod', 'use_gc', 'HDM', 'flat_state')
+# Iterate averaging and lookahead modes of --check (IA steps with activate_IA=True)
+AVERAGING = {'none': {'IA': False, 'k': 0},
+             'lookahead': {'IA': False, 'k': 3},
+             'IA': {'IA': True, 'k': 0, 'IA_cycle': 3}}
+# hypergrad_lr of the additive hypergradient rule (HDM=False) in --check: with the default of HyperProp (made for HDM=True),
+# the learning rates blow up on random gradients, which amplifies the rounding differences of the two paths
+ADDITIVE_HYPERGRAD_LR = {'HyperProp': 1e-4}
+# Tolerances of --check for the states (the parameters use the defaults of assert_close): the hypergradients of the
+# momentum are divided by (1 - beta ** step) ** 2, which the loops compute from float32 scalars and the foreach paths from
+# Python floats
+STATE_TOLERANCES = {'rtol': 1e-3, 'atol': 1e-5}
+# Noise that --check compares in distribution, since the two paths draw different samples
+# (rectify=False so that dropout applies from the first step)
+NOISE = {'DemonRanger': [{'use_grad_noise': True}, {'dropout': 0.5, 'rectify': False}, {'use_grad_noise': True, 'dropout': 0.5, 'rectify': False}]}
+
+
+def build_params(args, seed=0):
+    torch.manual_seed(seed)
+    model = PELICANClassifier(1, args.num_channels_scalar, [[args.num_channels_m]] * args.num_layers, [args.num_channels_2to2] * args.num_layers,
+                              [args.num_channels_m], [args.num_channels_m, args.num_channels_2to2], config=args.config, config_out=args.config,
+                              batchnorm='b', check_nan=False, dtype=torch.float)
+    return [p for p in model.parameters() if p.requires_grad]
+
+
+def timeit(optimizer, params, grads):
+    for step, step_grads in enumerate(grads):
+        if step == 1:
+            start = time.perf_counter()
+        for p, grad in zip(params, step_grads):
+            p.grad = grad.clone()
+        optimizer.step()
+    return (time.perf_counter() - start) / (len(grads) - 1)
+
+
+def run_steps(name, params, grads, seed=2, **kwargs):
+    # Copies of params and their states after one step per gradient, with the global RNG seeded for the noise (with a seed
+    # other than those of the parameters and gradients, which the noise would otherwise repeat)
+    copies = [torch.nn.Parameter(p.detach().clone()) for p in params]
+    optimizer = getattr(optimizers, name)(copies, **kwargs)
+    step_kwargs = {'activate_IA': True} if kwargs.get('IA') else {}
+    torch.manual_seed(seed)
+    for step_grads in grads:
+        for p, grad in zip(copies, step_grads):
+            p.grad = grad.clone()
+        optimizer.step(**step_kwargs)
+    return copies, [optimizer.state[p] for p in copies]
+
+
+def assert_same(loop, foreach, msg):
+    # Parameters (or states) of the two paths; the states also hold per-parameter scalars, and NaNs of both paths count as equal
+    for idx, (a, b) in enumerate(zip(loop, foreach)):
+        if isinstance(a, dict):
+            assert a.keys() == b.keys(), f'{msg}: states {sorted(a)} and {sorted(b)}'
+            for key in a:
+                torch.testing.assert_close(torch.as_tensor(b[key]), torch.as_tensor(a[key]), check_dtype=False, equal_nan=True,
+                                           **STATE_TOLERANCES, msg=lambda m: f'{msg}, state {key} of parameter {idx}: {m}')
+        else:
+            torch.testing.assert_close(b, a, equal_nan=True, msg=lambda m: f'{msg}, parameter {idx}: {m}')
+
+
+def deviation_statistics(initial, reference, noisy):
+    """
+    Statistics of the deviations of the noisy tensors from the noiseless ones: their mean in units of their standard
+    deviation, their standard deviation in units of that of the noiseless changes from the initial tensors, and their
+    projection on those changes (e.g. minus the fraction of the updates that dropout drops).
+    """
+    change = torch.cat([(b - a).detach().reshape(-1) for a, b in zip(initial, reference)])
+    deviation = torch.cat([(b - a).detach().reshape(-1) for a, b in zip(reference, noisy)])
+    return torch.stack([deviation.mean() / deviation.std(), deviation.std() / change.std(), deviation.dot(change) / change.dot(change)])
+
+
+def check(name, params, grads):
+    # Number of configurations in which the loop and foreach paths of an optimizer agree (raises at the first that does not)
+    accepted = inspect.signature(getattr(optimizers, name)).parameters
+    flags = [flag for flag in CHECK_FLAGS if flag in accepted]
+    # Without iterate averaging (HDQHSGDW), only the lookahead modes
+    modes = [mode for mode, averaging in AVERAGING.items() if 'IA' in accepted or not averaging['IA']]
+    count = 0
+    for values, mode in itertools.product(itertools.product((False, True), repeat=len(flags)), modes):
+        kwargs = {**OPTIMIZERS[name], **dict(zip(flags, values)), **{key: value for key, value in AVERAGING[mode].items() if key in accepted}}
+        if not kwargs.get('HDM', True) and name in ADDITIVE_HYPERGRAD_LR:
+            kwargs['hypergrad_lr'] = ADDITIVE_HYPERGRAD_LR[name]
+        msg = f'{name}({", ".join(f"{key}={value}" for key, value in kwargs.items())})'
+        (loop, loop_states), (foreach, foreach_states) = (run_steps(name, params, grads, foreach=foreach, **kwargs) for foreach in (False, True))
+        assert_same(loop, foreach, msg)
+        assert_same(loop_states, foreach_states, msg)
+        count += 1
+
+    for noise in NOISE.get(name, []):
+        msg = f'{name}({", ".join(f"{key}={value}" for key, value in noise.items())})'
+        statistics = []
+        for foreach in (False, True):
+            reference, reference_states = run_steps(name, params, grads, foreach=foreach, **{**noise, **OPTIMIZERS[name]})
+            noisy, noisy_states = run_steps(name, params, grads, foreach=foreach, **{**OPTIMIZERS[name], **noise})
+            # The moments start from zero
+            statistics.append([deviation_statistics(params, reference, noisy)] +
+                              [deviation_statistics([torch.zeros_like(state[key]) for state in reference_states],
+                                                    [state[key] for state in reference_states], [state[key] for state in noisy_states])
+                               for key in ('exp_avg', 'exp_avg_sq')])
+        for key, loop_stats, foreach_stats in zip(('parameters', 'exp_avg', 'exp_avg_sq'), *statistics):
+            # The spread within 5%, the mean and the projection within five of their standard errors (NaN without noise)
+            torch.testing.assert_close(foreach_stats[1], loop_stats[1], rtol=0.05, atol=0,
+                                       msg=lambda m: f'{msg}, spread of the deviations of {key}: {m}')
+            atol = 5 * max(1., loop_stats[1].item()) / math.sqrt(sum(p.numel() for p in params))
+            torch.testing.assert_close(foreach_stats[::2], loop_stats[::2], rtol=0, atol=atol, equal_nan=True,
+                                       msg=lambda m: f'{msg}, (mean, projection) of the deviations of {key}: {m}')
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the per-parameter and foreach steps of the custom optimizers.')
+    parser.add_argument('--optimizers', nargs='+', type=str, default=list(OPTIMIZERS), choices=list(OPTIMIZERS))
+    parser.add_argument('--steps', type=int, default=20, help='Timed steps, after an untimed one (default: 20)')
+    parser.add_argument('--num-layers', type=int, default=3)
+    parser.add_argument('--num-channels-m', type=int, default=30)
+    parser.add_argument('--num-channels-2to2', type=int, default=20)
+    parser.add_argument('--num-channels-scalar', type=int, default=10)
+    parser.add_argument('--config', type=str, default='M')
+    parser.add_argument('--threads', type=int, default=None, help='torch.set_num_threads (default: torch default)')
+    parser.add_argument('--check', action='store_true', help='Check that the two paths agree instead of timing them')
+    args = parser.parse_args()
+    # The per-parameter loops use deprecated signatures of add_/addcmul_
+    warnings.filterwarnings('ignore', category=UserWarning)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    params = build_params(args)
+    generator = torch.Generator().manual_seed(1)
+    grads = [[torch.randn(p.shape, generator=generator) for p in params] for _ in range(args.steps + 1)]
+    print(f'{len(params)} parameters, {sum(p.numel() for p in params)} weights')
+    if args.check:
+        for name in args.optimizers:
+            print(f'{name:>15} loop and foreach agree in {check(name, params, grads)} configurations')
+        return
+    print(f'{"optimizer":>15} {"loop":>10} {"foreach":>10} {"speedup":>8} {"max diff":>10}   (ms per step)')
+    for name in args.optimizers:
+        times, results = [], []
+        for foreach in (False, True):
+            copies = [torch.nn.Parameter(p.detach().clone()) for p in params]
+            optimizer = getattr(optimizers, name)(copies, foreach=foreach, **OPTIMIZERS[name])
+            times.append(timeit(optimizer, copies, grads))
+            results.append(copies)
+        # NaNs that both paths produce count as equal
+        diff = max(torch.where(a.isnan() & b.isnan(), 0., a - b).abs().max().item() for a, b in zip(*results))
+        print(f'{name:>15} {1000 * times[0]:10.2f} {1000 * times[1]:10.2f} {times[0] / times[1]:8.2f} {diff:10.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+"""
+Precomputes the SoftDrop multiplicity nSD of every event and stores it as an 'nSD' dataset in the same HDF5 file.
+
+With --irc-safe and a mean aggregation ('m' or 'M' in --config/--config-out), the models use nSD instead of the
+particle count, and computing it on the fly (CATree + SDMultiplicity) dominates the cost of every batch.
+JetDataset and collate_fn pass the stored 'nSD' through, and the models use it whenever it is present.
+
+The value is computed exactly as in the models' forward pass, from the jet constituents with nonzero energy
+(spurions are not included), so --nobj must match the value used for training.
+
+Example:
+    python precompute_nsd.py data/sample_data/run12/*.h5 --num-workers 8
+"""
+import argparse
+import logging
+from multiprocessing import Pool
+
+import h5py
+import numpy as np
+import torch
+
+from src.models import dot4, CATree, SDMultiplicity
+
+logger = logging.getLogger(__name__)
+
+
+def compute_nsd(event_momenta, nobj=None):
+    """
+    nSD of a batch of padded events, as computed by PELICANClassifier/PELICANRegression with irc_safe=True.
+
+    event_momenta: B x N x 4
+    Returns: B (long)
+    """
+    if nobj is not None and nobj > 0:
+        event_momenta = event_momenta[:, :nobj]
+    particle_mask = event_momenta[..., 0] != 0.
+    dot_products = dot4(event_momenta.unsqueeze(1), event_momenta.unsqueeze(2))
+    return SDMultiplicity(CATree(dot_products, particle_mask.sum(-1, keepdim=True), ycut=1000, eps=10e-8))
+
+
+def _worker_init():
+    # Parallelism comes from the pool, one thread per worker avoids oversubscription
+    torch.set_num_threads(1)
+
+
+def _compute_chunk(job):
+    filename, start, stop, nobj = job
+    with h5py.File(filename, mode='r') as f:
+        event_momenta = torch.from_numpy(f['Pmu'][start:stop]).to(torch.float64)
+    return start, compute_nsd(event_momenta, nobj).numpy()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute the SoftDrop multiplicity nSD of every event of PELICAN HDF5 files.')
+    parser.add_argument('files', nargs='+', help='HDF5 files to process (modified in place)')
+    parser.add_argument('--num-workers', type=int, default=1, metavar='N',
+                        help='Number of worker processes (default: 1)')
+    parser.add_argument('--chunk-size', type=int, default=1000, metavar='N',
+                        help='Number of events per task (default: 1000)')
+    parser.add_argument('--nobj', type=int, default=None, metavar='N',
+                        help='Same as the --nobj option of the training scripts (default: None)')
+    parser.add_argument('--overwrite', action=argparse.BooleanOptionalAction, default=False,
+                        help='Recompute nSD in files that already have it (default: False)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+
+    with Pool(args.num_workers, initializer=_worker_init) as pool:
+        for filename in args.files:
+            with h5py.File(filename, mode='r') as f:
+                if 'nSD' in f and not args.overwrite:
+                    logger.info(f'{filename} already contains nSD, skipping (use --overwrite to recompute)')
+                    continue
+                num_events = len(f['Pmu'])
+
+            nSD = np.empty(num_events, dtype=np.int64)
+            jobs = [(filename, start, min(start + args.chunk_size, num_events), args.nobj) for start in range(0, num_events, args.chunk_size)]
+            for done, (start, values) in enumerate(pool.imap_unordered(_compute_chunk, jobs)):
+                nSD[start:start + len(values)] = values
+                logger.info(f'{filename}: {done + 1}/{len(jobs)} chunks')
+
+            with h5py.File(filename, mode='r+') as f:
+                if 'nSD' in f:
+                    del f['nSD']
+                f.create_dataset('nSD', data=nSD)
+                f['nSD'].attrs['nobj'] = -1 if args.nobj is None else args.nobj
+            logger.info(f'Wrote nSD for {num_events} events to {filename}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
 from .jetdatasets import JetDataset
 from .utils import initialize_datasets
 from .collate import collate_fn
+from .samplers import PairBudgetBatchSampler
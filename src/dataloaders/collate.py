@@ -1,4 +1,5 @@
 import torch
+import torch.nn.functional as F
 import numpy as np
 from math import sqrt
 
@@ -135,7 +136,16 @@ def drop_zeros(props, to_keep):
         return props[:, to_keep, ...]
 
 
-def collate_fn(data, scale=1., nobj=None, edge_features=[], beam_mass=1):
+def particle_keys(data):
+    """
+    Keys of the per-particle properties of a list of datapoints, i.e. the tensors whose first axis runs over the particles of 'Pmu'.
+    """
+    num_particles = [len(event['Pmu']) for event in data]
+    return [key for key, val in data[0].items() if torch.is_tensor(val) and val.dim() > 0
+            and all(len(event[key]) == n for event, n in zip(data, num_particles))]
+
+
+def collate_fn(data, scale=1., nobj=None, edge_features=[], beam_mass=1, packed=False, trim=False, buckets=None):
     """
     Collation function that collates datapoints into the batch format
 
@@ -147,6 +157,14 @@ def collate_fn(data, scale=1., nobj=None, edge_features=[], beam_mass=1):
         Keys of properties that correspond to edge features, and therefore are
         matrices of shapes (num_particles, num_particles), which when forming a batch
         need to be padded along the first two axes instead of just the first one.
+    packed : bool
+        Concatenate the particles of all events instead of padding them (see :collate_packed:).
+    trim : bool
+        Cut the padding of the per-particle properties down to the largest number of particles in this batch
+        (the datafiles store every event padded to the same length).
+    buckets : list of ints or None
+        With trim, round the number of particles kept up to the smallest of these sizes that fits the batch,
+        so that only a few distinct shapes reach the model (e.g. to bound the recompilations of torch.compile).
 
     Returns
     -------
@@ -155,8 +173,11 @@ def collate_fn(data, scale=1., nobj=None, edge_features=[], beam_mass=1):
     """
     if data[0] is None:
         return None
+    if packed:
+        return collate_packed(data, scale=scale, nobj=nobj)
     
     common_keys = data[0].keys()
+    per_particle = particle_keys(data) if trim else []
     # common_keys = set.intersection(*[set(d.keys()) for d in data]) # Uncomment if different data files have different sets of keys
     data = {key: batch_stack([event[key] for event in data], nobj=nobj) for key in common_keys}
     device = data['Pmu'].device
@@ -172,10 +193,62 @@ def collate_fn(data, scale=1., nobj=None, edge_features=[], beam_mass=1):
     data['Pmu'] = data['Pmu'] * scale
 
     particle_mask = data['Pmu'][...,0] != 0.
+    if trim:
+        num_kept = particle_mask.any(0).nonzero().max().item() + 1 if particle_mask.any() else 0
+        if buckets:
+            num_kept = min([b for b in buckets if b >= num_kept] + [particle_mask.shape[1]])
+        for key in per_particle:
+            data[key] = data[key][:, :num_kept]
+        particle_mask = particle_mask[:, :num_kept]
     edge_mask = particle_mask.unsqueeze(1) * particle_mask.unsqueeze(2)
 
     data['particle_mask'] = particle_mask.bool()
     data['edge_mask'] = edge_mask.bool()
 
     return data
-    
+
+
+def collate_packed(data, scale=1., nobj=None):
+    """
+    Collation function for packed batches: instead of padding every event to the
+    largest one, the particles of all events are concatenated along the first axis,
+    and the model works on the N x N pair blocks of each event only.
+
+    Parameters
+    ----------
+    data : list of datapoints
+        The data to be collated.
+    nobj : int or None
+        Maximum number of particles kept per event.
+
+    Returns
+    -------
+    batch : dict of Pytorch tensors
+        Per-particle properties of shape (sum(Nobj), ...) and per-event properties of shape (B, ...),
+        along with 'Nobj' (the number of particles kept in each event) and the offsets
+        'particle_offsets' and 'pair_offsets' (B+1 each) of every event among the concatenated
+        particles and among the concatenated, row-major N x N pair blocks.
+    """
+    if nobj is not None and nobj < 0:
+        nobj = None
+
+    # Keep the particles with nonzero energy, i.e. the ones that are unmasked in the padded format
+    keep = [event['Pmu'][:nobj, 0] != 0. for event in data]
+    per_particle = particle_keys(data)
+
+    batch = {}
+    for key in data[0].keys():
+        props = [event[key] for event in data]
+        if not torch.is_tensor(props[0]):
+            batch[key] = torch.tensor(props)
+        elif key in per_particle:
+            batch[key] = torch.cat([prop[:nobj][k] for prop, k in zip(props, keep)])
+        else:
+            batch[key] = torch.stack(props)
+
+    batch['Pmu'] = batch['Pmu'] * scale
+    batch['Nobj'] = torch.stack([k.sum() for k in keep])
+    batch['particle_offsets'] = F.pad(batch['Nobj'].cumsum(0), (1, 0))
+    batch['pair_offsets'] = F.pad((batch['Nobj']**2).cumsum(0), (1, 0))
+
+    return batch
@@ -3,6 +3,11 @@ from torch.utils.data import Dataset
 
 import h5py
 import numpy as np
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
+import torch.distributed as dist
 
 import logging
 logger = logging.getLogger(__name__)
@@ -10,11 +15,21 @@ logger = logging.getLogger(__name__)
 class JetDataset(Dataset):
     """
     PyTorch dataset.
+    With RAMdataset, a random subset of the file is read in blocks of at most max_memory bytes using num_threads threads.
+    With shard=(rank, num_replicas), the dataset only holds the share of the events of one DDP process (see self.positions);
+    with reshard_seed, the events are dealt out to the processes anew every epoch (see set_epoch).
+    With shared_memory (and RAMdataset), the first process of each node (LOCAL_RANK 0) reads the data into POSIX shared memory
+    and the other processes of the node map it without copying; torch.distributed must be initialized.
     """
-    def __init__(self, filename, num_pts=-1, randomize_subset=True, balance=True, RAMdataset=False):
+    def __init__(self, filename, num_pts=-1, randomize_subset=True, balance=True, RAMdataset=False, max_memory=2**28, num_threads=1,
+                 shard=None, drop_last=False, reshard_seed=None, shared_memory=False):
 
         self.filename = filename
         self.RAMdataset = RAMdataset
+        self.max_memory, self.num_threads = max_memory, num_threads
+        # Persistent read-only handle to the file (one per process, i.e. per DataLoader worker), see _h5file
+        self._file, self._file_pid = None, None
+        self._segments = None
 
         with h5py.File(filename, mode='r') as f:
             len_data = len(f[next(iter(f))])
@@ -37,9 +52,13 @@ class JetDataset(Dataset):
                 if balance:
                     # We want to shuffle things, but make sure that we keep our signal-to-background ratio
                     # We will assume there are only two possible values (0,1) of "is_signal". #TODO: We could consider generalizing/extending this, for multi-label classification problems.
-                    signal_flags = f['is_signal'][:] # This will read the entire column into RAM, which is a potential limitation
-                    signal_idxs = np.where(signal_flags==1)[0]
-                    backgd_idxs = np.where(signal_flags==0)[0]
+                    # The column is streamed in blocks of at most max_memory bytes, only the indices are kept
+                    signal_idxs, backgd_idxs = [], []
+                    for start, signal_flags in iter_blocks(f['is_signal'], max_memory):
+                        signal_idxs.append(start + np.where(signal_flags==1)[0])
+                        backgd_idxs.append(start + np.where(signal_flags==0)[0])
+                    signal_idxs = np.concatenate(signal_idxs)
+                    backgd_idxs = np.concatenate(backgd_idxs)
 
                     # We will randomly permute each list of indices using PyTorch, so that its RNG (which is global) is invoked.
                     signal_perm = torch.randperm(len(signal_idxs))
@@ -61,29 +80,242 @@ class JetDataset(Dataset):
             else:
                 self.perm = None
 
+            # With shard=(rank, num_replicas), only the share of the (shuffled) events of one process is kept (see _deal).
+            # self.positions holds the position of every kept event among the num_pts events, -1 for the padding.
+            self.positions, self.shard, self.drop_last, self.reshard_seed = None, shard, drop_last, reshard_seed
+            # The first epoch of the Trainer
+            self.epoch = 1
+            if shard is not None:
+                self._rows = np.asarray(self.perm) if self.perm is not None else np.arange(self.num_pts)
+                self.perm = self._deal()
+
             if RAMdataset:
-                logger.warn(f'Reading {self.num_pts} events from {filename} into RAM.')
-                if self.perm is None:
+                logger.warn(f'Reading {len(self)} events from {filename} into RAM.')
+                if self.perm is None and not shared_memory:
                     self.data = {key: torch.from_numpy(val[:self.num_pts]) for key, val in f.items() if len(val)==len_data}
                 else:
-                    # this returns the permutation of range(num_pts) that unsorts sorted(self.perm), and subset=sorted(self.perm)
-                    self.perm, subset = zip(*list(sorted(enumerate(self.perm), key=lambda x: x[1])[:self.num_pts]))
-                    # only load data[subset] into RAM 
-                    self.data = {key: torch.from_numpy(val[:])[torch.tensor(subset)] for key, val in f.items()}
-                    # this version will only ever read num_pts events into RAM, but will be slow because subset is not sequential
-                    # self.data = {key: torch.from_numpy(val[list(subset)]) for key, val in f.items()}
+                    if self.perm is None:
+                        keys, subset = [key for key, val in f.items() if len(val)==len_data], np.arange(self.num_pts)
+                    else:
+                        # subset=sorted(set(self.perm)), and self.perm becomes the position of every event in subset, i.e. subset[self.perm] is the original self.perm
+                        keys = list(f.keys())
+                        subset, self.perm = np.unique(np.asarray(self.perm), return_inverse=True)
+                    # only load data[subset] into RAM, streaming the file in blocks of at most max_memory bytes (shared by the threads)
+                    max_block = max_memory // max(1, min(num_threads, len(keys)))
+                    if shared_memory:
+                        self.data = self._load_shared(f, keys, subset, max_block, num_threads)
+                    else:
+                        with ThreadPoolExecutor(num_threads) as pool:
+                            columns = pool.map(lambda key: (key, read_rows(f[key], subset, max_gap=None, max_bytes=max_block)), keys)
+                            self.data = {key: torch.from_numpy(val) for key, val in columns}
             elif num_pts > 0 and num_pts < len_data:
                 logger.warn(f'Chose {num_pts} event indices from {filename}. Batches will be read directly from disk (might be slow!).')
 
+        if self.perm is not None:
+            self.perm = np.asarray(self.perm)
+
+    def _deal(self):
+        """
+        Sets self.positions to the events of this process's shard and returns their rows in the file. The shard is a
+        contiguous 1/num_replicas of the events, padded with events from the start of the dataset so that all the shards
+        have the same length (as DistributedSampler does), or with drop_last num_pts // num_replicas events without padding.
+        With reshard_seed, the events are first permuted by a generator seeded with (reshard_seed, self.epoch), which is the
+        same on all the processes since they share the seed, so the shards of an epoch still partition the events.
+        """
+        rank, num_replicas = self.shard
+        shard_size = self.num_pts // num_replicas if self.drop_last else -(-self.num_pts // num_replicas)
+        padded = np.arange(rank * shard_size, (rank + 1) * shard_size)
+        order = np.random.default_rng([self.reshard_seed, self.epoch]).permutation(self.num_pts) if self.reshard_seed is not None else np.arange(self.num_pts)
+        events = order[padded % max(1, self.num_pts)]
+        self.positions = np.where(padded < self.num_pts, events, -1)
+        return self._rows[events]
+
+    def set_epoch(self, epoch):
+        """
+        With reshard_seed, deals the events out to the processes anew for the given epoch (see _deal) and, for a RAM
+        dataset, reads the newly assigned rows from the file into the existing arrays.
+        """
+        if self.reshard_seed is None or epoch == self.epoch:
+            return
+        self.epoch = epoch
+        rows = self._deal()
+        if not self.RAMdataset:
+            self.perm = rows
+            return
+        # As in __init__, the data holds the sorted rows and self.perm the position of every event among them
+        subset, perm = np.unique(rows, return_inverse=True)
+        arrays = {key: val.numpy() for key, val in self.data.items()}
+        if any(len(array) != len(subset) for array in arrays.values()):
+            raise RuntimeError(f'The shard of {self.filename} changed size from {len(next(iter(arrays.values())))} to {len(subset)} events')
+        logger.info(f'Reading the {len(subset)} events of epoch {epoch} from {self.filename} into RAM.')
+        max_block = self.max_memory // max(1, min(self.num_threads, len(arrays)))
+        with h5py.File(self.filename, mode='r') as f, ThreadPoolExecutor(self.num_threads) as pool:
+            list(pool.map(lambda key: read_rows(f[key], subset, max_gap=None, max_bytes=max_block, out=arrays[key]), arrays))
+        self.perm = perm
+
     def __len__(self):
-        return self.num_pts
+        return len(self.positions) if self.positions is not None else self.num_pts
+
+    def _load_shared(self, f, keys, rows, max_bytes, num_threads):
+        """
+        Reads the given rows of the keys into one shared memory segment per key and returns tensors viewing the segments.
+        LOCAL_RANK 0 fills the segments, then the other processes of the node attach to them by name.
+        Once everyone is attached the names are unlinked: the memory is freed when the last process exits, even after a crash.
+        """
+        leader = int(os.environ.get('LOCAL_RANK', 0)) == 0
+        # The names only depend on the job and on the data, so they are the same on all the processes of a node
+        job = ':'.join(os.environ.get(var, '') for var in ['TORCHELASTIC_RUN_ID', 'MASTER_ADDR', 'MASTER_PORT'])
+        digest = hashlib.sha1(f'{job}:{os.path.abspath(self.filename)}'.encode() + np.asarray(rows, dtype=np.int64).tobytes())
+        specs = {key: ('pelican_' + hashlib.sha1(digest.digest() + key.encode()).hexdigest()[:20], (len(rows),) + f[key].shape[1:], f[key].dtype) for key in keys}
+        nbytes = lambda shape, dtype: max(1, int(np.prod(shape)) * dtype.itemsize)
+        segments = {}
+        if leader:
+            segments = {key: _create_segment(name, nbytes(shape, dtype)) for key, (name, shape, dtype) in specs.items()}
+            arrays = {key: np.ndarray(shape, dtype=dtype, buffer=segments[key].buf) for key, (name, shape, dtype) in specs.items()}
+            with ThreadPoolExecutor(num_threads) as pool:
+                list(pool.map(lambda key: read_rows(f[key], rows, max_gap=None, max_bytes=max_bytes, out=arrays[key]), keys))
+        dist.barrier()
+        if not leader:
+            segments = {key: _attach_segment(name) for key, (name, shape, dtype) in specs.items()}
+            arrays = {key: np.ndarray(shape, dtype=dtype, buffer=segments[key].buf) for key, (name, shape, dtype) in specs.items()}
+        dist.barrier()
+        if leader:
+            for segment in segments.values():
+                segment.unlink()
+        # The segments must stay open as long as the tensors are used
+        self._segments = list(segments.values())
+        return {key: torch.from_numpy(array) for key, array in arrays.items()}
+
+    def column(self, key):
+        """
+        Returns the values of a per-event key (e.g. 'Nobj' or 'is_signal') for every index of the dataset, in the same order
+        as __getitem__, without reading the other keys.
+        """
+        if self.RAMdataset:
+            values = self.data[key].numpy()
+        else:
+            with h5py.File(self.filename, mode='r') as f:
+                values = f[key][:] if self.perm is not None else f[key][:self.num_pts]
+        if self.perm is not None:
+            values = values[np.asarray(self.perm)]
+        return values
+
+    def __getstate__(self):
+        # h5py handles can't be pickled (e.g. when DataLoader workers are spawned); each worker reopens the file
+        state = self.__dict__.copy()
+        state['_file'], state['_file_pid'] = None, None
+        # Neither can the shared memory segments: the data itself is pickled instead
+        state['_segments'] = None
+        return state
+
+    def _h5file(self):
+        """
+        Returns a read-only handle to the file that stays open for the lifetime of the process.
+        Forked DataLoader workers inherit the parent's dataset, so the file is reopened whenever the pid changes.
+        """
+        if self._file is None or self._file_pid != os.getpid():
+            self._file, self._file_pid = h5py.File(self.filename, mode='r'), os.getpid()
+        return self._file
+
+    def close(self):
+        if self._file is not None and self._file_pid == os.getpid():
+            self._file.close()
+        self._file, self._file_pid = None, None
 
     def __getitem__(self, idx):
-        if not self.RAMdataset:
-            self.data = h5py.File(self.filename,'r')
+        data = self.data if self.RAMdataset else self._h5file()
         if self.perm is not None:
             idx = self.perm[idx]
-        item = {key: val[idx] for key, val in self.data.items()}
+        item = {key: val[idx] for key, val in data.items()}
         if not self.RAMdataset:
             item = {key: torch.from_numpy(val) if isinstance(val, np.ndarray) else torch.tensor(val) for key, val in item.items()}
         return item
+
+    def __getitems__(self, idxs):
+        """
+        Batched version of __getitem__, used by the DataLoader to fetch a whole minibatch at once.
+        Every key is read once for the entire batch and the events are returned as views into the batch arrays.
+        """
+        idxs = np.asarray(idxs, dtype=np.int64)
+        if self.perm is not None:
+            idxs = self.perm[idxs]
+        if self.RAMdataset:
+            batch = {key: val[torch.from_numpy(idxs)] for key, val in self.data.items()}
+            positions = range(len(idxs))
+        else:
+            # HDF5 selections must be increasing, so read the sorted unique rows and map every event to its row in the batch
+            rows, positions = np.unique(idxs, return_inverse=True)
+            batch = {key: torch.from_numpy(read_rows(val, rows)) for key, val in self._h5file().items()}
+        return [{key: val[i] for key, val in batch.items()} for i in positions]
+
+
+def block_rows(dataset, max_bytes):
+    # Number of rows of an HDF5 dataset that fit in max_bytes (at least one)
+    row_bytes = dataset.dtype.itemsize * int(np.prod(dataset.shape[1:]))
+    return max(1, max_bytes // max(1, row_bytes))
+
+
+def iter_blocks(dataset, max_bytes):
+    """
+    Iterates over an HDF5 dataset in consecutive blocks of at most max_bytes, yielding (first row, block).
+    """
+    step = block_rows(dataset, max_bytes)
+    for start in range(0, len(dataset), step):
+        yield start, dataset[start:start + step]
+
+
+def _create_segment(name, size):
+    try:
+        return shared_memory.SharedMemory(name=name, create=True, size=size)
+    except FileExistsError:
+        # Left over by a job that crashed before unlinking it
+        stale = shared_memory.SharedMemory(name=name)
+        stale.close()
+        stale.unlink()
+        return shared_memory.SharedMemory(name=name, create=True, size=size)
+
+
+def _attach_segment(name):
+    # Only the creator unlinks the segment, so the other processes must not let the resource tracker do it at exit
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        segment = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(segment._name, 'shared_memory')
+        return segment
+
+
+def read_rows(dataset, rows, max_gap='chunk', max_bytes=None, out=None):
+    """
+    Reads the given sorted, unique rows of an HDF5 dataset into a single pre-allocated array
+    (out if given, e.g. an array in shared memory).
+
+    The rows are split into runs whose gaps are at most max_gap rows (by default one HDF5 chunk, since a chunk
+    is always read whole anyway; None for no limit), and whose span fits in max_bytes (None for no limit).
+    Every run costs one slice read: contiguous runs are read directly into the output array,
+    the others are read as a temporary slice and the requested rows are picked from it.
+    So besides the output, the peak memory is one run of at most max_bytes.
+    """
+    if out is None:
+        out = np.empty((len(rows),) + dataset.shape[1:], dtype=dataset.dtype)
+    if len(rows) == 0:
+        return out
+    if max_gap == 'chunk':
+        max_gap = dataset.chunks[0] if dataset.chunks is not None else 1
+    breaks = np.nonzero(np.diff(rows) > max_gap)[0] + 1 if max_gap is not None else np.array([], dtype=np.int64)
+    if max_bytes is not None:
+        # Also break the runs wherever the span since the start of the current block exceeds the block size
+        step = block_rows(dataset, max_bytes)
+        span_breaks = []
+        for begin, end in zip(np.concatenate([[0], breaks]), np.concatenate([breaks, [len(rows)]])):
+            while rows[end - 1] - rows[begin] >= step:
+                begin = begin + np.searchsorted(rows[begin:end], rows[begin] + step)
+                span_breaks.append(begin)
+        breaks = np.union1d(breaks, np.array(span_breaks, dtype=np.int64)).astype(np.int64)
+    for begin, end in zip(np.concatenate([[0], breaks]), np.concatenate([breaks, [len(rows)]])):
+        start, stop = rows[begin], rows[end - 1] + 1
+        if stop - start == end - begin:
+            dataset.read_direct(out, source_sel=np.s_[start:stop], dest_sel=np.s_[begin:end])
+        else:
+            out[begin:end] = dataset[start:stop][rows[begin:end] - start]
+    return out
@@ -0,0 +1,137 @@
+import torch
+from torch.utils.data import Sampler
+import torch.distributed as dist
+
+import numpy as np
+from math import ceil
+
+import logging
+logger = logging.getLogger(__name__)
+
+
+class PairBudgetBatchSampler(Sampler):
+    """
+    Batch sampler that groups events of similar multiplicity so that every batch costs about the same.
+
+    The cost of a padded batch is (batch size) x N_max^2, so instead of a fixed batch size the batches are filled
+    greedily up to a pair budget: len(batch) * max(Nobj in batch)**2 <= max_pairs. Events are shuffled, split into
+    pools of pool_size, and sorted by Nobj within each pool, so that batches are both homogeneous and random.
+
+    Parameters
+    ----------
+    nobj : array of ints
+        Multiplicity of every event of the dataset (e.g. JetDataset.column('Nobj')).
+    max_pairs : int
+        Pair budget of a batch. An event that alone exceeds the budget forms its own batch.
+    labels : array of {0,1} or None
+        Binary labels (e.g. JetDataset.column('is_signal')). If given, signal and background events are drawn
+        in pairs of similar multiplicity, so every batch is balanced (as with JetDataset(balance=True)).
+        Events left over from the larger class are batched on their own.
+    nobj_cap : int or None
+        The --nobj cutoff of collate_fn, i.e. the maximum number of particles kept per event.
+    shuffle : bool
+        Reshuffle the events and the batches every epoch (see set_epoch).
+    pool_size : int
+        Number of units (events, or signal/background pairs) sorted together.
+    num_replicas, rank : int or None
+        Same as in DistributedSampler: every rank builds the same list of batches and takes every num_replicas-th one.
+        The list is padded with its first batches (or truncated if drop_last) to a multiple of num_replicas.
+    """
+    def __init__(self, nobj, max_pairs, labels=None, nobj_cap=None, shuffle=True, pool_size=2048,
+                 num_replicas=None, rank=None, seed=0, drop_last=False):
+        if num_replicas is None:
+            num_replicas = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+        if rank is None:
+            rank = dist.get_rank() if dist.is_available() and dist.is_initialized() else 0
+        if rank >= num_replicas or rank < 0:
+            raise ValueError(f"Invalid rank {rank}, rank should be in the interval [0, {num_replicas - 1}]")
+
+        self.nobj = np.asarray(nobj).astype(np.int64).reshape(-1)
+        if nobj_cap is not None and nobj_cap > 0:
+            self.nobj = np.minimum(self.nobj, nobj_cap)
+        self.labels = None if labels is None else np.asarray(labels).reshape(-1)
+        self.max_pairs = max_pairs
+        self.shuffle = shuffle
+        self.pool_size = pool_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self._batches = None
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self._batches = None
+
+    def _permutation(self, idxs, generator):
+        if self.shuffle:
+            return idxs[torch.randperm(len(idxs), generator=generator).numpy()]
+        return idxs
+
+    def _units(self, generator):
+        """
+        Splits the events into units that always go to the same batch (single events, or signal/background pairs),
+        grouped into pools of events of similar multiplicity. Returns a list of (units, cost) per pool.
+        """
+        pool_size = self.pool_size
+        if self.labels is None:
+            idxs = self._permutation(np.arange(len(self.nobj)), generator)
+            pools = [idxs[i:i + pool_size, None] for i in range(0, len(idxs), pool_size)]
+        else:
+            signal_idxs = self._permutation(np.where(self.labels == 1)[0], generator)
+            backgd_idxs = self._permutation(np.where(self.labels == 0)[0], generator)
+            num_pairs = min(len(signal_idxs), len(backgd_idxs))
+            pools = []
+            for i in range(0, num_pairs, pool_size):
+                # Sorting both classes in the same pool before pairing them up keeps the pairs homogeneous
+                signal = signal_idxs[i:min(i + pool_size, num_pairs)]
+                backgd = backgd_idxs[i:min(i + pool_size, num_pairs)]
+                signal = signal[np.argsort(self.nobj[signal], kind='stable')]
+                backgd = backgd[np.argsort(self.nobj[backgd], kind='stable')]
+                pools.append(np.stack([signal, backgd], axis=1))
+            leftover = np.concatenate([signal_idxs[num_pairs:], backgd_idxs[num_pairs:]])
+            pools += [leftover[i:i + pool_size, None] for i in range(0, len(leftover), pool_size)]
+
+        out = []
+        for units in pools:
+            cost = self.nobj[units].max(axis=1)
+            order = np.argsort(cost, kind='stable')
+            out.append((units[order], cost[order]))
+        return out
+
+    def _make_batches(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+
+        batches = []
+        for units, cost in self._units(generator):
+            unit_size = units.shape[1]
+            start = 0
+            # Units are sorted by cost, so the last unit added is always the one with the largest multiplicity
+            for end in range(1, len(units) + 1):
+                if end - start > 1 and (end - start) * unit_size * cost[end - 1]**2 > self.max_pairs:
+                    batches.append(units[start:end - 1].reshape(-1).tolist())
+                    start = end - 1
+            batches.append(units[start:].reshape(-1).tolist())
+
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=generator).tolist()]
+
+        if self.drop_last:
+            batches = batches[:len(batches) - len(batches) % self.num_replicas]
+        else:
+            padding = -len(batches) % self.num_replicas
+            batches += (batches * ceil(padding / max(len(batches), 1)))[:padding]
+        return batches[self.rank::self.num_replicas]
+
+    def _get_batches(self):
+        if self._batches is None:
+            self._batches = self._make_batches()
+        return self._batches
+
+    def __iter__(self):
+        return iter(self._get_batches())
+
+    def __len__(self):
+        return len(self._get_batches())
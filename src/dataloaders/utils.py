@@ -1,5 +1,6 @@
 import numpy as np
 import torch
+import torch.distributed as dist
 import logging, glob
 import logging
 logger = logging.getLogger(__name__)
@@ -7,9 +8,12 @@ logger = logging.getLogger(__name__)
 from torch.utils.data import ConcatDataset
 from . import JetDataset
 
-def initialize_datasets(args, datadir='../../data/sample_data', num_pts=None, testfile='', balance=True, RAMdataset=True):
+def initialize_datasets(args, datadir='../../data/sample_data', num_pts=None, testfile='', balance=True, RAMdataset=True, RAM_max_memory=2**28, RAM_threads=1, RAM_distributed='replicate'):
     """
     Initialize datasets.
+    RAM_max_memory (in bytes) and RAM_threads control how the subsets of the files are read into RAM (see JetDataset).
+    RAM_distributed sets what each process of a DDP run holds: 'replicate' (all the events), 'shard' (only its share of the events)
+    or 'shared' (all the events, in shared memory mapped by all the processes of a node).
     """
 
     ### ------ 1: Get the file names ------ ###
@@ -77,15 +81,24 @@ def initialize_datasets(args, datadir='../../data/sample_data', num_pts=None, te
 
     ### ------ 5: Initialize datasets ------ ###
     # Now initialize datasets based upon loaded data
-    torch_datasets = {split: ConcatDatasetChild([JetDataset(filename, num_pts=num_pts_per_file[split][idx], randomize_subset=randomize_subset[split], balance=balance, RAMdataset=RAMdataset_splits[split]) for idx, filename in enumerate(datasets[split]) if num_pts_per_file[split][idx]!=0]) for split in splits if len(datasets[split])>0}
+    world_size = dist.get_world_size() if dist.is_available() and dist.is_initialized() else 1
+    distribution = {split: {} for split in splits}
+    if world_size > 1 and RAM_distributed == 'shard':
+        distribution = {split: {'shard': (dist.get_rank(), world_size)} for split in splits}
+        # The training shards leave the remainder of the events out instead of training on padding, and are dealt out to the
+        # processes anew every epoch when the training set is shuffled (see JetDataset.set_epoch)
+        distribution['train'].update(drop_last=True, reshard_seed=args.seed if args.shuffle else None)
+    elif world_size > 1 and RAM_distributed == 'shared' and RAMdataset:
+        distribution = {split: {'shared_memory': True} for split in splits}
+    torch_datasets = {split: ConcatDatasetChild([JetDataset(filename, num_pts=num_pts_per_file[split][idx], randomize_subset=randomize_subset[split], balance=balance, RAMdataset=RAMdataset_splits[split], max_memory=RAM_max_memory, num_threads=RAM_threads, **distribution[split]) for idx, filename in enumerate(datasets[split]) if num_pts_per_file[split][idx]!=0]) for split in splits if len(datasets[split])>0}
 
-    # Now, update the number of training/test/validation sets in args
+    # Now, update the number of training/test/validation sets in args (all the events, even if this process only holds a shard)
     if 'train' in torch_datasets.keys():
-        args.num_train = torch_datasets['train'].cumulative_sizes[-1]
+        args.num_train = torch_datasets['train'].num_events
     if 'test' in torch_datasets.keys():
-        args.num_test = torch_datasets['test'].cumulative_sizes[-1]
+        args.num_test = torch_datasets['test'].num_events
     if 'valid' in torch_datasets.keys():
-        args.num_valid = torch_datasets['valid'].cumulative_sizes[-1]
+        args.num_valid = torch_datasets['valid'].num_events
 
     return args, torch_datasets
 
@@ -96,8 +109,46 @@ class ConcatDatasetChild(ConcatDataset):
     def __init__(self, list):
         ConcatDataset.__init__(self, list)
         self.fast_skip=False
+        # Offsets of the datasets among all the events, which differ from cumulative_sizes when the datasets are sharded (see JetDataset.positions)
+        sizes = [getattr(dataset, 'num_pts', len(dataset)) for dataset in self.datasets]
+        self.num_events = int(np.sum(sizes))
+        self.event_offsets = np.concatenate([[0], np.cumsum(sizes)[:-1]]).astype(np.int64)
     
+    def set_epoch(self, epoch):
+        # Deals the events of rank-sharded training datasets out to the processes anew (see JetDataset.set_epoch)
+        for dataset in self.datasets:
+            if hasattr(dataset, 'set_epoch'):
+                dataset.set_epoch(epoch)
+        self.cumulative_sizes = self.cumsum(self.datasets)
+
     def __getitem__(self, idx):
         if self.fast_skip:
             return None
-        return ConcatDataset.__getitem__(self, idx)
+        return self.__getitems__([idx])[0]
+
+    def __getitems__(self, idxs):
+        # Batched reads: every index is routed to its dataset, each dataset reads its share at once (see JetDataset.__getitems__)
+        if self.fast_skip:
+            return [None] * len(idxs)
+        idxs = np.asarray(idxs, dtype=np.int64)
+        idxs = np.where(idxs < 0, idxs + len(self), idxs)
+        dataset_idxs = np.searchsorted(self.cumulative_sizes, idxs, side='right')
+        items = [None] * len(idxs)
+        for dataset_idx in np.unique(dataset_idxs):
+            positions = np.nonzero(dataset_idxs == dataset_idx)[0]
+            offset = self.cumulative_sizes[dataset_idx - 1] if dataset_idx > 0 else 0
+            dataset = self.datasets[dataset_idx]
+            # Position of the events among all the events, which collate_fn stacks like the other per-event keys (-1 for the padding of a shard)
+            index = idxs[positions] - offset
+            if getattr(dataset, 'positions', None) is not None:
+                index = np.where(dataset.positions[index] >= 0, self.event_offsets[dataset_idx] + dataset.positions[index], -1)
+            else:
+                index = self.event_offsets[dataset_idx] + index
+            for position, event_index, item in zip(positions, index, dataset.__getitems__(idxs[positions] - offset)):
+                item['index'] = torch.tensor(event_index)
+                items[position] = item
+        return items
+
+    def column(self, key):
+        # Values of a per-event key (e.g. 'Nobj') across all the datasets, see JetDataset.column
+        return np.concatenate([dataset.column(key) for dataset in self.datasets])
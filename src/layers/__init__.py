@@ -1,5 +1,6 @@
-from .generic_layers import BasicMLP, MessageNet, get_activation_fn, InputEncoder, SoftMask, GInvariants, MyLinear
-from .perm_equiv_layers import eops_1_to_1, eops_2_to_2, eops_2_to_1, eops_2_to_0, eops_1_to_2
+from .generic_layers import BasicMLP, MessageNet, get_activation_fn, InputEncoder, SoftMask, GInvariants, MyLinear, checkpoint_module
+from .perm_equiv_layers import eops_1_to_1, eops_2_to_2, eops_2_to_1, eops_2_to_0, eops_1_to_2, multi_aggregate_1, multi_aggregate_2
 from .perm_equiv_models import Eq2to2, Eq2to0, Eq2to1, Net2to2, Eq1to2
+from .packed_layers import Packing, segment_reduce, add_spurions_packed
 from .masked_batchnorm import MaskedBatchNorm1d, MaskedBatchNorm2d, MaskedBatchNorm3d
 from .masked_instancenorm import masked_instance_norm, MaskedInstanceNorm1d, MaskedInstanceNorm2d, MaskedInstanceNorm3d
\ No newline at end of file
@@ -1,6 +1,8 @@
 import torch
 import math
+import contextlib
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 from .masked_batchnorm import MaskedBatchNorm1d, MaskedBatchNorm2d
 from .masked_instancenorm import MaskedInstanceNorm2d, MaskedInstanceNorm3d
 # from ..models.lorentz_metric import dot4, dot3, dot2, dot12, dot11
@@ -9,6 +11,31 @@ import traceback
 
 
 
+@contextlib.contextmanager
+def frozen_running_stats(module):
+    """
+    Restores the running statistics of the norm layers of module on exit, so that the recomputation
+    of a checkpointed block during the backward pass doesn't update them a second time.
+    """
+    norms = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._NormBase) and m.running_mean is not None]
+    saved = [(m.running_mean.clone(), m.running_var.clone(), m.num_batches_tracked.clone()) for m in norms]
+    try:
+        yield
+    finally:
+        for m, (mean, var, num_batches) in zip(norms, saved):
+            m.running_mean, m.running_var = mean, var
+            m.num_batches_tracked.copy_(num_batches)
+
+def checkpoint_module(function, module, *args, **kwargs):
+    """
+    Runs function(*args, **kwargs) under activation checkpointing: only the inputs are saved, and the forward pass of
+    function is recomputed during the backward pass. The RNG state is restored for the recomputation, so dropout
+    masks are identical, and the running statistics of the norm layers of module are only updated once.
+    """
+    return checkpoint(function, *args, use_reentrant=False, preserve_rng_state=True,
+                      context_fn=lambda: (contextlib.nullcontext(), frozen_running_stats(module)), **kwargs)
+
+
 class MyLinear(nn.Module):
     r"""Applies a linear transformation to the incoming data: :math:`y = xA^T + b`
 
@@ -206,13 +233,21 @@ class MessageNet(nn.Module):
         self.zero = torch.tensor(0, device=device, dtype=dtype)
         self.to(device=device, dtype=dtype)
 
-    def forward(self, x, mask=None):
+    def forward(self, x, mask=None, packing=None):
         # Standard MLP. Loop over a linear layer followed by a non-linear activation
 
         for (lin, activation) in zip(self.linear, self.activations):
             x = activation(lin(x))
 
-        if self.batchnorm: 
+        if self.batchnorm and packing is not None:
+            # Packed batch (see packed_layers.Packing): x is P x C and contains only valid pairs
+            if not self.batchnorm.startswith('b'):
+                raise NotImplementedError("Only batchnorm is supported for packed batches")
+            if self.masked:
+                x = self.normlayer(x.view(1, 1, -1, x.shape[-1]), torch.ones(1, 1, x.shape[0], dtype=torch.bool, device=x.device)).view(x.shape)
+            else:
+                x = self.normlayer(x.t().view(1, x.shape[-1], 1, -1)).view(x.shape[-1], -1).t()
+        elif self.batchnorm: 
             if self.batchnorm.startswith('b') or self.batchnorm.startswith('i'):
                 if len(x.shape)==3:
                     if self.masked:
@@ -256,9 +291,13 @@ class MessageNet(nn.Module):
 
 
 class InputEncoder(nn.Module):
-    def __init__(self, rank1_dim_multiplier, rank2_dim_multiplier, rank1_in_dim = 0, rank2_in_dim = 1, mode = 'log', device=torch.device('cpu'), dtype=torch.float):
+    def __init__(self, rank1_dim_multiplier, rank2_dim_multiplier, rank1_in_dim = 0, rank2_in_dim = 1, mode = 'log', symmetric=False, device=torch.device('cpu'), dtype=torch.float):
         super().__init__()
 
+        # With symmetric=True the rank 2 inputs are assumed symmetric under i<->j (as all the invariants from GInvariants are),
+        # and the embedding MLP only runs on the upper triangle. In training, this also mirrors its dropout mask.
+        self.symmetric = symmetric
+
         self.embedding_dim = rank2_dim_multiplier
         self.rank2_embed_mlp = nn.Sequential(
             nn.Linear(self.embedding_dim, 32),   
@@ -278,11 +317,14 @@ class InputEncoder(nn.Module):
             # rank2_dim is never higher than 1 for us, so these alphas are defined with that in mind
             # self.rank2_alphas = nn.Parameter(torch.linspace(0.05, 0.5, rank2_dim_multiplier, device=device, dtype=dtype).unsqueeze(-1).repeat((1, rank2_in_dim)).t())
             self.rank2_alphas = nn.Parameter(torch.linspace(0.05, 0.5, rank2_dim_multiplier, device=device, dtype=dtype))
+            # The embedding MLP replaced them in forward; they stay a parameter so that the checkpoints keep loading,
+            # but get no gradient, which lets DistributedDataParallel skip looking for unused parameters
+            self.rank2_alphas.requires_grad_(False)
         # self.alphas = nn.Parameter(0.5 * torch.rand(1, 1, 1, out_dim, device=device, dtype=dtype))
         # self.betas = nn.Parameter(torch.randn(1, 1, 1, out_dim, device=device, dtype=dtype))
         self.zero = torch.tensor(0, device=device, dtype=dtype)
 
-    def forward(self, rank1_inputs, dot_products, rank1_mask=None, rank2_mask=None):        
+    def forward(self, rank1_inputs, dot_products, rank1_mask=None, rank2_mask=None, packing=None):        
         if self.rank1_in_dim > 0:
             s = rank1_inputs.shape[:-1]
             l = len(s)
@@ -292,9 +334,23 @@ class InputEncoder(nn.Module):
             rank1_out = None
         if self.rank2_in_dim > 0: 
             orig_shape = dot_products.shape  # (B, N, N, embedding_dim)
-            mlp_in = dot_products.reshape(-1, self.embedding_dim)  # (B*N*N, embedding_dim)
-            mlp_out = self.rank2_embed_mlp(mlp_in)                # (B*N*N, 1)
-            rank2_out = mlp_out.view(orig_shape[:-1])             # (B, N, N)
+            if self.symmetric and packing is not None:
+                # Evaluate the MLP on the pairs i<=j and mirror the result to (j,i)
+                upper = packing.upper_pairs
+                mlp_out = self.rank2_embed_mlp(dot_products[upper]).view(-1)
+                rank2_out = mlp_out.new_empty(orig_shape[:-1])
+                rank2_out[upper] = mlp_out
+                rank2_out[packing.pair_transpose[upper]] = mlp_out
+            elif self.symmetric:
+                rows, cols = torch.triu_indices(orig_shape[1], orig_shape[2], device=dot_products.device)
+                mlp_out = self.rank2_embed_mlp(dot_products[:, rows, cols]).squeeze(-1)   # (B, N(N+1)/2)
+                rank2_out = mlp_out.new_empty(orig_shape[:-1])
+                rank2_out[:, rows, cols] = mlp_out
+                rank2_out[:, cols, rows] = mlp_out
+            else:
+                mlp_in = dot_products.reshape(-1, self.embedding_dim)  # (B*N*N, embedding_dim)
+                mlp_out = self.rank2_embed_mlp(mlp_in)                # (B*N*N, 1)
+                rank2_out = mlp_out.view(orig_shape[:-1])             # (B, N, N)
         else:
             rank2_out = None
 
@@ -323,19 +379,26 @@ class GInvariants(nn.Module):
         self.rank1_dim = dict_rank1[stabilizer]
         self.rank2_dim = dict_rank2[stabilizer]
 
-    def forward(self, event_momenta):
+    def forward(self, event_momenta, packing=None):
         dtype, device = event_momenta.dtype, event_momenta.device
+        # Broadcast a rank 1 tensor to the (j, i) pairs: N x N for padded batches, or the P packed pairs (see packed_layers.Packing)
+        if packing is None:
+            pairs = lambda x: (x.unsqueeze(1), x.unsqueeze(2))
+        else:
+            if self.irc_safe:
+                raise NotImplementedError("The irc_safe option is not supported for packed batches")
+            pairs = lambda x: (x[packing.pair_cols], x[packing.pair_rows])
         # event_momenta = event_momenta.unsqueeze(1)
         if self.stabilizer == '1':
             rank1 = event_momenta
-            rank2 = rank1.unsqueeze(1)*rank1.unsqueeze(2)
+            rank2 = torch.mul(*pairs(rank1))
             rank1 = None
         elif self.stabilizer == '1_0':
             rank1 = event_momenta @ torch.tensor([[1,0,0,1],[1,-1,0,0],[1,0,-1,0],[1,0,0,-1]],dtype=dtype,device=device).t()
-            rank2 = rank1.unsqueeze(1)*rank1.unsqueeze(2)
+            rank2 = torch.mul(*pairs(rank1))
             rank1 = None
         else:
-            dot_products = dot4(event_momenta.unsqueeze(1), event_momenta.unsqueeze(2)).unsqueeze(-1)
+            dot_products = dot4(*pairs(event_momenta)).unsqueeze(-1)
             if self.stabilizer=='so13':   # L_x, L_y, L_z, K_x, K_y, K_z
                 rank1 = None
             elif self.stabilizer=='so3':  # L_x, L_y, L_z
@@ -362,7 +425,7 @@ class GInvariants(nn.Module):
             if rank1 == None:
                 rank2 = dot_products
             else:
-                rank2 = torch.cat([rank1.unsqueeze(1)*rank1.unsqueeze(2), dot_products], dim=-1)
+                rank2 = torch.cat([torch.mul(*pairs(rank1)), dot_products], dim=-1)
 
         # TODO: make irc_safe option work with rank1 inputs
         irc_weight = None
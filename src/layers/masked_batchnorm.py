@@ -70,19 +70,25 @@ class MaskedBatchNorm1d(nn.BatchNorm1d):
                 else:
                     exponential_average_factor = self.momentum
 
-        if self.training and n > 1:
+        if self.training:
             # E[x] = sum(mask*x)/n  over batch & spatial dims (0,1,2)
             mean = (mask * inp).sum(dim=(0,1,2)) / n
             # Var = E[x^2] - E[x]^2
             ex2  = (mask * (inp**2)).sum(dim=(0,1,2)) / n
             var  = ex2 - mean**2
 
-            with torch.no_grad():
-                self.running_mean = exponential_average_factor * mean + \
-                                    (1 - exponential_average_factor) * self.running_mean
-                # unbiased correction
-                self.running_var  = exponential_average_factor * var * (n/(n-1)) + \
-                                    (1 - exponential_average_factor) * self.running_var
+            # With fewer than 2 unmasked entries the running statistics are used (and kept) instead,
+            # selected with torch.where so that n never has to be read on the host
+            enough = n > 1
+            if self.track_running_stats:
+                with torch.no_grad():
+                    self.running_mean = torch.where(enough, exponential_average_factor * mean + \
+                                        (1 - exponential_average_factor) * self.running_mean, self.running_mean)
+                    # unbiased correction
+                    self.running_var  = torch.where(enough, exponential_average_factor * var * (n/(n-1)) + \
+                                        (1 - exponential_average_factor) * self.running_var, self.running_var)
+            mean = torch.where(enough, mean, self.running_mean)
+            var  = torch.where(enough, var, self.running_var)
         else:
             mean = self.running_mean
             var  = self.running_var
@@ -145,18 +151,24 @@ class MaskedBatchNorm2d(nn.BatchNorm2d):
                 else:
                     exponential_average_factor = self.momentum
 
-        if self.training and n > 1:
+        if self.training:
             # E[x] and Var[x] over batch & both spatial dims (0,1,2)
             mean = (mask * inp).sum(dim=(0, 1, 2)) / n
             ex2  = (mask * (inp ** 2)).sum(dim=(0, 1, 2)) / n
             var  = ex2 - mean ** 2
 
-            with torch.no_grad():
-                self.running_mean = exponential_average_factor * mean + \
-                                    (1 - exponential_average_factor) * self.running_mean
-                # Unbiased correction
-                self.running_var  = exponential_average_factor * var * (n / (n - 1)) + \
-                                    (1 - exponential_average_factor) * self.running_var
+            # With fewer than 2 unmasked entries the running statistics are used (and kept) instead,
+            # selected with torch.where so that n never has to be read on the host
+            enough = n > 1
+            if self.track_running_stats:
+                with torch.no_grad():
+                    self.running_mean = torch.where(enough, exponential_average_factor * mean + \
+                                        (1 - exponential_average_factor) * self.running_mean, self.running_mean)
+                    # Unbiased correction
+                    self.running_var  = torch.where(enough, exponential_average_factor * var * (n / (n - 1)) + \
+                                        (1 - exponential_average_factor) * self.running_var, self.running_var)
+            mean = torch.where(enough, mean, self.running_mean)
+            var  = torch.where(enough, var, self.running_var)
         else:
             mean = self.running_mean
             var  = self.running_var
@@ -196,9 +208,6 @@ class MaskedBatchNorm3d(nn.BatchNorm3d):
         self.zero = torch.tensor(0, device=device, dtype=dtype)
 
     def forward(self, inp, mask):
-        print("MaskedBatchNorm call:")
-        print("inp.shape:", inp.shape)
-        print("mask.shape:", mask.shape)
         self._check_input_dim(inp)
         
         # We transform the mask into a sort of P(inp) with equal probabilities
@@ -222,7 +231,7 @@ class MaskedBatchNorm3d(nn.BatchNorm3d):
                     exponential_average_factor = self.momentum
 
         # calculate running estimates
-        if self.training and (n > 1).all():
+        if self.training:
             # Here lies the trick. Using Var(X) = E[X^2] - E[X]^2 as the biased
             # variance, we do not need to make any tensor shape manipulation.
             # mean = E[X] is simply the sum-product of our "probability" mask with the input...
@@ -230,12 +239,17 @@ class MaskedBatchNorm3d(nn.BatchNorm3d):
             # ...whereas Var(X) is directly derived from the above formulae
             # This should be numerically equivalent to the biased sample variance
             var = (mask * inp ** 2).sum([0, 1, 2, 3]) - mean ** 2
-            with torch.no_grad():
-                self.running_mean = exponential_average_factor * mean\
-                    + (1 - exponential_average_factor) * self.running_mean
-                # Update running_var with unbiased var
-                self.running_var = exponential_average_factor * var * n / (n - 1)\
-                    + (1 - exponential_average_factor) * self.running_var
+            # Fall back to the running statistics without reading n on the host
+            enough = (n > 1).all()
+            if self.track_running_stats:
+                with torch.no_grad():
+                    self.running_mean = torch.where(enough, exponential_average_factor * mean\
+                        + (1 - exponential_average_factor) * self.running_mean, self.running_mean)
+                    # Update running_var with unbiased var
+                    self.running_var = torch.where(enough, exponential_average_factor * var * n / (n - 1)\
+                        + (1 - exponential_average_factor) * self.running_var, self.running_var)
+            mean = torch.where(enough, mean, self.running_mean)
+            var = torch.where(enough, var, self.running_var)
         else:
             mean = self.running_mean
             var = self.running_var
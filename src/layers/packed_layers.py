@@ -0,0 +1,287 @@
+import torch
+import torch.nn.functional as F
+
+# Packed (padding-free) batches: the particles of all events are concatenated into one Npart x C tensor,
+# and the N_b x N_b pairs of each event b are flattened in row-major order and concatenated into one P x C tensor,
+# where Npart = sum(N_b) and P = sum(N_b**2). The Packing object holds the index tensors that map between the two.
+
+class Packing:
+    """
+    Index bookkeeping for a packed batch.
+
+    nobj: tensor with the number of particles N_b of each event (B or B x 1)
+    """
+    def __init__(self, nobj):
+        nobj = nobj.view(-1).long()
+        device = nobj.device
+        events = torch.arange(len(nobj), device=device)
+
+        self.batch_size = len(nobj)
+        self.nobj = nobj
+        self.particle_offsets = F.pad(nobj.cumsum(0), (1, 0))       # B+1
+        self.pair_offsets = F.pad((nobj**2).cumsum(0), (1, 0))      # B+1
+        self.num_particles = int(self.particle_offsets[-1])
+        self.num_pairs = int(self.pair_offsets[-1])
+
+        # Event index of every particle and every pair
+        self.particle_event = torch.repeat_interleave(events, nobj, output_size=self.num_particles)    # Npart
+        self.pair_event = torch.repeat_interleave(events, nobj**2, output_size=self.num_pairs)         # P
+
+        n = nobj[self.pair_event]
+        local = torch.arange(self.num_pairs, device=device) - self.pair_offsets[self.pair_event]
+        rows, cols = local // n, local % n
+        # Global (packed) particle index of the first and second particle of every pair
+        self.pair_rows = self.particle_offsets[self.pair_event] + rows
+        self.pair_cols = self.particle_offsets[self.pair_event] + cols
+        # Pair index of the transposed pair (j,i) and the diagonal indicator i==j
+        self.pair_transpose = self.pair_offsets[self.pair_event] + cols * n + rows
+        self.is_diag = rows == cols
+        # Pair indices of the upper triangle i<=j (enough to describe a symmetric pair tensor)
+        self.upper_pairs = torch.nonzero(rows <= cols).view(-1)
+        # Pair index of the diagonal entry (i,i) of every particle
+        local = torch.arange(self.num_particles, device=device) - self.particle_offsets[self.particle_event]
+        self.diag_pairs = self.pair_offsets[self.particle_event] + local * (nobj[self.particle_event] + 1)
+
+def segment_reduce(x, index, num_segments, reduce='sum'):
+    """
+    Reduces the rows of x that share the same index ('sum', 'amax' or 'amin').
+    x: M x C, index: M
+    Returns: num_segments x C
+    """
+    out = x.new_zeros((num_segments,) + x.shape[1:])
+    if reduce == 'sum':
+        return out.index_add(0, index, x)
+    return out.scatter_reduce(0, index.view([-1] + [1,] * (x.dim() - 1)).expand_as(x), x, reduce, include_self=False)
+
+def _segment_extrema(x, index, num_segments, aggregations):
+    mins = segment_reduce(x, index, num_segments, 'amin') if 'min' in aggregations else None
+    maxs = segment_reduce(x, index, num_segments, 'amax') if 'max' in aggregations else None
+    return mins, maxs
+
+def multi_aggregate_packed_1(inputs, packing, nobj=None, nobj_avg=49, aggregations=('mean',)):
+    """
+    Packed counterpart of multi_aggregate_1: aggregates the particles of each event.
+    inputs: Npart x C
+    Returns: {aggregation: B x C tensor}
+    """
+    aggregations = set(aggregations)
+    B = packing.batch_size
+    if aggregations & {'sum', 'mean', 'var'}:
+        sums = segment_reduce(inputs, packing.particle_event, B)
+    if aggregations & {'max', 'min'}:
+        mins, maxs = _segment_extrema(inputs, packing.particle_event, B, aggregations)
+
+    result = {}
+    for aggregation in aggregations:
+        n = nobj_avg if aggregation == 'sum' else nobj.view(-1, 1)
+        if aggregation in ['sum', 'mean']:
+            result[aggregation] = sums / n
+        elif aggregation == 'max':
+            result[aggregation] = maxs - n.log()
+        elif aggregation == 'min':
+            result[aggregation] = mins + n.log()
+        elif aggregation == 'var':
+            result[aggregation] = segment_reduce((inputs - (sums / n)[packing.particle_event])**2, packing.particle_event, B) / n
+        else:
+            raise ValueError("Unknown aggregation", aggregation)
+    return result
+
+def multi_aggregate_packed(inputs, packing, nobj=None, nobj_avg=49, aggregations=('mean',), parts=('diag', 'rows', 'cols', 'all'), symmetric=False):
+    """
+    Packed counterpart of multi_aggregate_2. Only the pairs that exist are reduced, so unlike the padded version
+    max and min never see the zeros of padded entries.
+
+    inputs: P x C
+    parts: subset of 'diag' (B x C), 'rows' (Npart x C, aggregated over the second particle), 'cols' (Npart x C), 'all' (B x C)
+    symmetric: declares that the (i,j) and (j,i) pairs are equal, so the column aggregates are the row aggregates
+    Returns: {aggregation: {part: tensor}}
+    """
+    if symmetric and 'cols' in parts:
+        result = multi_aggregate_packed(inputs, packing, nobj, nobj_avg, aggregations, parts=tuple(p for p in parts if p != 'cols') + (() if 'rows' in parts else ('rows',)))
+        for aggregates in result.values():
+            aggregates['cols'] = aggregates['rows'] if 'rows' in parts else aggregates.pop('rows')
+        return result
+    aggregations = set(aggregations)
+    B, Npart = packing.batch_size, packing.num_particles
+    diag_part = inputs[packing.diag_pairs] # Npart x C
+    # (source, index, number of segments) of every part; totals are reduced from the row aggregates
+    segments = {'diag': (diag_part, packing.particle_event, B), 'rows': (inputs, packing.pair_rows, Npart), 'cols': (inputs, packing.pair_cols, Npart)}
+
+    sums, mins, maxs = {}, {}, {}
+    if aggregations & {'sum', 'mean', 'var'}:
+        for p in ['diag', 'rows', 'cols']:
+            if p in parts or (p == 'rows' and 'all' in parts):
+                sums[p] = segment_reduce(*segments[p])
+        if 'all' in parts:
+            sums['all'] = segment_reduce(sums['rows'], packing.particle_event, B)
+    if aggregations & {'max', 'min'}:
+        for p in ['diag', 'rows', 'cols']:
+            if p in parts or (p == 'rows' and 'all' in parts):
+                mins[p], maxs[p] = _segment_extrema(*segments[p], aggregations)
+        if 'all' in parts:
+            mins['all'] = None if mins['rows'] is None else segment_reduce(mins['rows'], packing.particle_event, B, 'amin')
+            maxs['all'] = None if maxs['rows'] is None else segment_reduce(maxs['rows'], packing.particle_event, B, 'amax')
+
+    # Particle counts broadcast to the rows of each part
+    counts = {}
+    if nobj is not None:
+        nobj = nobj.view(-1, 1)
+        counts = {'diag': nobj, 'rows': nobj[packing.particle_event], 'cols': nobj[packing.particle_event], 'all': nobj}
+    result = {}
+    for aggregation in aggregations:
+        result[aggregation] = {}
+        for p in parts:
+            n = nobj_avg if aggregation == 'sum' else counts[p]
+            power = 2 if p == 'all' else 1
+            if aggregation in ['sum', 'mean']:
+                result[aggregation][p] = sums[p] / n**power
+            elif aggregation == 'max':
+                result[aggregation][p] = maxs[p] - n.log()
+            elif aggregation == 'min':
+                result[aggregation][p] = mins[p] + n.log()
+            elif aggregation == 'var':
+                mean = sums[p] / n**power
+                if p == 'all':
+                    src, index, num = inputs, packing.pair_event, B
+                else:
+                    src, index, num = segments[p]
+                result[aggregation][p] = segment_reduce((src - mean[index])**2, index, num) / n**power
+            else:
+                raise ValueError("Unknown aggregation", aggregation)
+    return result
+
+def packed_eops_1_to_2(inputs, nobj=None, nobj_avg=49, aggregation='mean', weight=None, aggregates=None, mult=None, packing=None):
+    '''
+    Packed counterpart of eops_1_to_2.
+    inputs: Npart x C
+    mult: optional B x C x 5 multipliers of the five operators
+    Returns: P x C x 5
+    '''
+    if weight is not None:
+        raise NotImplementedError("IRC weights are not supported for packed batches")
+    if aggregates is None:
+        aggregates = multi_aggregate_packed_1(inputs, packing, nobj, nobj_avg, [aggregation])[aggregation]
+    sum_all = aggregates # B x C
+    diag = packing.is_diag.unsqueeze(-1)
+
+    def scaled(x, k, index):
+        return x if mult is None else x * mult[index, :, k]
+
+    op1 = scaled(inputs, 0, packing.particle_event)[packing.pair_rows] * diag
+    op2 = scaled(inputs, 1, packing.particle_event)[packing.pair_cols]
+    op3 = scaled(inputs, 2, packing.particle_event)[packing.pair_rows]
+    op4 = scaled(sum_all, 3, slice(None))[packing.pair_event] * diag
+    op5 = scaled(sum_all, 4, slice(None))[packing.pair_event]
+    return torch.stack([op1, op2, op3, op4, op5], dim=2)
+
+def packed_eops_2_to_0(inputs, nobj=None, nobj_avg=49, aggregation='mean', weight=None, aggregates=None, packing=None):
+    '''
+    Packed counterpart of eops_2_to_0.
+    inputs: P x C
+    Returns: B x C x 2
+    '''
+    if weight is not None:
+        raise NotImplementedError("IRC weights are not supported for packed batches")
+    if aggregates is None:
+        aggregates = multi_aggregate_packed(inputs, packing, nobj, nobj_avg, [aggregation], parts=('diag', 'all'))[aggregation]
+    return torch.stack([aggregates['all'], aggregates['diag']], dim=2)
+
+def packed_eops_2_to_1(inputs, nobj=None, nobj_avg=49, aggregation='mean', weight=None, aggregates=None, packing=None):
+    '''
+    Packed counterpart of eops_2_to_1.
+    inputs: P x C
+    Returns: Npart x C x 5
+    '''
+    if weight is not None:
+        raise NotImplementedError("IRC weights are not supported for packed batches")
+    if aggregates is None:
+        aggregates = multi_aggregate_packed(inputs, packing, nobj, nobj_avg, [aggregation])[aggregation]
+    op1 = inputs[packing.diag_pairs]
+    op2 = aggregates['rows']
+    op3 = aggregates['cols']
+    op4 = aggregates['diag'][packing.particle_event]
+    op5 = aggregates['all'][packing.particle_event]
+    return torch.stack([op1, op2, op3, op4, op5], dim=2)
+
+def packed_eops_2_to_2(inputs, nobj=None, nobj_avg=49, aggregation='mean', weight=None, skip_order_zero=False, folklore=False, aggregates=None, mult=None, packing=None):
+    """
+    Packed counterpart of eops_2_to_2: the same basis, evaluated on the existing pairs only.
+    inputs: P x C
+    mult: optional B x C x (10 or 11) multipliers of the aggregated operators ops[6:]
+    Returns: P x C x basis
+    """
+    if weight is not None:
+        raise NotImplementedError("IRC weights are not supported for packed batches")
+    if folklore:
+        raise NotImplementedError("The folklore operator is not supported for packed batches")
+    if aggregates is None:
+        aggregates = multi_aggregate_packed(inputs, packing, nobj, nobj_avg, [aggregation])[aggregation]
+    sum_diag_part, sum_rows, sum_cols, sum_all = aggregates['diag'], aggregates['rows'], aggregates['cols'], aggregates['all']
+    rows, cols, event = packing.pair_rows, packing.pair_cols, packing.pair_event
+    diag = packing.is_diag.unsqueeze(-1)
+
+    def scaled(x, k, index=packing.particle_event):
+        # index maps the rows of x (particles by default, slice(None) for per-event sources) to events
+        return x if mult is None else x * mult[index, :, k - 6]
+
+    ops = [None] * 16
+
+    if not skip_order_zero:
+        diag_part = inputs[packing.diag_pairs] # Npart x C
+        ops[1] = inputs
+        ops[2] = inputs[packing.pair_transpose]
+        ops[3] = inputs * diag
+        ops[4] = diag_part[cols]
+        ops[5] = diag_part[rows]
+
+    ops[6]  = scaled(sum_cols, 6)[rows] * diag
+    ops[7]  = scaled(sum_cols, 7)[cols]
+    ops[8]  = scaled(sum_cols, 8)[rows]
+    ops[9]  = scaled(sum_rows, 9)[rows] * diag
+    ops[10] = scaled(sum_rows, 10)[cols]
+    ops[11] = scaled(sum_rows, 11)[rows]
+    ops[12] = scaled(sum_diag_part, 12, slice(None))[event]
+    ops[13] = scaled(sum_diag_part, 13, slice(None))[event] * diag
+
+    ops[14] = scaled(sum_all, 14, slice(None))[event]
+    ops[15] = scaled(sum_all, 15, slice(None))[event] * diag
+
+    if skip_order_zero:
+        ops = torch.stack(ops[6:], dim=2)
+    else:
+        ops = torch.stack(ops[1:], dim=2)
+
+    return ops
+
+def add_spurions_packed(data, spurions, label_scalars=True):
+    """
+    Packed counterpart of the models' add_spurions: prepends the same S spurion four-vectors to every event.
+    'scalars' get S+1 extra one-hot channels labelling the spurions (1..S) and the regular particles (0).
+    With label_scalars=False existing 'scalars' are only zero-padded (the one-hot is used only when there are none).
+
+    spurions: S x 4
+    Returns: a new batch dict with updated 'Pmu', 'scalars' and 'Nobj'
+    """
+    data = dict(data)
+    B, S = len(data['Nobj']), len(spurions)
+    packing = Packing(data['Nobj'] + S)
+
+    local = torch.arange(packing.num_particles, device=packing.nobj.device) - packing.particle_offsets[packing.particle_event]
+    is_spurion = local < S
+
+    Pmu = data['Pmu'].new_empty((packing.num_particles,) + data['Pmu'].shape[1:])
+    Pmu[is_spurion] = spurions.to(Pmu.dtype).repeat(B, 1)
+    Pmu[~is_spurion] = data['Pmu']
+
+    spurion_label_onehot = F.one_hot(torch.where(is_spurion, local + 1, 0), num_classes=1 + S)
+    if 'scalars' in data.keys():
+        scalars = data['scalars'].new_zeros((packing.num_particles,) + data['scalars'].shape[1:])
+        scalars[~is_spurion] = data['scalars']
+        data['scalars'] = torch.cat([scalars, spurion_label_onehot], dim=-1) if label_scalars else scalars
+    else:
+        data['scalars'] = spurion_label_onehot
+
+    data['Pmu'] = Pmu
+    data['Nobj'] = packing.nobj
+    data['particle_offsets'], data['pair_offsets'] = packing.particle_offsets, packing.pair_offsets
+    return data
@@ -3,6 +3,7 @@
 import pdb
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 def check_shape(x, shape):
     assert len(x.shape) == len(shape)
@@ -45,103 +46,173 @@ def eops_1_to_1(inputs, normalize=False):
     op2 = sums.expand(-1, -1, dim)
     return torch.stack([op1, op2], dim=2)
 
-def eops_1_to_2(inputs, nobj=None, nobj_avg=49, aggregation='mean', weight=None):
+def _nobj_view(nobj, ndim):
+    # nobj is either a tensor of particle counts (one per event) or the scalar nobj_avg used by 'sum'
+    if torch.is_tensor(nobj):
+        return nobj.view([-1]+[1,]*(ndim-1))
+    return nobj
+
+def _extrema(x, dim, keepdim, aggregations):
+    # (min, max) of x along dim in one pass when both are needed, None for the one that isn't
+    if 'max' in aggregations and 'min' in aggregations:
+        return torch.aminmax(x, dim=dim, keepdim=keepdim)
+    if 'max' in aggregations:
+        return None, torch.amax(x, dim=dim, keepdim=keepdim)
+    return torch.amin(x, dim=dim, keepdim=keepdim), None
+
+def multi_aggregate_1(inputs, nobj=None, nobj_avg=49, aggregations=('mean',), weight=None):
+    """
+    Aggregates a B x C x N tensor over the particle index for several aggregations at once.
+    Returns: {aggregation: B x C x 1 tensor}
+    """
+    aggregations = set(aggregations)
+    if weight is not None:
+        inputs = inputs * weight.unsqueeze(1)
+
+    if aggregations & {'sum', 'mean', 'var'}:
+        sums = inputs.sum(dim=2, keepdim=True)
+    if aggregations & {'max', 'min'}:
+        mins, maxs = _extrema(inputs, 2, True, aggregations)
+
+    result = {}
+    for aggregation in aggregations:
+        n = _nobj_view(nobj_avg if aggregation == 'sum' else nobj, 3)
+        if aggregation in ['sum', 'mean']:
+            result[aggregation] = sums / n
+        elif aggregation == 'max':
+            result[aggregation] = maxs - n.log()
+        elif aggregation == 'min':
+            result[aggregation] = mins + n.log()
+        elif aggregation == 'var':
+            result[aggregation] = ((inputs - sums / n)**2).sum(dim=2, keepdim=True) / n
+        else:
+            raise ValueError("Unknown aggregation", aggregation)
+    return result
+
+def multi_aggregate_2(inputs, nobj=None, nobj_avg=49, aggregations=('mean',), weight=None, parts=('diag', 'rows', 'cols', 'all'), symmetric=False):
+    """
+    Computes the diagonal, row, column and total aggregates of a B x C x N x N tensor for several aggregations at once,
+    so that mixed configs such as 'sM' or 'smxn' read the input once per reduction rather than once per letter.
+    The raw sum is shared by 'sum', 'mean' and 'var', max and min come out of a single aminmax, the totals are reduced
+    from the row aggregates, and the normalizations (nobj, nobj_avg, log(nobj)) are only applied to the reduced tensors.
+
+    inputs: B x C x N x N
+    aggregations: iterable of 'sum', 'mean', 'max', 'min', 'var'
+    parts: subset of 'diag' (B x C x 1), 'rows' (B x C x N, aggregated over the last index), 'cols' (B x C x N), 'all' (B x C)
+    symmetric: declares that inputs equals its transpose, so the column aggregates are the row aggregates
+    Returns: {aggregation: {part: tensor}}
+    """
+    if symmetric and 'cols' in parts:
+        result = multi_aggregate_2(inputs, nobj, nobj_avg, aggregations, weight, parts=tuple(p for p in parts if p != 'cols') + (() if 'rows' in parts else ('rows',)))
+        for aggregates in result.values():
+            aggregates['cols'] = aggregates['rows'] if 'rows' in parts else aggregates.pop('rows')
+        return result
+    aggregations = set(aggregations)
+    diag_part = torch.diagonal(inputs, dim1=-2, dim2=-1) # B x C x N
+    if weight is not None:
+        weight = weight.unsqueeze(1) # B x 1 x N
+        srcs = {'diag': diag_part * weight, 'rows': inputs * weight.unsqueeze(2), 'cols': inputs * weight.unsqueeze(3)}
+    else:
+        srcs = {'diag': diag_part, 'rows': inputs, 'cols': inputs}
+    dims = {'diag': 2, 'rows': 3, 'cols': 2}
+    keep = {'diag': True, 'rows': False, 'cols': False}
+
+    sums, mins, maxs = {}, {}, {}
+    if aggregations & {'sum', 'mean', 'var'}:
+        for p in ['diag', 'rows', 'cols']:
+            if p in parts or (p == 'rows' and 'all' in parts):
+                sums[p] = srcs[p].sum(dim=dims[p], keepdim=keep[p])
+        if 'all' in parts:
+            sums['all'] = (sums['rows'] if weight is None else sums['rows'] * weight).sum(dim=2) # B x C
+    if aggregations & {'max', 'min'}:
+        for p in ['diag', 'rows', 'cols']:
+            if p in parts or (p == 'rows' and 'all' in parts and weight is None):
+                mins[p], maxs[p] = _extrema(srcs[p], dims[p], keep[p], aggregations)
+        if 'all' in parts:
+            if weight is None:
+                mins['all'] = None if mins['rows'] is None else mins['rows'].amin(dim=2)
+                maxs['all'] = None if maxs['rows'] is None else maxs['rows'].amax(dim=2)
+            else:
+                mins['all'], maxs['all'] = _extrema((srcs['rows'] * weight.unsqueeze(3)).flatten(2), 2, False, aggregations)
+
+    ndims = {'diag': 3, 'rows': 3, 'cols': 3, 'all': 2}
+    result = {}
+    for aggregation in aggregations:
+        result[aggregation] = {}
+        for p in parts:
+            n = _nobj_view(nobj_avg if aggregation == 'sum' else nobj, ndims[p])
+            power = 2 if p == 'all' else 1
+            if aggregation in ['sum', 'mean']:
+                result[aggregation][p] = sums[p] / n**power
+            elif aggregation == 'max':
+                result[aggregation][p] = maxs[p] - n.log()
+            elif aggregation == 'min':
+                result[aggregation][p] = mins[p] + n.log()
+            elif aggregation == 'var':
+                mean = sums[p] / n**power
+                if p == 'all':
+                    src = srcs['rows'] if weight is None else srcs['rows'] * weight.unsqueeze(3)
+                    result[aggregation][p] = ((src - mean.unsqueeze(-1).unsqueeze(-1))**2).sum(dim=(2,3)) / n**power
+                else:
+                    mean = mean if keep[p] else mean.unsqueeze(dims[p])
+                    result[aggregation][p] = ((srcs[p] - mean)**2).sum(dim=dims[p], keepdim=keep[p]) / n
+            else:
+                raise ValueError("Unknown aggregation", aggregation)
+    return result
+
+def eops_1_to_2(inputs, nobj=None, nobj_avg=49, aggregation='mean', weight=None, aggregates=None, mult=None):
     '''
     inputs: B x N x C tensor (event, particle, channel)
+    aggregates: this aggregation's entry of multi_aggregate_1, if it was already computed for the whole config
+    mult: optional B x C x 5 multipliers of the five operators, applied to their sources before broadcasting to N x N
     '''
     inputs = inputs.permute(0, 2, 1)
     B, C, N = inputs.shape
 
-    if aggregation == 'mean':
-        aggregation_fn = masked_mean
-    elif aggregation == 'max':
-        aggregation_fn = masked_amax
-    elif aggregation == 'min':
-        aggregation_fn = masked_amin
-    elif aggregation == 'var':
-        aggregation_fn = masked_var
-    elif aggregation == 'sum':
-        aggregation_fn = masked_sum
-        nobj = nobj_avg
+    if aggregates is None:
+        aggregates = multi_aggregate_1(inputs, nobj, nobj_avg, [aggregation], weight)[aggregation]
+    sum_all = aggregates # B x C x 1
 
-    if weight is not None:
-        sum_all = aggregation_fn(inputs * weight.unsqueeze(1), nobj, dim=2, keepdims=True) # B x C x 1
-    else:
-        sum_all = aggregation_fn(inputs, nobj, dim=2, keepdims=True) # B x C x 1
+    scaled = lambda x, k: x if mult is None else x * mult[:, :, k].unsqueeze(-1)
 
-    op1 = torch.diag_embed(inputs)
-    op2 = inputs.unsqueeze(2).expand(-1, -1, N, -1)
-    op3 = inputs.unsqueeze(3).expand(-1, -1, -1, N)
-    op4 = torch.diag_embed(sum_all.expand(-1, -1, N))
-    op5 = sum_all.unsqueeze(3).expand(-1, -1, N, N)
+    op1 = torch.diag_embed(scaled(inputs, 0))
+    op2 = scaled(inputs, 1).unsqueeze(2).expand(-1, -1, N, -1)
+    op3 = scaled(inputs, 2).unsqueeze(3).expand(-1, -1, -1, N)
+    op4 = torch.diag_embed(scaled(sum_all, 3).expand(-1, -1, N))
+    op5 = scaled(sum_all, 4).unsqueeze(3).expand(-1, -1, N, N)
     return torch.stack([op1, op2, op3, op4, op5], dim=2)
 
-def eops_2_to_0(inputs, nobj=None, nobj_avg=49, aggregation='mean', weight=None):
+def eops_2_to_0(inputs, nobj=None, nobj_avg=49, aggregation='mean', weight=None, aggregates=None):
+    '''
+    aggregates: this aggregation's entry of multi_aggregate_2 (with at least the 'diag' and 'all' parts), if it was already computed for the whole config
+    '''
     inputs = inputs.permute(0, 3, 1, 2)
     B, C, N, N = inputs.shape
 
-    diag_part = torch.diagonal(inputs, dim1=-2, dim2=-1)
-    if aggregation == 'mean':
-        aggregation_fn = masked_mean
-    elif aggregation == 'max':
-        aggregation_fn = masked_amax
-    elif aggregation == 'min':
-        aggregation_fn = masked_amin
-    elif aggregation == 'var':
-        aggregation_fn = masked_var
-    elif aggregation == 'sum':
-        aggregation_fn = masked_sum
-        nobj = nobj_avg
-
-    if weight is not None:
-        sum_diag_part = aggregation_fn(diag_part * weight.unsqueeze(1), nobj, dim=2) # B x C x 1
-        weight_rows = weight.unsqueeze(1).unsqueeze(2)
-        weight_cols = weight.unsqueeze(1).unsqueeze(3)
-        sum_all = aggregation_fn(inputs * weight_rows * weight_cols, nobj, dim=(2,3)) # B x C
-    else:
-        sum_diag_part = aggregation_fn(diag_part, nobj, dim=2)
-        sum_all = aggregation_fn(inputs, nobj, dim=(2,3)) # B x C
+    if aggregates is None:
+        aggregates = multi_aggregate_2(inputs, nobj, nobj_avg, [aggregation], weight, parts=('diag', 'all'))[aggregation]
 
-    op1 = sum_all
-    op2 = sum_diag_part
+    op1 = aggregates['all'] # B x C
+    op2 = aggregates['diag'].squeeze(2) # B x C
     ops = [op1, op2]
     return torch.stack(ops, dim=2)
 
-def eops_2_to_1(inputs, nobj=None, nobj_avg=49, aggregation='mean', weight=None):
+def eops_2_to_1(inputs, nobj=None, nobj_avg=49, aggregation='mean', weight=None, aggregates=None):
+    '''
+    aggregates: this aggregation's entry of multi_aggregate_2, if it was already computed for the whole config
+    '''
     inputs = inputs.permute(0, 3, 1, 2)
     B, C, N, N = inputs.shape
 
     diag_part = torch.diagonal(inputs, dim1=-2, dim2=-1)
-    if aggregation == 'mean':
-        aggregation_fn = masked_mean
-    elif aggregation == 'max':
-        aggregation_fn = masked_amax
-    elif aggregation == 'min':
-        aggregation_fn = masked_amin
-    elif aggregation == 'var':
-        aggregation_fn = masked_var
-    elif aggregation == 'sum':
-        aggregation_fn = masked_sum
-        nobj = nobj_avg
-
-    if weight is not None:
-        weight_rows = weight.unsqueeze(1).unsqueeze(2)
-        weight_cols = weight.unsqueeze(1).unsqueeze(3)
-        sum_diag_part = aggregation_fn(diag_part * weight.unsqueeze(1), nobj, dim=2, keepdims=True)
-        sum_rows = aggregation_fn(inputs * weight_rows, nobj, dim=3)
-        sum_cols = aggregation_fn(inputs * weight_cols, nobj, dim=2)
-        sum_all = aggregation_fn(inputs * weight_rows * weight_cols, nobj, dim=(2,3)) # B x C
-    else:
-        sum_diag_part = aggregation_fn(diag_part, nobj, dim=2, keepdims=True)
-        sum_rows = aggregation_fn(inputs, nobj, dim=3)
-        sum_cols = aggregation_fn(inputs, nobj, dim=2)
-        sum_all = aggregation_fn(inputs, nobj, dim=(2,3)) # B x C
+    if aggregates is None:
+        aggregates = multi_aggregate_2(inputs, nobj, nobj_avg, [aggregation], weight)[aggregation]
 
     op1 = diag_part 
-    op2 = sum_rows
-    op3 = sum_cols
-    op4 = sum_diag_part.expand(-1, -1, N)
-    op5 = sum_all.unsqueeze(2).expand(-1, -1, N)
+    op2 = aggregates['rows']
+    op3 = aggregates['cols']
+    op4 = aggregates['diag'].expand(-1, -1, N)
+    op5 = aggregates['all'].unsqueeze(2).expand(-1, -1, N)
     ops = [op1, op2, op3, op4, op5]
     return torch.stack(ops, dim=2)
 
@@ -193,41 +264,126 @@ def eops_2_to_1(inputs, nobj=None, nobj_avg=49, aggregation='mean', weight=None)
 #     return torch.stack(ops[1:], dim=2)
 
 
-def eops_2_to_2(inputs, nobj=None, nobj_avg=49, aggregation='mean', weight=None, skip_order_zero=False, folklore=False):
+def _as_pairs(inputs):
+    # B x N x N x C --> B x C x N x N
     if inputs.dim() == 3:
         # [batch, nobj, features] --> [batch, nobj, nobj, features]
         inputs = inputs.unsqueeze(2).expand(-1, -1, inputs.shape[1], -1)
-        print("Expanded inputs to:", inputs.shape)
-
-    inputs = inputs.permute(0, 3, 1, 2)
-    B, C, N, N = inputs.shape
 
-    diag_part = torch.diagonal(inputs, dim1=-2, dim2=-1) # B x C x N
-    if aggregation == 'mean':
-        aggregation_fn = masked_mean
+    return inputs.permute(0, 3, 1, 2)
+
+# Memory budget (in bytes) of the B x C x N x N x K tiles of the folklore operator
+FOLKLORE_MAX_MEMORY = 2**28
+FOLKLORE_NEGATIVE_SLOPE = 0.01
+
+def _folklore_tile(inputs, start, stop):
+    # B x C x N x N x K tile of x_ik + x_kj for k in [start, stop)
+    return inputs[..., start:stop].unsqueeze(3) + inputs[..., start:stop, :].transpose(-1, -2).unsqueeze(2)
+
+class FolkloreReduce(torch.autograd.Function):
+    """
+    reduce_k LeakyReLU(x_ik + x_kj) for a B x C x N x N input, streaming over blocks of block_size values of k,
+    so that only one B x C x N x N x block_size tile is alive at a time. The backward pass recomputes the tiles
+    instead of saving them.
+
+    reduce: 'sum', 'max', 'min', or 'moments' (sum and sum of squares, stacked along a new last dimension)
+    Ties of 'max' and 'min' share the gradient evenly, as in torch.amax/amin.
+    """
+    @staticmethod
+    def forward(ctx, inputs, reduce, block_size):
+        N = inputs.shape[-1]
+        slope = FOLKLORE_NEGATIVE_SLOPE
+        out = count = None
+        for start in range(0, N, block_size):
+            act = F.leaky_relu(_folklore_tile(inputs, start, min(start + block_size, N)), slope)
+            if reduce == 'sum':
+                out = act.sum(-1) if out is None else out + act.sum(-1)
+            elif reduce == 'moments':
+                moments = torch.stack([act.sum(-1), (act**2).sum(-1)], dim=-1)
+                out = moments if out is None else out + moments
+            else:
+                extremum = act.amax(-1) if reduce == 'max' else act.amin(-1)
+                ties = (act == extremum.unsqueeze(-1)).sum(-1)
+                if out is None:
+                    out, count = extremum, ties
+                else:
+                    better = extremum > out if reduce == 'max' else extremum < out
+                    count = torch.where(better, ties, count + torch.where(extremum == out, ties, 0))
+                    out = torch.where(better, extremum, out)
+        ctx.reduce, ctx.block_size = reduce, block_size
+        ctx.save_for_backward(inputs, out, count)
+        return out
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        inputs, out, count = ctx.saved_tensors
+        reduce, block_size = ctx.reduce, ctx.block_size
+        N = inputs.shape[-1]
+        slope = FOLKLORE_NEGATIVE_SLOPE
+        grad_inputs = torch.zeros_like(inputs)
+        if reduce in ['max', 'min']:
+            grad_output = grad_output / count
+        for start in range(0, N, block_size):
+            stop = min(start + block_size, N)
+            tile = _folklore_tile(inputs, start, stop)
+            dact = torch.where(tile > 0, tile.new_ones(()), tile.new_tensor(slope))
+            if reduce == 'sum':
+                grad_tile = grad_output.unsqueeze(-1) * dact
+            elif reduce == 'moments':
+                act = F.leaky_relu(tile, slope)
+                grad_tile = (grad_output[..., 0:1] + 2 * grad_output[..., 1:2] * act) * dact
+            else:
+                act = F.leaky_relu(tile, slope)
+                grad_tile = torch.where(act == out.unsqueeze(-1), grad_output.unsqueeze(-1) * dact, 0.)
+            # x_ik enters the (i,j,k) entries for every j, and x_kj for every i
+            grad_inputs[..., start:stop] += grad_tile.sum(3)
+            grad_inputs[..., start:stop, :] += grad_tile.sum(2).transpose(-1, -2)
+        return grad_inputs, None, None
+
+def _folklore_op(inputs, aggregation, nobj, nobj_avg, max_memory=None):
+    """
+    Folklore operator agg_k LeakyReLU(x_ik + x_kj) of a B x C x N x N input, with the same normalizations as masked_sum, masked_mean, masked_amax, etc.
+    The contracted index k is processed in blocks sized so that one B x C x N x N x K tile (and its temporaries)
+    fits in max_memory bytes (FOLKLORE_MAX_MEMORY by default).
+    """
+    B, C, N, _ = inputs.shape
+    max_memory = FOLKLORE_MAX_MEMORY if max_memory is None else max_memory
+    block_size = max(1, min(N, max_memory // (4 * B * C * N * N * inputs.element_size())))
+    n = _nobj_view(nobj_avg if aggregation == 'sum' else nobj, 4)
+    if aggregation in ['sum', 'mean']:
+        return FolkloreReduce.apply(inputs, 'sum', block_size) / n
     elif aggregation == 'max':
-        aggregation_fn = masked_amax
+        return FolkloreReduce.apply(inputs, 'max', block_size) - n.log()
     elif aggregation == 'min':
-        aggregation_fn = masked_amin
+        return FolkloreReduce.apply(inputs, 'min', block_size) + n.log()
     elif aggregation == 'var':
-        aggregation_fn = masked_var
-    elif aggregation == 'sum':
-        aggregation_fn = masked_sum
-        nobj = nobj_avg
+        # sum_k (y_k - mean)^2 / n over all N values of k, from the first two moments
+        moments = FolkloreReduce.apply(inputs, 'moments', block_size)
+        mean = moments[..., 0] / n
+        return (moments[..., 1] - 2 * mean * moments[..., 0] + N * mean**2) / n
+    raise ValueError("Unknown aggregation", aggregation)
+
+def eops_2_to_2(inputs, nobj=None, nobj_avg=49, aggregation='mean', weight=None, skip_order_zero=False, folklore=False, aggregates=None, mult=None):
+    """
+    inputs: B x N x N x C
+    aggregates: this aggregation's entry of multi_aggregate_2, if it was already computed for the whole config
+    mult: optional B x C x (10 or 11) multipliers of the aggregated operators ops[6:], applied to their
+          O(N) and O(1) sources before they are broadcast to N x N
+    Returns: B x C x basis x N x N
+    """
+    inputs = _as_pairs(inputs)
+    B, C, N, N = inputs.shape
 
-    # sum_diag_part = aggregation_fn(diag_part, nobj, dim=2, keepdims=True) # B x C x 1
-    if weight is not None:
-        weight_rows = weight.unsqueeze(1).unsqueeze(2)
-        weight_cols = weight.unsqueeze(1).unsqueeze(3)
-        sum_diag_part = aggregation_fn(diag_part * weight.unsqueeze(1), nobj, dim=2, keepdims=True) # B x C x 1
-        sum_rows = aggregation_fn(inputs * weight_rows, nobj, dim=3) # B x C x N
-        sum_cols = aggregation_fn(inputs * weight_cols, nobj, dim=2) # B x C x N
-        sum_all = aggregation_fn(inputs * weight_rows * weight_cols, nobj, dim=(2,3)) # B x C
-    else:
-        sum_diag_part = aggregation_fn(diag_part, nobj, dim=2, keepdims=True) # B x C x 1
-        sum_rows = aggregation_fn(inputs, nobj, dim=3) # B x C x N
-        sum_cols = aggregation_fn(inputs, nobj, dim=2) # B x C x N
-        sum_all = aggregation_fn(inputs, nobj, dim=(2,3)) # B x C
+    diag_part = torch.diagonal(inputs, dim1=-2, dim2=-1) # B x C x N
+    if aggregates is None:
+        aggregates = multi_aggregate_2(inputs, nobj, nobj_avg, [aggregation], weight)[aggregation]
+    sum_diag_part, sum_rows, sum_cols, sum_all = aggregates['diag'], aggregates['rows'], aggregates['cols'], aggregates['all']
+
+    def scaled(x, k):
+        if mult is None:
+            return x
+        m = mult[:, :, k - 6]
+        return x * m.view(m.shape + (1,) * (x.dim() - 2))
 
     ops = [None] * (17 if folklore else 16)
 
@@ -238,20 +394,20 @@ def eops_2_to_2(inputs, nobj=None, nobj_avg=49, aggregation='mean', weight=None,
         ops[4] = diag_part.unsqueeze(2).expand(-1, -1, N, -1)
         ops[5] = diag_part.unsqueeze(3).expand(-1, -1, -1, N)
 
-    ops[6]  = torch.diag_embed(sum_cols)
-    ops[7]  = sum_cols.unsqueeze(2).expand(-1, -1, N, -1)
-    ops[8]  = sum_cols.unsqueeze(3).expand(-1, -1, -1, N)
-    ops[9]  = torch.diag_embed(sum_rows)
-    ops[10] = sum_rows.unsqueeze(2).expand(-1, -1, N, -1)
-    ops[11] = sum_rows.unsqueeze(3).expand(-1, -1, -1, N)
-    ops[12] = sum_diag_part.unsqueeze(3).expand(-1, -1, N, N)
-    ops[13] = torch.diag_embed(sum_diag_part.expand(-1, -1, N))
+    ops[6]  = torch.diag_embed(scaled(sum_cols, 6))
+    ops[7]  = scaled(sum_cols, 7).unsqueeze(2).expand(-1, -1, N, -1)
+    ops[8]  = scaled(sum_cols, 8).unsqueeze(3).expand(-1, -1, -1, N)
+    ops[9]  = torch.diag_embed(scaled(sum_rows, 9))
+    ops[10] = scaled(sum_rows, 10).unsqueeze(2).expand(-1, -1, N, -1)
+    ops[11] = scaled(sum_rows, 11).unsqueeze(3).expand(-1, -1, -1, N)
+    ops[12] = scaled(sum_diag_part, 12).unsqueeze(3).expand(-1, -1, N, N)
+    ops[13] = torch.diag_embed(scaled(sum_diag_part, 13).expand(-1, -1, N))
 
-    ops[14] = sum_all.unsqueeze(-1).unsqueeze(-1).expand(-1, -1, N, N)
-    ops[15] = torch.diag_embed(sum_all.unsqueeze(-1).expand(-1, -1, N))
+    ops[14] = scaled(sum_all, 14).unsqueeze(-1).unsqueeze(-1).expand(-1, -1, N, N)
+    ops[15] = torch.diag_embed(scaled(sum_all, 15).unsqueeze(-1).expand(-1, -1, N))
 
     if folklore:
-        ops[16] = aggregation_fn(torch.nn.LeakyReLU()(inputs.unsqueeze(-2) + inputs.unsqueeze(-3).permute(0,1,2,4,3)), nobj, dim=-1)
+        ops[16] = scaled(_folklore_op(inputs, aggregation, nobj, nobj_avg), 16)
 
     if skip_order_zero:
         ops = torch.stack(ops[6:], dim=2)
@@ -260,6 +416,92 @@ def eops_2_to_2(inputs, nobj=None, nobj_avg=49, aggregation='mean', weight=None,
 
     return ops
 
+def eops_2_to_2_fused(inputs, coefs, nobj=None, nobj_avg=49, aggregation='mean', weight=None, skip_order_zero=False, folklore=False, aggregates=None):
+    """
+    Computes einsum('dsb,ndbij->nijs', coefs, eops_2_to_2(inputs, ...)) without materializing the basis stack.
+
+    Every basis operator except the identity, the transpose and the folklore operator is a broadcast
+    or a diag_embed of an O(N) source (the diagonal, row and column aggregates) or an O(1) source
+    (diagonal and total aggregates), so the coefficients are contracted with those sources first
+    and only the final B x N x N x C_out output is ever allocated.
+
+    inputs: B x N x N x C_in
+    coefs: C_in x C_out x basis, or B x C_in x C_out x basis if the coefficients differ between events
+           (e.g. after absorbing the nobj**alpha multipliers)
+    aggregates: this aggregation's entry of multi_aggregate_2, if it was already computed for the whole config
+    Returns: B x N x N x C_out
+    """
+    inputs = _as_pairs(inputs)
+    B, C, N, N = inputs.shape
+
+    diag_part = torch.diagonal(inputs, dim1=-2, dim2=-1) # B x C x N
+    if aggregates is None:
+        aggregates = multi_aggregate_2(inputs, nobj, nobj_avg, [aggregation], weight)[aggregation]
+    sum_diag_part, sum_rows, sum_cols, sum_all = aggregates['diag'], aggregates['rows'], aggregates['cols'], aggregates['all']
+
+    if coefs.dim() == 3:
+        coefs = coefs.unsqueeze(0)
+
+    # position of ops[k] (as numbered in eops_2_to_2) along the basis dimension of coefs
+    idx = (lambda k: k - 6) if skip_order_zero else (lambda k: k - 1)
+
+    # O(N) sources. Source v with diag_embed at ops[k] is broadcast along rows at ops[k+1] and along columns at ops[k+2]
+    vecs, ks = [sum_cols, sum_rows], [6, 9]
+    if not skip_order_zero:
+        vecs, ks = [diag_part] + vecs, [3] + ks
+    vecs = torch.stack(vecs, dim=2) # B x C x K x N
+    diag_out = torch.einsum('ndki,ndsk->nis', vecs, coefs[..., [idx(k) for k in ks]])
+    cols_out = torch.einsum('ndki,ndsk->nis', vecs, coefs[..., [idx(k + 1) for k in ks]])
+    rows_out = torch.einsum('ndki,ndsk->nis', vecs, coefs[..., [idx(k + 2) for k in ks]])
+
+    # O(1) sources: (diag_embed, full broadcast) are (ops[13], ops[12]) for the diagonal aggregate and (ops[15], ops[14]) for the total
+    scalars = torch.stack([sum_diag_part.squeeze(-1), sum_all], dim=2) # B x C x 2
+    diag_out = diag_out + torch.einsum('ndk,ndsk->ns', scalars, coefs[..., [idx(13), idx(15)]]).unsqueeze(1)
+    const_out = torch.einsum('ndk,ndsk->ns', scalars, coefs[..., [idx(12), idx(14)]])
+
+    output = rows_out.unsqueeze(2) + cols_out.unsqueeze(1) + const_out.unsqueeze(1).unsqueeze(1) # B x N x N x C_out
+
+    if not skip_order_zero:
+        output = output + torch.einsum('ndij,nds->nijs', inputs, coefs[..., idx(1)]) + torch.einsum('ndji,nds->nijs', inputs, coefs[..., idx(2)])
+    if folklore:
+        output = output + torch.einsum('ndij,nds->nijs', _folklore_op(inputs, aggregation, nobj, nobj_avg), coefs[..., idx(16)])
+
+    output = output + torch.diag_embed(diag_out.transpose(1, 2)).permute(0, 2, 3, 1)
+
+    return output
+
+def eops_2_to_2_depthwise(inputs, weights, aggregates=None, skip_order_zero=False):
+    """
+    Per-channel combination sum_b weights[c, b] * eops_2_to_2(inputs)[:, c, b] of the basis operators, built from their
+    sources as in eops_2_to_2_fused, i.e. the contraction with a diagonal C x C coefficient tensor, in O(C N^2).
+
+    inputs: B x C x N x N
+    weights: C x basis or B x C x basis, with the columns ordered as in eops_2_to_2 (the five order-zero operators
+             unless skip_order_zero, followed by the ten aggregated operators if aggregates is given)
+    aggregates: this aggregation's entry of multi_aggregate_2 for inputs, or None for the order-zero operators only
+    Returns: B x C x N x N
+    """
+    if weights.dim() == 2:
+        weights = weights.unsqueeze(0)
+    offset = 6 if skip_order_zero else 1
+    w = lambda k: weights[:, :, k - offset].unsqueeze(-1) # B x C x 1
+
+    output, diag_out, rows_out, cols_out = 0, 0, 0, 0
+    if not skip_order_zero:
+        diag_part = torch.diagonal(inputs, dim1=-2, dim2=-1) # B x C x N
+        output = w(1).unsqueeze(-1) * inputs + w(2).unsqueeze(-1) * inputs.transpose(-1, -2)
+        diag_out = w(3) * diag_part
+        cols_out = w(4) * diag_part
+        rows_out = w(5) * diag_part
+    if aggregates is not None:
+        sum_diag_part, sum_rows, sum_cols, sum_all = aggregates['diag'], aggregates['rows'], aggregates['cols'], aggregates['all'].unsqueeze(-1)
+        diag_out = diag_out + w(6) * sum_cols + w(9) * sum_rows + w(13) * sum_diag_part + w(15) * sum_all
+        # ops[k] with the source indexed by the column j (broadcast along rows), or by the row i, and the constants
+        cols_out = cols_out + w(7) * sum_cols + w(10) * sum_rows + w(12) * sum_diag_part + w(14) * sum_all
+        rows_out = rows_out + w(8) * sum_cols + w(11) * sum_rows
+
+    return output + rows_out.unsqueeze(3) + cols_out.unsqueeze(2) + torch.diag_embed(diag_out)
+
 # def eset_ops_1_to_3(inputs):
 #     N, D, m = inputs.shape
 #     dim = inputs.shape[-1]
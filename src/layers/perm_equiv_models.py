@@ -1,9 +1,11 @@
 import numpy as np
+from functools import partial
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from .perm_equiv_layers import eops_1_to_2, eops_2_to_2, eops_2_to_1, eops_2_to_0 #, eset_ops_3_to_3, eset_ops_4_to_4, eset_ops_1_to_3, eops_1_to_2
-from .generic_layers import get_activation_fn, MessageNet
+from .perm_equiv_layers import eops_1_to_2, eops_2_to_2, eops_2_to_2_fused, eops_2_to_2_depthwise, eops_2_to_1, eops_2_to_0, multi_aggregate_1, multi_aggregate_2, _as_pairs #, eset_ops_3_to_3, eset_ops_4_to_4, eset_ops_1_to_3, eops_1_to_2
+from .packed_layers import packed_eops_1_to_2, packed_eops_2_to_2, packed_eops_2_to_1, packed_eops_2_to_0, multi_aggregate_packed, multi_aggregate_packed_1
+from .generic_layers import get_activation_fn, MessageNet, checkpoint_module
 from .masked_batchnorm import MaskedBatchNorm3d
 
 # class Eq1to1(nn.Module):
@@ -62,19 +64,28 @@ class Eq2to0(nn.Module):
         self.bias = nn.Parameter(torch.zeros(1, out_dim, device=device, dtype=dtype))
         self.to(device=device, dtype=dtype)
 
-    def forward(self, inputs, mask=None, nobj=None, irc_weight=None):
+    def forward(self, inputs, mask=None, nobj=None, irc_weight=None, packing=None):
         '''
-        inputs: N x D x m x m
-        Returns: N x D x m
+        inputs: N x D x m x m, or P x D for a packed batch (see packed_layers.Packing)
+        Returns: N x D
         '''
         d = {'s': 'sum', 'm': 'mean', 'x': 'max', 'n': 'min'}
+        aggregations = [d[char.lower()] for char in self.config if char.lower() in d]
+
+        # All the aggregations of the config are computed in one sweep over the input
+        if packing is None:
+            aggregates = multi_aggregate_2(inputs.permute(0, 3, 1, 2), nobj, self.average_nobj, aggregations, irc_weight, parts=('diag', 'all'))
+            ops_func = self.ops_func
+        else:
+            aggregates = multi_aggregate_packed(inputs, packing, nobj, self.average_nobj, aggregations, parts=('diag', 'all'))
+            ops_func = partial(packed_eops_2_to_0, packing=packing)
 
         ops = []
         for i, char in enumerate(self.config):
             if char in ['s', 'm', 'x', 'n']:
-                op = self.ops_func(inputs, nobj=nobj, nobj_avg=self.average_nobj, aggregation=d[char], weight=irc_weight)
+                op = ops_func(inputs, nobj=nobj, nobj_avg=self.average_nobj, aggregation=d[char], weight=irc_weight, aggregates=aggregates[d[char]])
             elif char in ['S', 'M', 'X', 'N']:
-                op = self.ops_func(inputs, nobj=nobj, nobj_avg=self.average_nobj, aggregation=d[char.lower()], weight=irc_weight)
+                op = ops_func(inputs, nobj=nobj, nobj_avg=self.average_nobj, aggregation=d[char.lower()], weight=irc_weight, aggregates=aggregates[d[char.lower()]])
                 mult = (nobj).view([-1,1,1])**self.alphas[i]
                 mult = mult / (self.average_nobj** self.alphas[i])
                 op = op * mult            
@@ -105,7 +116,7 @@ class Eq2to0(nn.Module):
 class Eq1to2(nn.Module):
     def __init__(self, in_dim, out_dim, activate_agg=False, activate_lin=True, activation = 'leakyrelu', config='s', factorize=False, average_nobj=49, device=torch.device('cpu'), dtype=torch.float):
         super(Eq1to2, self).__init__()
-        self.basis_dim = 5
+        self.basis_dim = 5 * len(config)
         self.out_dim = out_dim
         self.in_dim = in_dim
         self.activate_agg = activate_agg
@@ -135,22 +146,31 @@ class Eq1to2(nn.Module):
         self.bias = nn.Parameter(torch.zeros(out_dim, device=device, dtype=dtype))
         self.to(device=device, dtype=dtype)
 
-    def forward(self, inputs, mask=None, nobj=None, softmask_ir=None, irc_weight=None):
+    def forward(self, inputs, mask=None, nobj=None, softmask_ir=None, irc_weight=None, packing=None):
         '''
-        inputs: B x N x N x C
-        Returns: B x N x C
+        inputs: B x N x C, or Npart x C for a packed batch (see packed_layers.Packing)
+        Returns: B x N x N x C, or P x C for a packed batch
         '''
         d = {'s': 'sum', 'm': 'mean', 'x': 'max', 'n': 'min'}
+        aggregations = [d[char.lower()] for char in self.config if char.lower() in d]
+
+        # All the aggregations of the config are computed in one sweep over the input
+        if packing is None:
+            aggregates = multi_aggregate_1(inputs.permute(0, 2, 1), nobj, self.average_nobj, aggregations, irc_weight)
+            ops_func = self.ops_func
+        else:
+            aggregates = multi_aggregate_packed_1(inputs, packing, nobj, self.average_nobj, aggregations)
+            ops_func = partial(packed_eops_1_to_2, packing=packing)
 
         ops = []
         for i, char in enumerate(self.config):
             if char in ['s', 'm', 'x', 'n']:
-                op = self.ops_func(inputs, nobj, self.average_nobj, aggregation=d[char], weight=irc_weight)
+                op = ops_func(inputs, nobj, self.average_nobj, aggregation=d[char], weight=irc_weight, aggregates=aggregates[d[char]])
             elif char in ['S', 'M', 'X', 'N']:
-                op = self.ops_func(inputs, nobj, self.average_nobj, aggregation=d[char.lower()], weight=irc_weight)
-                mult = (nobj).view([-1,1,1,1,1])**self.alphas[i]
-                mult = mult / (self.average_nobj** self.alphas[i])
-                op = op * mult
+                # The nobj**alpha multipliers are applied to the B x C x N sources rather than to the N x N operators
+                mult = (nobj).view([-1,1,1])**self.alphas[i][..., 0, 0]
+                mult = mult / (self.average_nobj** self.alphas[i][..., 0, 0])
+                op = ops_func(inputs, nobj, self.average_nobj, aggregation=d[char.lower()], weight=irc_weight, aggregates=aggregates[d[char.lower()]], mult=mult)
             else:
                 raise ValueError("args.config must consist of the following letters: smxnSMXN", self.config)
             if softmask_ir is not None:
@@ -166,9 +186,12 @@ class Eq1to2(nn.Module):
         else:
             coefs = self.coefs
 
-        output = torch.einsum('dsb,ndbij->nijs', coefs, ops)
+        if packing is None:
+            output = torch.einsum('dsb,ndbij->nijs', coefs, ops)
+        else:
+            output = torch.einsum('dsb,pdb->ps', coefs, ops)
 
-        output = output + self.bias.view(1,1,-1)
+        output = output + self.bias
 
         if self.activate_lin:
             output = self.activation_fn(output)
@@ -190,7 +213,7 @@ class Eq1to2(nn.Module):
 class Eq2to1(nn.Module):
     def __init__(self, in_dim, out_dim, activate_agg=False, activate_lin=True, activation = 'leakyrelu', config='s', factorize=False, average_nobj=49, device=torch.device('cpu'), dtype=torch.float):
         super(Eq2to1, self).__init__()
-        self.basis_dim = 5
+        self.basis_dim = 5 * len(config)
         self.out_dim = out_dim
         self.in_dim = in_dim
         self.activate_agg = activate_agg
@@ -220,21 +243,32 @@ class Eq2to1(nn.Module):
         self.bias = nn.Parameter(torch.zeros(out_dim, device=device, dtype=dtype))
         self.to(device=device, dtype=dtype)
 
-    def forward(self, inputs, mask=None, nobj=None, softmask_ir=None, irc_weight=None):
+    def forward(self, inputs, mask=None, nobj=None, softmask_ir=None, irc_weight=None, packing=None):
         '''
-        inputs: B x N x N x C
-        Returns: B x N x C
+        inputs: B x N x N x C, or P x C for a packed batch (see packed_layers.Packing)
+        Returns: B x N x C, or Npart x C for a packed batch
         '''
         d = {'s': 'sum', 'm': 'mean', 'x': 'max', 'n': 'min'}
+        aggregations = [d[char.lower()] for char in self.config if char.lower() in d]
+
+        # All the aggregations of the config are computed in one sweep over the input
+        if packing is None:
+            aggregates = multi_aggregate_2(inputs.permute(0, 3, 1, 2), nobj, self.average_nobj, aggregations, irc_weight)
+            ops_func = self.ops_func
+        else:
+            aggregates = multi_aggregate_packed(inputs, packing, nobj, self.average_nobj, aggregations)
+            ops_func = partial(packed_eops_2_to_1, packing=packing)
 
         ops = []
         for i, char in enumerate(self.config):
             if char in ['s', 'm', 'x', 'n']:
-                op = self.ops_func(inputs, nobj, self.average_nobj, aggregation=d[char], weight=irc_weight)
+                op = ops_func(inputs, nobj, self.average_nobj, aggregation=d[char], weight=irc_weight, aggregates=aggregates[d[char]])
             elif char in ['S', 'M', 'X', 'N']:
-                op = self.ops_func(inputs, nobj, self.average_nobj, aggregation=d[char.lower()], weight=irc_weight)
+                op = ops_func(inputs, nobj, self.average_nobj, aggregation=d[char.lower()], weight=irc_weight, aggregates=aggregates[d[char.lower()]])
                 mult = (nobj).view([-1,1,1,1])**self.alphas[i]
                 mult = mult / (self.average_nobj** self.alphas[i])
+                if packing is not None:
+                    mult = mult[packing.particle_event, ..., 0]
                 op = op * mult
             else:
                 raise ValueError("args.config must consist of the following letters: smxnSMXN", self.config)
@@ -251,9 +285,12 @@ class Eq2to1(nn.Module):
         else:
             coefs = self.coefs
 
-        output = torch.einsum('dsb,ndbi->nis', coefs, ops)
+        if packing is None:
+            output = torch.einsum('dsb,ndbi->nis', coefs, ops)
+        else:
+            output = torch.einsum('dsb,pdb->ps', coefs, ops)
 
-        output = output + self.bias.view(1,1,-1)
+        output = output + self.bias
 
         if self.activate_lin:
             output = self.activation_fn(output)
@@ -271,7 +308,7 @@ class Eq2to1(nn.Module):
 
 
 class Eq2to2(nn.Module):
-    def __init__(self, in_dim, out_dim, ops_func=None, activate_agg=False, activate_lin=True, activation = 'leakyrelu', config='s', factorize=True, folklore=False, average_nobj=49, device=torch.device('cpu'), dtype=torch.float):
+    def __init__(self, in_dim, out_dim, ops_func=None, activate_agg=False, activate_lin=True, activation = 'leakyrelu', config='s', factorize=True, folklore=False, average_nobj=49, fused=False, device=torch.device('cpu'), dtype=torch.float):
         super(Eq2to2, self).__init__()
         self.device = device
         self.dtype = dtype
@@ -281,13 +318,18 @@ class Eq2to2(nn.Module):
         self.config = config
         self.factorize=factorize
         self.folklore = folklore
+        # fused=True contracts the coefficients with the low-rank sources of each basis operator (see eops_2_to_2_fused)
+        # instead of building the B x C x basis x N x N stack. It needs the default ops_func and no activation between
+        # the aggregation and the linear mixing, otherwise the stacked path is used.
+        self.fused = fused
+        # With factorize=True and fused=False, the factors are contracted one at a time (see _two_stage) under the same
+        # conditions, and without the folklore operator. fused=True is faster still (see bench_factorized.py).
 
         self.average_nobj = average_nobj
         self.basis_dim = (16 if folklore else 15) + (11 if folklore else 10) * (len(config) - 1)
         # self.basis_dim = 6
 
         self.alphas = nn.ParameterList([None] * len(config))
-        self.dummy_alphas = torch.zeros(1, in_dim, 5, 1, 1, device=device, dtype=dtype)
         # countM = 0
         for i, char in enumerate(config):
             if char in ['M', 'X', 'N']:
@@ -314,48 +356,134 @@ class Eq2to2(nn.Module):
 
         self.to(device=device, dtype=dtype)
 
-    def forward(self, inputs, mask=None, nobj=None, softmask_ir=None, irc_weight=None):
-
+    def _nobj_mult(self, i, nobj, order_zero=False):
+        # Multipliers (nobj/average_nobj)**alpha of the aggregated operators of the i-th letter of config: B x C x (10 or 11).
+        # With order_zero=True the five order-zero operators of the first letter are included with a multiplier of 1.
+        alphas = self.alphas[i][..., 0, 0]
+        mult = (nobj).view([-1,1,1])**alphas
+        mult = mult / (self.average_nobj**alphas)
+        if order_zero and i==0:
+            mult = torch.cat([torch.ones_like(mult[:, :, :5]), mult], dim=2)
+        return mult
+
+    def _two_stage(self, inputs, nobj, irc_weight, aggregates, symmetric):
+        # Factorized contraction without the C_in x C_out x basis coefficients: in the first term
+        # coefs00[d, b] * coefs10[d, s], the basis operators of every input channel are combined before the channels
+        # are mixed. In the second term coefs01[s, b] * coefs11[d, s], the channels are mixed first and the basis operators
+        # of every output channel are combined afterwards, which is exact for the operators that are linear in the input
+        # (the order-zero ones and the sum/mean aggregates of lowercase letters). The other operators of the second term
+        # (max/min aggregates, nobj**alpha multipliers) are contracted with their sources as in eops_2_to_2_fused.
         d = {'s': 'sum', 'm': 'mean', 'x': 'max', 'n': 'min'}
+        x = _as_pairs(inputs) # B x C_in x N x N
+        y = torch.einsum('ndij,ds->nsij', x, self.coefs11) # B x C_out x N x N
+        linear = [d[char] for char in self.config if char in ['s', 'm']]
+        aggregates_y = multi_aggregate_2(y, nobj, self.average_nobj, linear, irc_weight, symmetric=symmetric) if linear else {}
 
-        ops=[]
+        z1, z2, rest = 0, 0, 0
+        offset = 0
         for i, char in enumerate(self.config):
-            if char.lower() in ['s', 'm', 'x', 'n']:
-                op = self.ops_func(inputs, nobj, self.average_nobj, aggregation=d[char.lower()], weight=irc_weight, skip_order_zero=False if i==0 else True, folklore = self.folklore)
-                if char in ['S', 'M', 'X', 'N']:
-                    if i==0:
-                        alphas = torch.cat([self.dummy_alphas, self.alphas[0]], dim=2)
-                    else:
-                        alphas = self.alphas[i]
-                    mult = (nobj).view([-1,1,1,1,1])**alphas
-                    mult = mult / (self.average_nobj**alphas)
-                    op = op * mult
-            else:
+            if char.lower() not in ['s', 'm', 'x', 'n']:
                 raise ValueError("args.config must consist of the following letters: smxnSMXN", self.config)
-            if softmask_ir is not None:
-                s = op.shape
-                softmask_ir = torch.cat([
-                                        torch.ones([s[0],1,3,s[-2],s[-1]], device=op.device), 
-                                        softmask_ir.expand([s[0],1,12,s[-2],s[-1]])
-                                        ], 2)
-                op = op*softmask_ir
-            ops.append(op)
-
-        ops = torch.cat(ops, dim=2)
-
-        if self.activate_agg:
-            ops = self.activation_fn(ops)
+            aggregation = d[char.lower()]
+            num_ops = 15 if i==0 else 10
+            coefs00 = self.coefs00[:, offset:offset + num_ops]
+            coefs01 = self.coefs01[:, offset:offset + num_ops]
+            offset += num_ops
+            if char in ['S', 'M', 'X', 'N']:
+                coefs00 = coefs00 * self._nobj_mult(i, nobj, order_zero=True)
+            z1 = z1 + eops_2_to_2_depthwise(x, coefs00, aggregates[aggregation], skip_order_zero=i>0)
+            if char in ['s', 'm']:
+                z2 = z2 + eops_2_to_2_depthwise(y, coefs01, aggregates_y[aggregation], skip_order_zero=i>0)
+                continue
+            if i==0:
+                z2 = z2 + eops_2_to_2_depthwise(y, coefs01[:, :5])
+                coefs01 = coefs01[:, 5:]
+            coefs = self.coefs11.unsqueeze(-1) * coefs01.unsqueeze(0) # C_in x C_out x 10
+            if char in ['S', 'M', 'X', 'N']:
+                coefs = coefs.unsqueeze(0) * self._nobj_mult(i, nobj).unsqueeze(2)
+            rest = rest + eops_2_to_2_fused(inputs, coefs, nobj, self.average_nobj, aggregation=aggregation, weight=irc_weight, skip_order_zero=True, aggregates=aggregates[aggregation])
+
+        return torch.einsum('ndij,ds->nijs', z1, self.coefs10) + z2.permute(0, 2, 3, 1) + rest
+
+    def forward(self, inputs, mask=None, nobj=None, softmask_ir=None, irc_weight=None, packing=None, symmetric=False):
+        '''
+        inputs: B x N x N x C, or P x C for a packed batch (see packed_layers.Packing)
+        symmetric: declares that inputs is symmetric under i<->j, so that only the row aggregates are computed
+        Returns: B x N x N x C, or P x C for a packed batch
+        '''
+        d = {'s': 'sum', 'm': 'mean', 'x': 'max', 'n': 'min'}
+        aggregations = [d[char.lower()] for char in self.config if char.lower() in d]
 
         if self.factorize:
             coefs = self.coefs00.unsqueeze(1) * self.coefs10.unsqueeze(-1) + self.coefs01.unsqueeze(0) * self.coefs11.unsqueeze(-1)
         else:
             coefs = self.coefs
-        
-        output = torch.einsum('dsb,ndbij->nijs', coefs, ops)
 
-        diag_eye = torch.eye(inputs.shape[1], device=self.device, dtype=self.dtype).unsqueeze(0).unsqueeze(-1)
-        diag_bias = diag_eye.multiply(self.diag_bias.view(1,1,1,-1))
-        output = output + self.bias.view(1,1,1,-1) + diag_bias
+        # With the default ops_func, all the aggregations of the config are computed in one sweep over the input
+        # and the nobj**alpha multipliers are applied to the aggregates instead of the N x N operators
+        sweep = self.ops_func is eops_2_to_2
+        ops_func = self.ops_func
+        if packing is not None:
+            if not sweep:
+                raise NotImplementedError("Packed batches only support the default ops_func")
+            aggregates = multi_aggregate_packed(inputs, packing, nobj, self.average_nobj, aggregations, symmetric=symmetric)
+            ops_func = partial(packed_eops_2_to_2, packing=packing)
+        elif sweep:
+            aggregates = multi_aggregate_2(_as_pairs(inputs), nobj, self.average_nobj, aggregations, irc_weight, symmetric=symmetric)
+
+        stackless = sweep and packing is None and softmask_ir is None and not self.activate_agg
+        if self.fused and stackless:
+            output = 0
+            offset = 0
+            for i, char in enumerate(self.config):
+                if char.lower() not in ['s', 'm', 'x', 'n']:
+                    raise ValueError("args.config must consist of the following letters: smxnSMXN", self.config)
+                num_ops = (16 if self.folklore else 15) if i==0 else (11 if self.folklore else 10)
+                char_coefs = coefs[..., offset:offset + num_ops]
+                offset += num_ops
+                if char in ['S', 'M', 'X', 'N']:
+                    # Absorb the per-event nobj**alpha multipliers into per-event coefficients (B x C_in x C_out x basis)
+                    char_coefs = char_coefs.unsqueeze(0) * self._nobj_mult(i, nobj, order_zero=True).unsqueeze(2)
+                output = output + eops_2_to_2_fused(inputs, char_coefs, nobj, self.average_nobj, aggregation=d[char.lower()], weight=irc_weight, skip_order_zero=False if i==0 else True, folklore=self.folklore, aggregates=aggregates[d[char.lower()]])
+        elif self.factorize and not self.folklore and stackless:
+            output = self._two_stage(inputs, nobj, irc_weight, aggregates, symmetric)
+        else:
+            ops=[]
+            for i, char in enumerate(self.config):
+                if char.lower() in ['s', 'm', 'x', 'n'] and sweep:
+                    mult = self._nobj_mult(i, nobj) if char in ['S', 'M', 'X', 'N'] else None
+                    op = ops_func(inputs, nobj, self.average_nobj, aggregation=d[char.lower()], weight=irc_weight, skip_order_zero=False if i==0 else True, folklore = self.folklore, aggregates=aggregates[d[char.lower()]], mult=mult)
+                elif char.lower() in ['s', 'm', 'x', 'n']:
+                    op = self.ops_func(inputs, nobj, self.average_nobj, aggregation=d[char.lower()], weight=irc_weight, skip_order_zero=False if i==0 else True, folklore = self.folklore)
+                    if char in ['S', 'M', 'X', 'N']:
+                        op = op * self._nobj_mult(i, nobj, order_zero=True).unsqueeze(-1).unsqueeze(-1)
+                else:
+                    raise ValueError("args.config must consist of the following letters: smxnSMXN", self.config)
+                if softmask_ir is not None:
+                    s = op.shape
+                    softmask_ir = torch.cat([
+                                            torch.ones([s[0],1,3,s[-2],s[-1]], device=op.device), 
+                                            softmask_ir.expand([s[0],1,12,s[-2],s[-1]])
+                                            ], 2)
+                    op = op*softmask_ir
+                ops.append(op)
+
+            ops = torch.cat(ops, dim=2)
+
+            if self.activate_agg:
+                ops = self.activation_fn(ops)
+
+            if packing is None:
+                output = torch.einsum('dsb,ndbij->nijs', coefs, ops)
+            else:
+                output = torch.einsum('dsb,pdb->ps', coefs, ops)
+
+        if packing is None:
+            diag_eye = torch.eye(inputs.shape[1], device=self.device, dtype=self.dtype).unsqueeze(0).unsqueeze(-1)
+            diag_bias = diag_eye.multiply(self.diag_bias.view(1,1,1,-1))
+            output = output + self.bias.view(1,1,1,-1) + diag_bias
+        else:
+            output = output + self.bias + packing.is_diag.unsqueeze(-1) * self.diag_bias
 
         if self.activate_lin:
             output = self.activation_fn(output)
@@ -390,7 +518,8 @@ class Eq2to2(nn.Module):
 class Net2to2(nn.Module):
     def __init__(self, num_channels, num_channels_m, ops_func=None, activate_agg=False, activate_lin=True,
                  activation='leakyrelu', dropout=True, drop_rate=0.25, batchnorm=None,
-                 config='s', average_nobj=49, factorize=False, masked=True, device=torch.device('cpu'), dtype=torch.float):
+                 config='s', average_nobj=49, factorize=False, masked=True, fused=False, activation_checkpoint=None, checkpoint_memory=2**30,
+                 device=torch.device('cpu'), dtype=torch.float):
         super(Net2to2, self).__init__()
         
         self.masked = masked
@@ -402,8 +531,6 @@ class Net2to2(nn.Module):
         num_layers = len(num_channels) - 1
         self.in_dim = num_channels_m[0][0] if len(num_channels_m[0]) > 0 else num_channels[0]
 
-        print("Net2to2 initialized with in_dim =", self.in_dim)
-
         num_layers = len(num_channels) - 1
         if len(num_channels_m) < num_layers:
             raise ValueError(f"num_channels_m is too short: len(num_channels_m)={len(num_channels_m)}, expected at least {num_layers}")
@@ -417,32 +544,80 @@ class Net2to2(nn.Module):
         if dropout:
             self.dropout_layer = nn.Dropout(drop_rate)
 
+        # Activation checkpointing of the (message, dropout, Eq2to2) blocks in training:
+        # None (off), 'all', k (every k-th block, starting from the first one),
+        # or 'auto' (the blocks with the largest estimated activations, until the rest fit in checkpoint_memory bytes)
+        if isinstance(activation_checkpoint, str) and activation_checkpoint.isdigit():
+            activation_checkpoint = int(activation_checkpoint)
+        if activation_checkpoint not in [None, 'none', 'all', 'auto'] and not (isinstance(activation_checkpoint, int) and activation_checkpoint > 0):
+            raise ValueError(f"Unknown activation checkpointing policy {activation_checkpoint}")
+        self.activation_checkpoint = None if activation_checkpoint == 'none' else activation_checkpoint
+        self.checkpoint_memory = checkpoint_memory
+
         self.message_layers = nn.ModuleList(([MessageNet(num_channels_m[i]+[num_channels[i],], activation=activation, batchnorm=batchnorm, masked=masked, device=device, dtype=dtype) for i in range(num_layers)]))        
-        self.eq_layers = nn.ModuleList([Eq2to2(num_channels[i], eq_out_dims[i], ops_func, activate_agg=activate_agg, activate_lin=activate_lin, activation=activation, config=config, average_nobj=average_nobj, factorize=factorize, device=device, dtype=dtype) for i in range(num_layers)])
+        self.eq_layers = nn.ModuleList([Eq2to2(num_channels[i], eq_out_dims[i], ops_func, activate_agg=activate_agg, activate_lin=activate_lin, activation=activation, config=config, average_nobj=average_nobj, factorize=factorize, fused=fused, device=device, dtype=dtype) for i in range(num_layers)])
         self.to(device=device, dtype=dtype)
 
-    def forward(self, x, mask=None, nobj=None, softmask_ir=None, irc_weight=None):
+    def forward(self, x, mask=None, nobj=None, softmask_ir=None, irc_weight=None, packing=None, symmetric=False):
         
         '''
-        x: N x m x m x in_dim
-        Returns: N x m x m x out_dim
+        x: N x m x m x in_dim, or P x in_dim for a packed batch (see packed_layers.Packing)
+        symmetric: declares that x is symmetric under i<->j (message layers preserve this, so it holds up to the first Eq2to2 layer)
+        Returns: N x m x m x out_dim, or P x out_dim
         '''
 
-        print("Net2to2.in_dim:", self.in_dim)
-
         assert (x.shape[-1] == self.in_dim), "Input dimension of Net2to2 doesn't match the dimension of the input tensor"
+        # Elementwise dropout breaks the symmetry before the first aggregation
+        symmetric = symmetric and not (self.dropout and self.training)
 
-        for agg, msg in zip(self.eq_layers, self.message_layers):
-            x = msg(x, mask)
-            if self.dropout:
-                if x.dim() == 4:
-                    # [batch, nobj, nobj, features] style
-                    x = self.dropout_layer(x.permute(0, 3, 1, 2)).permute(0, 2, 3, 1)
-                elif x.dim() == 3:
-                    # [batch, nobj, features] style
-                    x = self.dropout_layer(x.permute(0, 2, 1)).permute(0, 2, 1)
-                else:
-                    raise RuntimeError(f"Unexpected tensor shape for dropout: {x.shape}")
-            x = agg(x, mask, nobj, irc_weight=irc_weight)
-            # if self.dropout: x = self.dropout_layer(x.permute(0,3,1,2)).permute(0,2,3,1)
+        checkpointed = self.checkpointed_layers(x) if self.training and torch.is_grad_enabled() else set()
+        for i in range(len(self.eq_layers)):
+            if i in checkpointed:
+                x = checkpoint_module(self._block, self.message_layers[i], i, x, mask, nobj, irc_weight, packing, symmetric)
+            else:
+                x = self._block(i, x, mask, nobj, irc_weight, packing, symmetric)
+            symmetric = False
         return x
+
+    def _block(self, i, x, mask, nobj, irc_weight, packing, symmetric):
+        x = self.message_layers[i](x, mask, packing=packing)
+        if self.dropout:
+            if packing is not None:
+                # [pairs, features] style
+                x = self.dropout_layer(x)
+            elif x.dim() == 4:
+                # [batch, nobj, nobj, features] style
+                x = self.dropout_layer(x.permute(0, 3, 1, 2)).permute(0, 2, 3, 1)
+            elif x.dim() == 3:
+                # [batch, nobj, features] style
+                x = self.dropout_layer(x.permute(0, 2, 1)).permute(0, 2, 1)
+            else:
+                raise RuntimeError(f"Unexpected tensor shape for dropout: {x.shape}")
+        return self.eq_layers[i](x, mask, nobj, irc_weight=irc_weight, packing=packing, symmetric=symmetric)
+
+    def checkpointed_layers(self, x):
+        """
+        Indices of the blocks to checkpoint for an input x, according to self.activation_checkpoint.
+        """
+        num_layers = len(self.eq_layers)
+        policy = self.activation_checkpoint
+        if policy is None:
+            return set()
+        if policy == 'all':
+            return set(range(num_layers))
+        if isinstance(policy, int):
+            return set(range(0, num_layers, policy))
+        # 'auto': rough estimate of the activations saved by each block, per pair (or per particle) of the input
+        num_entries = x.shape[:-1].numel() * x.element_size()
+        costs = []
+        for msg, agg in zip(self.message_layers, self.eq_layers):
+            msg_width = sum(layer.out_features for layer in msg.linear)
+            agg_width = agg.in_dim * (2 if agg.fused or (agg.factorize and not agg.folklore) else agg.basis_dim) + agg.out_dim
+            costs.append(num_entries * (2 * msg_width + agg_width))
+        total, checkpointed = sum(costs), set()
+        for i in sorted(range(num_layers), key=lambda i: -costs[i]):
+            if total <= self.checkpoint_memory:
+                break
+            checkpointed.add(i)
+            total -= costs[i]
+        return checkpointed
@@ -1,5 +1,5 @@
 from .pelican_classifier import PELICANClassifier
 from .pelican_cov import PELICANRegression
 
-from .lorentz_metric import dot4, normsq4, CATree, SDMultiplicity, dot3, dot2, dot12, dot11
+from .lorentz_metric import dot4, normsq4, CATree, CAHistory, SDMultiplicity, dot3, dot2, dot12, dot11
 from .tests import tests, expand_data, ir_data, c_data, irc_data
\ No newline at end of file
@@ -34,98 +34,189 @@ def dot11(p1, p2):
     prod = p1[...,[0,-1]] * p2[...,[0,-1]]
     return 2 * prod[..., 0] - prod.sum(dim=-1)
 
-def SDMultiplicity(jetsbatch, zcut=0.005, thetacut=0., R0 = 0.8, beta = -1.):
+def SDMultiplicity(history, zcut=0.005, thetacut=0., R0 = 0.8, beta = -1.):
     """
-    Given a C/A tree produced by CATree(), compute the Lorentz-invariant
+    Given a C/A clustering history produced by CATree(), compute the Lorentz-invariant
     analog of the Soft Drop multiplicity nSD from https://arxiv.org/pdf/1704.06266.pdf
     nSD is the depth of the branching tree along its hard core (i.e. choosing the harder subjet at each branching), until we hit the thetacut.
 
-    Input: a list of events, each event potentially containing several jets:
-        jetsbatch=[[jet0,jet1,...],[jet0,jet1,...],...] where each jet is stored 
-        as a binary tree with branching info (z, theta) stored at nodes.
-    
-    Output: torch.Tensor of nSD of only the first jet (jet0) contained in each event.
+    The hard core of the first jet of every event is read off the history once, and the SoftDrop condition is then
+    evaluated for all events at once. zcut, thetacut, R0 and beta can also be sequences/tensors of settings
+    (broadcast against each other), in which case nSD is computed for every setting from the same history.
+
+    Input: a CAHistory of a batch of B events.
+    Output: torch.Tensor of nSD of only the first jet (jet0) contained in each event, of shape B,
+        or settings_shape x B if any of the SoftDrop parameters is not a scalar.
+    """
+    z, thetasq, valid = history.hard_core()   # B x D, the (z, thetasq) sequence along the hard core of jet0
+    settings = torch.broadcast_tensors(*[torch.as_tensor(x, dtype=torch.float64) for x in (zcut, thetacut, R0, beta)])
+    shape = settings[0].shape
+    zcut, thetacut, R0, beta = [x.reshape(-1) for x in settings]
+
+    # The parameters are cast to the dtype of the history the same way python scalars would be,
+    # and the exponent stays a python scalar, so that the result does not depend on how many settings are evaluated
+    dtype, device = thetasq.dtype, thetasq.device
+    cast = lambda x: x.to(dtype).to(device).view(-1, 1, 1)
+    nSD = torch.zeros((len(beta), z.shape[0]), dtype=torch.long, device=device)
+    for b in beta.unique().tolist():
+        idx = torch.nonzero(beta == b).view(-1)
+        # If the branching angle is below the cut, terminate the traversal
+        inside = torch.cumprod((~(thetasq <= cast(thetacut[idx] ** 2)) & valid).long(), dim=-1).bool()
+        # Count the branchings that satisfy the softdrop condition (the others are skipped by recursing on the harder subjet)
+        passed = ~(z <= cast(zcut[idx]) * (thetasq / cast(R0[idx] ** 2)) ** (b / 2))
+        nSD[idx.to(device)] = (inside & passed).sum(-1)
+    return nSD.view(shape + (z.shape[0],))
+
+
+class CAHistory():
     """
+    Clustering history of a batch of B events produced by CATree(), stored as padded arrays.
+
+    Nodes 0..N-1 are the particles, and node N+k is the k-th merge of the event, whose branching info
+    (z, thetasq) is stored at position k. For every merge, children holds the (softer, harder) nodes,
+    and parent holds the merge of every node (-1 for the roots). roots lists the root nodes of the jets of every event
+    (if ycut>=1, there will be only one jet), padded with -1.
+    """
+    def __init__(self, z, thetasq, children, num_merges, roots, num_jets):
+        self.z = z                      # B x (N-1)
+        self.thetasq = thetasq          # B x (N-1)
+        self.children = children        # B x (N-1) x 2
+        self.num_merges = num_merges    # B
+        self.roots = roots              # B x N
+        self.num_jets = num_jets        # B
+        self.num_nodes = z.shape[1] + 1 # N
+        B, M = children.shape[:2]
+        self.parent = torch.full((B, self.num_nodes + M), -1, dtype=torch.long, device=z.device)
+        merges = torch.arange(M, device=z.device).unsqueeze(0) < num_merges.unsqueeze(1)
+        events = torch.arange(B, device=z.device).unsqueeze(1).expand(B, M)
+        for c in range(2):
+            self.parent[events[merges], children[..., c][merges]] = self.num_nodes + torch.arange(M, device=z.device).expand(B, M)[merges]
+
+    def __len__(self):
+        return self.z.shape[0]
+
+    def hard_core(self):
+        """
+        (z, thetasq) of the branchings along the hard core of the first jet of every event (following the harder child from the root),
+        as B x D tensors, along with the mask of the valid entries.
+        """
+        B, N = len(self), self.num_nodes
+        events = torch.arange(B, device=self.z.device)
+        node = self.roots[:, 0]
+        steps = []
+        while True:
+            merge = torch.where(node >= N, node - N, -1)
+            if not (merge >= 0).any():
+                break
+            steps.append(merge)
+            node = torch.where(merge >= 0, self.children[events, merge.clamp(min=0), 1], -1)
+        if len(steps) == 0:
+            empty = self.z.new_zeros((B, 0))
+            return empty, empty, empty.bool()
+        steps = torch.stack(steps, dim=1)
+        valid = steps >= 0
+        steps = steps.clamp(min=0)
+        return self.z.gather(1, steps), self.thetasq.gather(1, steps), valid
+
+    def trees(self):
+        """
+        The nested-tuple form of the history: for every event, a list of binary branching trees for each jet,
+        where each node has the form ((left_node, right_node), (z, theta)) and the leaves are particle indices.
+        """
+        N = self.num_nodes
+        children, num_merges, roots, num_jets = self.children.tolist(), self.num_merges.tolist(), self.roots.tolist(), self.num_jets.tolist()
+        jetsbatch = []
+        for b in range(len(self)):
+            z, thetasq = self.z[b].unbind(), self.thetasq[b].unbind()
+            nodes = list(range(N))
+            for k in range(num_merges[b]):
+                nodes.append(((nodes[children[b][k][0]], nodes[children[b][k][1]]), (z[k], thetasq[k])))
+            jetsbatch.append([nodes[root] for root in roots[b][:num_jets[b]]])
+        return jetsbatch
 
-    def SD_traverse(jet, zcut, thetacut, R0, beta, out):
-        # This function outputs a sequence of (z_n, theta_n) similar to https://arxiv.org/pdf/1704.06266.pdf
-        # That sequence can be used to define all kinds of IRC-safe observables, but we will only use it for nSD
-        if type(jet) is int:
-            return out
-        else:
-            subjet_0, subjet_1, z, thetasq = jet[0][0], jet[0][1], jet[1][0], jet[1][1]
-            if thetasq <= thetacut ** 2:
-                return out                                                    # if the branching angle is below the cut, terminate
-            if z <= zcut * (thetasq / R0 ** 2) ** (beta / 2):
-                return SD_traverse(subjet_1, zcut, thetacut, R0, beta, out)   # if the softdrop condition is not satisfied, recurse on the harder subjet
-            else:
-                out.append((z, thetasq))                                      # otherwise save (z, thetasq), and recurse on the harder subjet
-                return SD_traverse(subjet_1, zcut, thetacut, R0, beta, out)
-
-    # Now we traverse the tree and count the number of branchings that satisfy the soft drop condition
-    B=len(jetsbatch)
-    nSD=[]
-    for b in range(B):
-        jet=jetsbatch[b][0]
-        nSD.append(len(SD_traverse(jet, zcut, thetacut, R0, beta, [])))
-    return torch.tensor(nSD, dtype=torch.long)    
-            
 
 def CATree(dot_products, nobj, ycut=1, eps=1e-12):
     """
-    Primitive and slow implementation of a Lorentz-invariant analog
-    of the C/A algorithm from https://arxiv.org/pdf/hep-ph/9803322.pdf
+    Lorentz-invariant analog of the C/A algorithm from https://arxiv.org/pdf/hep-ph/9803322.pdf
     If the jet frame were to coincide with the lab frame, this would've 
     completely matched the standard C/A for electron-positron collisions.
 
+    All events of the batch are clustered at once on the padded tensors: merged (or removed) particles are masked out
+    instead of being deleted, and only the row and column of the merged pair are updated at each step.
+
     Input: batch of matrices of pairwise dot products of the 4-momenta of jet constituents
-    Output: for every event, a list of binary branching trees for each jet in the event (if ycut>=1, there will be only one jet)
-        Each node has the form ((left_node, right_node), (z, theta)),
-        where z is the SoftDrop observable min(E_i,E_j)/(E_i+E_j) and theta is the branching angle.
+    Output: CAHistory of the batch, with the binary branching trees of every jet in the event (if ycut>=1, there will be only one jet)
+        Each branching stores the SoftDrop observable z=min(E_i,E_j)/(E_i+E_j) and the branching angle theta.
+        CAHistory.trees() gives the nested form ((left_node, right_node), (z, theta)).
     """
-    B = dot_products.shape[0]
-    energies = dot_products.sum(1)
-    jetsbatch=[]
-    for b in range(B):
-        N = nobj[b].item()
-        dots = dot_products[b,:N,:N]
-        treelist = list(range(N))
-        jets =[]
-        energy = energies[b, :N]         # Computes E_i*M, where E_i is the jet-frame energy and M is the jet mass (we avoid dividing by M)
-        Msq = energy.sum()
-
-        # First we construct the branching tree, which will be located in jets[0] 
-        # (if y_cut<1, it can produce several jets with separate trees for each)
-        while N > 1:
-            thetasq = 2 * dots / (eps + (energy.unsqueeze(0) * energy.unsqueeze(1) / Msq).abs())  # Computes the Lorentz-invariant analog of 2*(1-cos(theta_ij))
-            thetasq = thetasq + 100 * torch.eye(N, dtype=thetasq.dtype, device=thetasq.device) # Add a number greater than 4 to the diagonal to avoid it being chosen as the minimum
-            (i, j) = unravel_index(torch.argmin(thetasq), thetasq.shape).tolist()  # Find the pair with the smallest angle
-            if energy[i] > energy[j]:       # Order the pair so that i has the lower energy
-                (i, j) = (j, i)
-            y = (energy[i] ** 2) * thetasq[i,j]  # Compute the main test variable
-            y_cut = ycut * Msq ** 2
-            if y <= y_cut:
-                z = min(energy[i], energy[j]) / (energy[i] + energy[j])
-                treelist[j] = ((treelist[i], treelist[j]),(z, thetasq[i,j])) # Each node in the tree has the form ((left_node, right_node),(z_ij,theta_ij))
-                treelist.pop(i)
-                energy[j] = energy[i] + energy[j]
-                energy = torch.cat((energy[:i],energy[i+1:]))
-                merged_pmu = dots[i] + dots[j]
-                dots[j] = merged_pmu
-                dots[:,j] = merged_pmu
-                dots[j,j] = dots[j,j] + dots[i,j]
-                dots = torch.cat((dots[:i], dots[i+1:]))
-                dots = torch.cat((dots[:,:i], dots[:,i+1:]),1)
-            else:
-                jets.append(treelist[i])
-                energy = torch.cat((energy[:i],energy[i+1:]))
-                dots = torch.cat((dots[:i], dots[i+1:]))
-                dots = torch.cat((dots[:,:i], dots[:,i+1:]),1)
-            N = N - 1
-        jets.append(treelist[0])
-        jetsbatch.append(jets)
-
-    return jetsbatch
+    B, N = dot_products.shape[:2]
+    device = dot_products.device
+    nobj = nobj.view(-1).tolist()
+    dots = dot_products.clone()
+    energy = dots.sum(1)                # Computes E_i*M, where E_i is the jet-frame energy and M is the jet mass (we avoid dividing by M)
+    Msq = torch.stack([energy[b, :nobj[b]].sum() for b in range(B)]).view(B, 1)
+    alive = torch.arange(N, device=device).unsqueeze(0) < torch.tensor(nobj, device=device).unsqueeze(1)
+    inf = torch.tensor(float('inf'), dtype=dots.dtype, device=device)
+    diag = 100 * torch.eye(N, dtype=dots.dtype, device=device)  # A number greater than 4 on the diagonal to avoid it being chosen as the minimum
+
+    # Computes the Lorentz-invariant analog of 2*(1-cos(theta_ij)), with the pairs involving removed particles set to inf
+    thetasq = 2 * dots / (eps + (energy.unsqueeze(1) * energy.unsqueeze(2) / Msq.unsqueeze(-1)).abs()) + diag
+    thetasq = torch.where(alive.unsqueeze(1) & alive.unsqueeze(2), thetasq, inf)
+
+    # The history: node currently held by every particle slot, the branchings, and the jets
+    node = torch.arange(N, device=device).repeat(B, 1)
+    z_hist = dots.new_zeros((B, max(N - 1, 0)))
+    thetasq_hist = dots.new_zeros((B, max(N - 1, 0)))
+    children = torch.full((B, max(N - 1, 0), 2), -1, dtype=torch.long, device=device)
+    num_merges = torch.zeros(B, dtype=torch.long, device=device)
+    roots = torch.full((B, N), -1, dtype=torch.long, device=device)
+    num_jets = torch.zeros(B, dtype=torch.long, device=device)
+
+    # First we construct the branching tree, which will be located in roots[:, 0]
+    # (if y_cut<1, it can produce several jets with separate trees for each)
+    active = torch.nonzero(alive.sum(1) > 1).view(-1)
+    while len(active) > 0:
+        (i, j) = unravel_index(torch.argmin(thetasq[active].flatten(1), dim=1), (N, N)).unbind(-1)  # Find the pair with the smallest angle
+        swap = energy[active, i] > energy[active, j]  # Order the pairs so that i has the lower energy
+        (i, j) = (torch.where(swap, j, i), torch.where(swap, i, j))
+        energy_i, energy_j, thetasq_ij = energy[active, i], energy[active, j], thetasq[active, i, j]
+        y = (energy_i ** 2) * thetasq_ij  # Compute the main test variable
+        merge = y <= ycut * Msq[active, 0] ** 2
+
+        # Record the branchings of the pairs that pass the test, the others become separate jets
+        b, mi, mj, k = active[merge], i[merge], j[merge], num_merges[active[merge]]
+        z_hist[b, k] = torch.minimum(energy_i, energy_j)[merge] / (energy_i + energy_j)[merge]
+        thetasq_hist[b, k] = thetasq_ij[merge]
+        children[b, k] = torch.stack([node[b, mi], node[b, mj]], dim=-1)
+        node[b, mj] = N + k
+        num_merges[b] += 1
+        jb, ji = active[~merge], i[~merge]
+        roots[jb, num_jets[jb]] = node[jb, ji]
+        num_jets[jb] += 1
+
+        # Merge the pairs that pass the test into j
+        merged_pmu = dots[b, mi] + dots[b, mj]
+        dots[b, mj] = merged_pmu
+        dots[b, :, mj] = merged_pmu
+        dots[b, mj, mj] = dots[b, mj, mj] + dots[b, mi, mj]
+        energy[b, mj] = energy[b, mi] + energy[b, mj]
+        # Remove i (merged or not) and recompute the angles of the merged j only
+        alive[active, i] = False
+        row = 2 * dots[b, mj] / (eps + (energy[b, mj].unsqueeze(1) * energy[b] / Msq[b]).abs()) + diag[mj]
+        row = torch.where(alive[b], row, inf)
+        thetasq[b, mj] = row
+        thetasq[b, :, mj] = row
+        thetasq[active, i] = inf
+        thetasq[active, :, i] = inf
+
+        active = active[alive[active].sum(1) > 1]
+
+    # The last remaining particle of every event holds the last jet
+    last = torch.nonzero(alive)
+    roots[last[:, 0], num_jets[last[:, 0]]] = node[last[:, 0], last[:, 1]]
+    num_jets[last[:, 0]] += 1
+
+    return CAHistory(z_hist, thetasq_hist, children, num_merges, roots, num_jets)
 
 
 def unravel_index(
@@ -1,8 +1,12 @@
 import torch
+import torch.distributed as dist
 import numpy as np
 from sklearn.metrics import confusion_matrix, roc_auc_score, roc_curve
 
-def metrics(predict, targets, loss_fn, prefix, logger=None):
+from ..trainer import get_world_size
+
+def metrics(predict, targets, loss_fn, prefix, logger=None, roc_csv=False):
+    # The ROC curve is saved downsampled to prefix+'_ROC.npy', and in full as text to prefix+'_ROC.csv' with roc_csv
     loss = loss_fn(predict, targets.long()).item()
     predict = predict.softmax(dim=1)
     accuracy = Accuracy(predict, targets).item()
@@ -11,7 +15,10 @@ def metrics(predict, targets, loss_fn, prefix, logger=None):
     conf_matrix = confusion_matrix(targets, predict.argmax(dim=1), normalize='true')
     metrics = {'loss': loss, 'accuracy': accuracy, 'AUC': auc_score, 'BgRejectionAt0.3': 1/eB03 if eB03>0 else 0, 'atSignEfficiency03': eS03, 'BgRejectionAt0.5': 1/eB05 if eB05>0 else 0, 'atSignEfficiency05': eS05, 'FP_rate': conf_matrix[0,1], 'FN_rate': conf_matrix[1,0]}
     string = ' L: {:10.4f}, ACC: {:10.4f}, AUC: {:10.4f},    BR: {:10.1f} @ {:>4.4f},    BR: {:10.1f} @ {:>4.4f},   FP: {:10.4f}, FN: {:10.4f}'.format(loss, accuracy, auc_score, 1/eB03 if eB03>0 else 0, eS03,  1/eB05 if eB05>0 else 0, eS05, conf_matrix[0,1], conf_matrix[1,0])
-    np.savetxt(prefix+'_ROC.csv', roc, delimiter=',')
+    if roc is not None:
+        np.save(prefix+'_ROC.npy', downsample_roc(roc))
+        if roc_csv:
+            np.savetxt(prefix+'_ROC.csv', roc, delimiter=',')
     # if logger:
     #     logger.info('ROC saved to file ' + prefix+'_ROC.csv' + '\n')
     return metrics, string
@@ -19,7 +26,7 @@ def metrics(predict, targets, loss_fn, prefix, logger=None):
 def minibatch_metrics(predict, targets, loss):
     predict = predict.softmax(dim=1)
     accuracy = Accuracy(predict, targets).item()
-    auc_score = AUCScore(predict, targets)
+    auc_score = RankAUCScore(predict, targets)
     return [loss, accuracy, auc_score]
 
 def minibatch_metrics_string(metrics):
@@ -44,6 +51,17 @@ def AUCScore(predict, targets):
     else:
         return roc_auc_score(targets, predict[:, -1])          # Area Under Curve score (between 0 and 1). The closer to 1 the better.
 
+def RankAUCScore(predict, targets):
+    # Same as AUCScore (Mann-Whitney statistic, tied scores count 1/2), computed in torch from the ranks of the scores
+    targets = targets.long()
+    num_sig = targets.sum().item()
+    num_bkg = len(targets) - num_sig
+    if num_sig == 0 or num_bkg == 0:
+        return 0
+    _, inverse, counts = torch.unique(predict[:, -1], return_inverse=True, return_counts=True)
+    ranks = (counts.cumsum(0) - (counts - 1) / 2)[inverse] # average rank of every score, starting at 1
+    return ((ranks[targets == 1].sum().item() - num_sig * (num_sig + 1) / 2) / (num_sig * num_bkg))
+
 def ROC(predict, targets):
     if torch.equal(targets, torch.ones_like(targets)) or torch.equal(targets, torch.zeros_like(targets)):
         return None, 0., 0., 0., 0.
@@ -65,4 +83,100 @@ def BR(curve, at_eS):
             eB, eS = curve[0][idx], curve[1][idx]
         else:
             eB, eS = 1., 1.
-    return eB, eS
\ No newline at end of file
+    return eB, eS
+
+def downsample_roc(curve, num_points=2000):
+    """
+    Keeps about num_points points of an ROC curve (eB, eS, thresholds): the first points past a uniform grid of signal
+    efficiencies and past a logarithmic grid of background efficiencies down to 1e-7 (where the rejections are read), and both ends.
+    """
+    curve = np.asarray(curve)
+    idx = np.concatenate([np.searchsorted(curve[1], np.linspace(0, 1, num_points // 2)),
+                          np.searchsorted(curve[0], np.logspace(-7, 0, num_points // 2)), [0, curve.shape[1] - 1]])
+    return curve[:, np.unique(idx.clip(0, curve.shape[1] - 1))]
+
+class StreamingMetrics:
+    """
+    Streaming version of metrics() for binary classification. Every update costs O(batch) on the device of the predictions
+    and does not synchronize with the host; only two score histograms and the confusion counts are kept.
+
+    The score log(p_signal / p_background) is binned into num_bins uniform bins on [-score_range, score_range] (the tails
+    go to the edge bins). The loss, the accuracy and the confusion rates are exact. The ROC curve is sampled at the bin
+    edges, so the AUC differs from the exact one by at most auc_error() (half the fraction of signal-background pairs
+    that share a bin), and the signal efficiencies of the background rejections by at most the signal fraction of a bin.
+    """
+    def __init__(self, loss_fn, num_bins=2**14, score_range=20.):
+        self.loss_fn = loss_fn
+        self.num_bins = num_bins
+        self.score_range = score_range
+        self.hist = None
+        self.roc = None
+
+    def update(self, predict, targets, loss=None):
+        """
+        predict: B x 2 logits
+        targets: B class labels
+        loss: mean loss of the minibatch, recomputed with loss_fn if None
+        """
+        predict, targets = predict.detach(), targets.detach().long()
+        if self.hist is None:
+            self.hist = torch.zeros(2, self.num_bins, dtype=torch.float64, device=predict.device)
+            self.confusion = torch.zeros(2, 2, dtype=torch.float64, device=predict.device)
+            self.loss_sum = torch.zeros((), dtype=torch.float64, device=predict.device)
+        if loss is None:
+            loss = self.loss_fn(predict, targets)
+        score = predict[:, -1] - predict[:, :-1].logsumexp(dim=1)
+        bins = ((score + self.score_range) * (self.num_bins / (2 * self.score_range))).floor().clamp(0, self.num_bins - 1).long()
+        ones = torch.ones(len(targets), dtype=torch.float64, device=predict.device)
+        self.hist.view(-1).index_add_(0, targets * self.num_bins + bins, ones)
+        self.confusion.view(-1).index_add_(0, 2 * targets + predict.argmax(dim=1), ones)
+        self.loss_sum += loss.detach().double() * len(targets)
+
+    def all_reduce(self):
+        # Sums the histograms of all the processes (one collective)
+        if get_world_size() > 1 and self.hist is not None:
+            state = torch.cat([self.hist.view(-1), self.confusion.view(-1), self.loss_sum.view(1)])
+            dist.all_reduce(state)
+            self.hist.copy_(state[:2 * self.num_bins].view(2, -1))
+            self.confusion.copy_(state[2 * self.num_bins:-1].view(2, 2))
+            self.loss_sum.copy_(state[-1])
+
+    def roc_curve(self):
+        # (eB, eS, thresholds on p_signal) at the bin edges, in the order of sklearn's roc_curve
+        bkg, sig = self.hist.cpu().numpy()
+        eB = np.concatenate([[0.], np.cumsum(bkg[::-1])]) / max(bkg.sum(), 1)
+        eS = np.concatenate([[0.], np.cumsum(sig[::-1])]) / max(sig.sum(), 1)
+        edges = np.linspace(-self.score_range, self.score_range, self.num_bins + 1)[-2::-1]
+        thresholds = np.concatenate([[np.inf], 1 / (1 + np.exp(-edges))])
+        return eB, eS, thresholds
+
+    def auc_error(self):
+        bkg, sig = self.hist.cpu().numpy()
+        return (bkg * sig).sum() / (2 * max(bkg.sum() * sig.sum(), 1))
+
+    def compute(self, prefix=None, roc_csv=False):
+        """
+        Returns the metrics and the logstring of metrics(), and saves the sampled ROC curve, downsampled with downsample_roc,
+        to prefix+'_ROC.npy' (a 3 x points array of eB, eS and thresholds), which is also kept in self.roc.
+        With roc_csv, the same array is also written as text to prefix+'_ROC.csv', the file of the exact metrics().
+        """
+        confusion = self.confusion.cpu().numpy()
+        count = confusion.sum()
+        loss = self.loss_sum.item() / count
+        accuracy = np.trace(confusion) / count
+        rates = confusion / np.maximum(confusion.sum(axis=1, keepdims=True), 1)
+        if (confusion.sum(axis=1) == 0).any():
+            roc, auc_score, eB03, eS03, eB05, eS05 = None, 0, 0., 0., 0., 0.
+        else:
+            roc = self.roc_curve()
+            auc_score = (np.diff(roc[0]) * (roc[1][1:] + roc[1][:-1]) / 2).sum()
+            eB03, eS03 = BR(roc, at_eS=0.3)
+            eB05, eS05 = BR(roc, at_eS=0.5)
+        metrics = {'loss': loss, 'accuracy': accuracy, 'AUC': auc_score, 'BgRejectionAt0.3': 1/eB03 if eB03>0 else 0, 'atSignEfficiency03': eS03, 'BgRejectionAt0.5': 1/eB05 if eB05>0 else 0, 'atSignEfficiency05': eS05, 'FP_rate': rates[0,1], 'FN_rate': rates[1,0]}
+        string = ' L: {:10.4f}, ACC: {:10.4f}, AUC: {:10.4f},    BR: {:10.1f} @ {:>4.4f},    BR: {:10.1f} @ {:>4.4f},   FP: {:10.4f}, FN: {:10.4f}'.format(loss, accuracy, auc_score, 1/eB03 if eB03>0 else 0, eS03,  1/eB05 if eB05>0 else 0, eS05, rates[0,1], rates[1,0])
+        if prefix is not None and roc is not None:
+            self.roc = downsample_roc(roc)
+            np.save(prefix+'_ROC.npy', self.roc)
+            if roc_csv:
+                np.savetxt(prefix+'_ROC.csv', self.roc, delimiter=',')
+        return metrics, string
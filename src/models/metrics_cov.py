@@ -1,32 +1,33 @@
 import torch
+import math
 import numpy as np
+import torch.distributed as dist
 from sklearn.metrics import confusion_matrix, roc_auc_score, roc_curve
 from .lorentz_metric import normsq4, dot4
+from ..trainer import get_world_size
+
+# Per-event quantities of kinematics() whose means are reported by metrics(), under their metric names
+MEAN_LOSSES = ['loss_inv', 'loss_m', 'loss_m2', 'loss_3d', 'loss_4d', 'loss_E', 'loss_psi', 'loss_pT', 'loss_R', 'loss_col', 'loss_col3']
 
 def metrics(predict, targets, loss_fn, prefix, logger=None, **kwargs):
     """
     This generates metrics reported at the end of each epoch and during validation/testing, as well as the logstring printed to the logger.
+    The kinematic quantities shared by the metrics are computed once (see kinematics), the quantiles are exact.
     """    
     # if len(targets.shape)==2:
     #     targets = targets.unsqueeze(1)
-    loss = loss_fn(predict,targets).numpy()
-    angle = AngleDeviation(predict, targets).numpy()
-    drsigma = dRSigma(predict, targets).numpy()
-    pTsigma = pTSigma(predict, targets).numpy()
-    massdelta = MassSigma(predict, targets).numpy()
-    loss_inv = loss_fn_inv(predict, targets).numpy()
-    loss_m = loss_fn_m(predict, targets).numpy()
-    loss_m2 = loss_fn_m2(predict, targets).numpy()
-    loss_3d = loss_fn_3d(predict, targets).numpy()
-    loss_4d = loss_fn_4d(predict, targets).numpy()
-    loss_E = loss_fn_E(predict,targets).numpy()
-    loss_psi = loss_fn_psi(predict,targets).numpy()
-    loss_pT = loss_fn_pT(predict,targets).numpy()
-    loss_dR = loss_fn_dR(predict, targets).numpy()
-    loss_col = loss_fn_col(predict,targets).numpy()
-    loss_col3 = loss_fn_col3(predict,targets).numpy()
+    loss = loss_fn(predict,targets)
+    q = kinematics(predict, targets)
+    quantiles = {'angle': torch.quantile(q['angle'], 0.68, dim=0), 'dR': torch.quantile(q['dR'], 0.68, dim=0),
+                 'pT_rel': iqr(q['pT_rel'], dim=0), 'm_rel': iqr(q['m_rel'], dim=0)}
+    return _metrics_string(loss, quantiles, {name: q[name].mean() for name in MEAN_LOSSES}, targets.shape[1])
+
+def _metrics_string(loss, quantiles, means, num_targets):
+    angle, drsigma, pTsigma, massdelta = [quantiles[name].numpy() for name in ['angle', 'dR', 'pT_rel', 'm_rel']]
+    loss = loss.numpy()
+    loss_inv, loss_m, loss_m2, loss_3d, loss_4d, loss_E, loss_psi, loss_pT, loss_dR, loss_col, loss_col3 = [means[name].numpy() for name in MEAN_LOSSES]
     
-    w = 1 + 8 * targets.shape[1]
+    w = 1 + 8 * num_targets
 
     metrics = {'loss': loss, '∆Ψ': angle, '∆R': drsigma, '∆pT': pTsigma, '∆m': massdelta, 'loss_inv': loss_inv, 'loss_m': loss_m, 'loss_m2': loss_m2, 'loss_3d': loss_3d, 'loss_4d': loss_4d, "loss_E": loss_E, "loss_psi": loss_psi, "loss_pT": loss_pT, "loss_R": loss_dR, "loss_col": loss_col, "loss_col3": loss_col3}
     with np.printoptions(precision=4):
@@ -34,6 +35,125 @@ def metrics(predict, targets, loss_fn, prefix, logger=None, **kwargs):
         string = f' L: {loss:10.4f}, ∆Ψ: {f(angle)}, ∆R: {f(drsigma)}, ∆pT: {f(pTsigma)}, ∆m: {f(massdelta)}, loss_inv: {loss_inv:10.4f}, loss_m: {loss_m:10.4f}, loss_m2: {loss_m2:10.4f}, loss_3d: {loss_3d:10.4f}, loss_4d: {loss_4d:10.4f}, loss_E: {loss_E:10.4f}, loss_psi: {loss_psi:10.4f}, loss_pT: {loss_pT:10.4f}, loss_R: {loss_dR:10.4f}, loss_col: {loss_col:10.4f}, loss_col3: {loss_col3:10.4f}'
     return metrics, string
 
+def kinematics(predict, targets):
+    """
+    Per-event quantities behind all the metrics, with the norms, masses and detector coordinates of predict and targets
+    computed only once: the arguments of the quantile metrics ('angle', 'dR', 'pT_rel', 'm_rel') and the
+    per-event values of the losses of MEAN_LOSSES (e.g. 'loss_m' is the per-event term of loss_fn_m).
+    """
+    diff = predict - targets
+    p3, t3 = predict[...,1:4], targets[...,1:4]
+    p3_norm, t3_norm = p3.norm(dim=-1), t3.norm(dim=-1)
+    p_pT, t_pT = predict[...,1:3].norm(dim=-1), targets[...,1:3].norm(dim=-1)
+    p_m2, t_m2 = normsq4(predict), normsq4(targets)
+    p_m, t_m = p_m2.abs().sqrt(), t_m2.abs().sqrt()
+    aux1 = p3_norm.unsqueeze(-1) * t3
+    aux2 = t3_norm.unsqueeze(-1) * p3
+    angle = 2*torch.atan2((aux1 - aux2).norm(dim=-1), (aux1 + aux2).norm(dim=-1))
+    dr = (_eta_phi(predict, p3_norm) - _eta_phi(targets, t3_norm)).norm(dim=-1)
+    signed_mass = lambda m2: m2.sign() * (m2.abs()+1e-8).sqrt()
+    return {'angle': angle, 'dR': dr, 'pT_rel': (p_pT - t_pT) / t_pT, 'm_rel': (p_m - t_m) / t_m,
+            'loss_inv': normsq4(diff).abs(), 'loss_m': (signed_mass(p_m2) - signed_mass(t_m2)).abs(), 'loss_m2': (p_m2 - t_m2).abs(),
+            'loss_3d': diff[...,1:4].norm(dim=-1), 'loss_4d': diff.norm(dim=-1), 'loss_E': diff[...,0].abs(), 'loss_psi': angle,
+            'loss_pT': (p_pT - t_pT).abs(), 'loss_R': dr, 'loss_col': (dot4(predict,targets)**2 - p_m2*t_m2 + 1e-6).abs().pow(0.5),
+            'loss_col3': (p3_norm*t3_norm - (p3*t3).sum(dim=-1)).abs()}
+
+class QuantileSketch:
+    """
+    Mergeable streaming quantiles of each column of B x C batches with relative accuracy alpha, in the manner of DDSketch:
+    a value x is counted in the bucket i = ceil(log_gamma |x|) of its sign, gamma = (1 + alpha) / (1 - alpha), and a
+    quantile is reported as sign * 2 gamma^i / (gamma + 1), which is within a relative error alpha of the order statistic
+    of rank floor(q * (n-1)) or the next one. Magnitudes below min_value count as zero, those above 1/min_value as 1/min_value.
+    The counts live on the device of the batches (about 330 kB per column with the defaults).
+    """
+    def __init__(self, alpha=1e-3, min_value=1e-9):
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self.log_gamma = math.log(self.gamma)
+        self.min_value = min_value
+        self.offset = math.floor(math.log(min_value) / self.log_gamma)
+        self.num_buckets = math.ceil(-math.log(min_value) / self.log_gamma) - self.offset
+        # Counts per column: negative buckets in decreasing order of magnitude, zero, positive buckets
+        self.counts = None
+
+    def update(self, x):
+        x = x.detach().reshape(len(x), -1).double()
+        width = 2 * self.num_buckets + 1
+        if self.counts is None:
+            self.counts = torch.zeros(x.shape[1], width, dtype=torch.float64, device=x.device)
+        magnitude = x.abs()
+        index = ((magnitude.log() / self.log_gamma).ceil() - self.offset).clamp(1, self.num_buckets)
+        index = torch.where((magnitude < self.min_value) | x.isnan(), 0, index)
+        position = (self.num_buckets + x.sign() * index).long() + width * torch.arange(x.shape[1], device=x.device)
+        self.counts.view(-1).index_add_(0, position.view(-1), torch.ones(position.numel(), dtype=torch.float64, device=x.device))
+
+    def quantile(self, q):
+        # One value per column (a C tensor on the CPU)
+        cumulative = self.counts.cpu().cumsum(dim=1)
+        rank = q * (cumulative[:, -1:] - 1)
+        bucket = torch.searchsorted(cumulative, rank, right=True).squeeze(1) - self.num_buckets
+        value = 2 * self.gamma ** (bucket.abs() + self.offset).double() / (self.gamma + 1)
+        return torch.where(bucket == 0, 0., bucket.sign() * value)
+
+
+class RegressionMetrics:
+    """
+    Streaming version of metrics() for the regression of 4-vectors. Every update derives the shared kinematic quantities of a
+    minibatch once (see kinematics) and accumulates them on its device without synchronizing with the host, so that the
+    predictions never need to be kept. The loss and the mean losses are exact (the loss assuming that loss_fn is a mean over
+    events), the resolutions come from QuantileSketch's with relative accuracy alpha instead of torch.quantile.
+    """
+    # Quantile metrics: (kinematics() quantity, quantiles); one quantile is reported as is, two as half their difference
+    QUANTILES = {'angle': (0.68,), 'dR': (0.68,), 'pT_rel': (0.16, 0.84), 'm_rel': (0.16, 0.84)}
+
+    def __init__(self, loss_fn, alpha=1e-3):
+        self.loss_fn = loss_fn
+        self.sketches = {name: QuantileSketch(alpha) for name in self.QUANTILES}
+        self.sums = None
+
+    def update(self, predict, targets, loss=None):
+        """
+        predict, targets: B x T x 4 (or B x 4)
+        loss: mean loss of the minibatch, recomputed with loss_fn if None
+        """
+        predict, targets = predict.detach(), targets.detach()
+        if loss is None:
+            loss = self.loss_fn(predict, targets)
+        q = kinematics(predict.double(), targets.double())
+        if self.sums is None:
+            self.sums = torch.zeros(len(MEAN_LOSSES) + 3, dtype=torch.float64, device=predict.device)
+            self.num_targets, self.scalar = targets.shape[1], q['angle'].dim() == 1
+        # Sums of the mean losses, the weighted sum of the loss, the number of events and the number of targets
+        self.sums += torch.stack([q[name].sum() for name in MEAN_LOSSES] + [loss.detach().double() * len(targets),
+                                 torch.tensor(len(targets), dtype=torch.float64, device=predict.device), torch.tensor(q['angle'].numel(), dtype=torch.float64, device=predict.device)])
+        for name, sketch in self.sketches.items():
+            sketch.update(q[name])
+
+    def all_reduce(self):
+        # Sums the counts of all the processes (one collective)
+        if get_world_size() > 1 and self.sums is not None:
+            state = torch.cat([self.sums] + [sketch.counts.view(-1) for sketch in self.sketches.values()])
+            dist.all_reduce(state)
+            self.sums.copy_(state[:len(self.sums)])
+            start = len(self.sums)
+            for sketch in self.sketches.values():
+                sketch.counts.view(-1).copy_(state[start:start + sketch.counts.numel()])
+                start += sketch.counts.numel()
+
+    def compute(self, prefix=None, roc_csv=False):
+        """
+        Returns the metrics and the logstring of metrics() (the predictions and the prefix are not saved, and there is no ROC curve for roc_csv).
+        """
+        sums = self.sums.cpu()
+        means = {name: sums[i] / sums[-1] for i, name in enumerate(MEAN_LOSSES)}
+        quantiles = {}
+        for name, rng in self.QUANTILES.items():
+            values = [self.sketches[name].quantile(q) for q in rng]
+            quantiles[name] = values[0] if len(values) == 1 else (values[1] - values[0]) * 0.5
+            # B x 4 targets give scalars, like torch.quantile of a B tensor
+            if self.scalar:
+                quantiles[name] = quantiles[name].squeeze(0)
+        return _metrics_string(sums[-3] / sums[-2], quantiles, means, self.num_targets)
+
 def minibatch_metrics(predict, targets, loss):
     """
     This computes metrics for each minibatch (if verbose mode is used). The logstring is defined separately in minibatch_metrics_string.
@@ -61,17 +181,21 @@ def cart2cyl(cart, include_r=False):
     """ 
     4D Cartesian coordinates to 2D detector coordinates conversion.
 	"""
-    cart = cart[...,1:4]
-    r = cart.norm(dim=-1)
-    theta = (cart[..., 2] / r).acos().nan_to_num() # theta=acos(z/r)
-    eta = - (theta / 2).tan().log()                # eta=-log(tan(theta/2))
-    phi = torch.atan2(cart[..., 1], cart[..., 0])  # phi=atan(y/x)
+    r = cart[...,1:4].norm(dim=-1)
+    eta, phi = _eta_phi(cart, r).unbind(-1)
     if include_r:
         sph = torch.stack((eta, phi, r), dim=-1)
     else:
         sph = torch.stack((eta, phi), dim=-1)
     return sph
 
+def _eta_phi(cart, r):
+    # (eta, phi) of 4D Cartesian coordinates whose 3-momentum norm r is already known
+    theta = (cart[..., 3] / r).acos().nan_to_num() # theta=acos(z/r)
+    eta = - (theta / 2).tan().log()                # eta=-log(tan(theta/2))
+    phi = torch.atan2(cart[..., 2], cart[..., 1])  # phi=atan(y/x)
+    return torch.stack((eta, phi), dim=-1)
+
 def AngleDeviation(predict, targets):
     """
     Measures the (always positive) angle between any two 3D vectors and returns the 68% quantile over the batch
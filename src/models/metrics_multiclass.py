@@ -1,15 +1,15 @@
 import torch
 import numpy as np
 from sklearn.metrics import classification_report, confusion_matrix, roc_auc_score, roc_curve
-import itertools
+from .metrics_classifier import downsample_roc
 
-def metrics(predict, targets, loss_fn, prefix, logger=None, backg_class=8):
+def metrics(predict, targets, loss_fn, prefix, logger=None, backg_class=8, roc_csv=False):
     loss = torch.nn.CrossEntropyLoss()(predict, targets).item()
     predict = predict.softmax(dim=1)
     num_classes = predict.shape[-1]
     accuracy = Accuracy(predict, targets).item()
     auc_ovr = AUCScore(predict, targets)
-    auc_macro = AUCScoreMacro(predict, targets)
+    auc_macro = AUCScoreMacro(predict, targets, scores=auc_ovr)
     roc, eB30s, eS30s, eB50s, eS50s, eB995s, eS995s, tpr10s, fpr10s, tpr1s, fpr1s = ROC(predict, targets, backg_class=backg_class)
     targets = targets.argmax(dim=1)
     predict = predict.argmax(dim=1)
@@ -31,7 +31,17 @@ def metrics(predict, targets, loss_fn, prefix, logger=None, backg_class=8):
 
     metrics.update({'conf': conf_matrix, 'report': report})
     string = ' L: {:10.4f}, ACC: {:10.4f}, AUC: {}, AUCs: {},    eS: {} @ {:>4.2f},    eS: {} @ {:>4.2f},    1/eB: {} @ {:>4.2f},    1/eB: {} @ {:>4.2f},    1/eB: {} @ {:>4.3f},\nconf:\n{},\nreport:\n{}'.format(loss, accuracy, auc_macro, auc_ovr, tpr10s, 0.1, tpr1s, 0.01, [1/eB if eB>0 else 0 for eB in eB30s], 0.3,  [1/eB if eB>0 else 0 for eB in eB50s], 0.5, [1/eB if eB>0 else 0 for eB in eB995s], 0.995, conf_matrix, report)
-    np.savetxt(prefix+'_ROC.csv', np.array(list(itertools.zip_longest(*roc,fillvalue=0.))), delimiter=',')
+    # One column per array of the ROC curves (eB, eS and thresholds of each class), padded with zeros to the longest:
+    # downsampled in binary to prefix+'_ROC.npy', and in full as text to prefix+'_ROC.csv' with roc_csv
+    def columns(curves):
+        out = np.zeros((max(len(x) for x in curves), len(curves)))
+        for i, x in enumerate(curves):
+            out[:len(x), i] = x
+        return out
+    sampled = [x for i in range(0, len(roc), 3) for x in (downsample_roc(roc[i:i+3]) if len(roc[i]) else roc[i:i+3])]
+    np.save(prefix+'_ROC.npy', columns(sampled))
+    if roc_csv:
+        np.savetxt(prefix+'_ROC.csv', columns(roc), delimiter=',')
     # if logger:
     #     logger.info('ROC saved to file ' + prefix+'_ROC.csv' + '\n')
     return metrics, string
@@ -54,41 +64,87 @@ def Entropy(predict, targets):
 def Accuracy(predict, targets):
     return (predict.argmax(dim=1) == targets.long().argmax(dim=1)).float().mean()
 
+def _sort_values(x):
+    # Ascending sort of the last dimension. On the CPU numpy's values-only sort is several times faster than torch.sort,
+    # which always computes the permutation as well
+    if x.device.type == 'cpu':
+        return torch.from_numpy(np.sort(x.numpy(), axis=-1))
+    return x.sort(dim=-1).values
+
 # AUC score for logging
 def AUCScore(predict, targets):
-    num_classes = targets.shape[-1]
-    scores=[]
-    for c in range(num_classes):
-        if torch.equal(targets[...,c], torch.ones_like(targets[...,c])) or torch.equal(targets[...,c], torch.zeros_like(targets[...,c])):
-            scores.append(0)
-        else:
-            # AUC for each class
-            scores.append(roc_auc_score(targets[...,c], predict[...,c], multi_class='ovr'))
+    """
+    One-vs-rest AUC of every class (0 for a class that is absent or present in every event), i.e. sklearn's roc_auc_score
+    of each column. All the columns are sorted at once, and the rank statistic of every class is read off its sorted
+    column by a binary search of its positive events (tied scores share their average rank).
+    """
+    num_events = len(targets)
+    sorted_scores = _sort_values(predict.T.contiguous()) # C x N
+    scores = []
+    for c in range(targets.shape[-1]):
+        positives = predict[targets[..., c] == 1, c].contiguous()
+        num_pos, num_neg = len(positives), num_events - len(positives)
+        if num_pos == 0 or num_neg == 0:
+            scores.append(0.)
+            continue
+        below = torch.searchsorted(sorted_scores[c], positives)
+        below_or_tied = torch.searchsorted(sorted_scores[c], positives, right=True)
+        rank_sum = (below + below_or_tied + 1).double().sum().item() / 2
+        scores.append((rank_sum - num_pos * (num_pos + 1) / 2) / (num_pos * num_neg))
     return np.array(scores)
 
-def AUCScoreMacro(predict, targets):
-    # If any of the classes are not represented in the sample, macro AUC can't be computed
+def AUCScoreMacro(predict, targets, scores=None):
+    # With one-hot targets, roc_auc_score(..., average='macro') is the mean of the one-vs-rest AUCs of AUCScore
+    # (scores, if they were already computed). If any of the classes are not represented in the sample, it can't be computed.
     if (targets.sum(0)==0).any():
         return 0
-    return roc_auc_score(targets, predict, multi_class='ovo', average='macro')
+    return (AUCScore(predict, targets) if scores is None else scores).mean()
 
+def roc_curves(scores, targets):
+    """
+    sklearn's roc_curve (with drop_intermediate=True) of every column of scores (N x C) against the one-hot targets.
+    The columns are sorted at once, and the positive events of a column are counted at its distinct scores after a binary
+    search of each of them. Classes that are absent or present in every event get None.
+    Returns: list of (fpr, tpr, thresholds)
+    """
+    num_events = len(targets)
+    sorted_scores = _sort_values(scores.T.contiguous()) # C x N
+    curves = []
+    for c in range(scores.shape[1]):
+        positives = scores[targets[..., c] == 1, c].contiguous()
+        if len(positives) == 0 or len(positives) == num_events:
+            curves.append(None)
+            continue
+        # Distinct scores, and the number of events / of positive events scoring at least as high as each of them
+        column = sorted_scores[c]
+        first = torch.cat([torch.ones(1, dtype=torch.bool, device=column.device), column[1:] != column[:-1]])
+        thresholds = column[first]
+        above = num_events - first.nonzero().squeeze(1)
+        tps = torch.bincount(torch.searchsorted(thresholds, positives), minlength=len(thresholds)).flip(0).cumsum(0)
+        thresholds, tps, fps = [x.cpu().numpy() for x in [thresholds.flip(0), tps, above.flip(0) - tps]]
+        if len(fps) > 2:
+            optimal_idxs = np.where(np.r_[True, np.logical_or(np.diff(fps, 2), np.diff(tps, 2)), True])[0]
+            fps, tps, thresholds = fps[optimal_idxs], tps[optimal_idxs], thresholds[optimal_idxs]
+        tps, fps, thresholds = np.r_[0, tps], np.r_[0, fps], np.r_[np.inf, thresholds]
+        curves.append((fps / fps[-1], tps / tps[-1], thresholds))
+    return curves
 
 def ROC(predict, targets, backg_class=-1):
     num_classes = targets.shape[-1]
     curves = ()
     eB30s, eB50s, eB995s, eS30s, eS50s, eS995s   = [], [], [], [], [], []
     tpr10s, fpr10s, tpr1s, fpr1s = [], [], [], []
-    for c in range(num_classes):
-        if torch.equal(targets[...,c], torch.ones_like(targets[...,c])) or torch.equal(targets[...,c], torch.zeros_like(targets[...,c])):
+    if backg_class >= 0:
+        eps = 1e-12
+        scores = predict/(eps + predict + predict[..., backg_class:backg_class + 1])
+    else:
+        scores = predict
+    # All the curves come out of one sort of the score columns, and the working points are read off each curve
+    for curve in roc_curves(scores, targets):
+        if curve is None:
             curves = curves + (np.array([]),np.array([]),np.array([]))
-            [x.append(0.) for x in [eB30s, eB50s, eS30s, eS50s, tpr10s, fpr10s, tpr1s, fpr1s]]
+            [x.append(0.) for x in [eB30s, eB50s, eB995s, eS30s, eS50s, eS995s, tpr10s, fpr10s, tpr1s, fpr1s]]
         else:
-            if backg_class >= 0:
-                eps = 1e-12
-                scores = predict[..., c]/(eps + predict[..., c] + predict[..., backg_class])
-                curve = roc_curve(targets[..., c], scores)
-            else:
-                curve = roc_curve(targets[...,c], predict[..., c])
             eB30, eS30   = BR(curve, at_eS=0.3)
             eB50, eS50   = BR(curve, at_eS=0.5)
             eB995, eS995 = BR(curve, at_eS=0.995)
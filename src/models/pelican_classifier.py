@@ -3,8 +3,8 @@ import torch.nn as nn
 
 import logging
 
-from .lorentz_metric import CATree, SDMultiplicity
-from ..layers import BasicMLP, Net2to2, Eq1to2, Eq2to0, MessageNet, InputEncoder, GInvariants, MyLinear
+from .lorentz_metric import dot4, CATree, SDMultiplicity
+from ..layers import BasicMLP, Net2to2, Eq1to2, Eq2to0, MessageNet, InputEncoder, GInvariants, MyLinear, Packing, checkpoint_module, add_spurions_packed
 from ..trainer import init_weights
 logger = logging.getLogger(__name__)
 import torch.nn.functional as F
@@ -16,7 +16,7 @@ class PELICANClassifier(nn.Module):
     def __init__(self, rank1_dim_multiplier, num_channels_scalar, num_channels_m, num_channels_2to2, num_channels_out, num_channels_m_out, 
                  stabilizer='so13', method='input', num_classes=2,
                  activate_agg_in=False, activate_lin_in=True,
-                 activate_agg=False, activate_lin=True, activation='leakyrelu', config='s', config_out='s', average_nobj=49, factorize=False, masked=True,
+                 activate_agg=False, activate_lin=True, activation='leakyrelu', config='s', config_out='s', average_nobj=49, factorize=False, masked=True, fused=False, packed=False, symmetric=False, activation_checkpoint=None, checkpoint_memory=2**30, check_nan=True,
                  activate_agg_out=True, activate_lin_out=False, mlp_out=True,
                  scale=1, irc_safe=False, dropout = False, drop_rate=0.1, drop_rate_out=0.1, batchnorm=None, dataset='',
                  device=torch.device('cpu'), dtype=None):
@@ -48,7 +48,18 @@ class PELICANClassifier(nn.Module):
         self.average_nobj = average_nobj
         self.factorize = factorize
         self.masked = masked
+        # packed=True expects batches from collate_fn(..., packed=True) and runs every layer on the valid particles and pairs only
+        self.packed = packed
+        # symmetric=True exploits the i<->j symmetry of the pairwise invariants: the input encoder only runs on the pairs i<=j,
+        # and the first 2->2 layer skips its column aggregations when its input is built from the pairwise invariants alone
+        self.symmetric = symmetric
+        # check_nan=k > 1 samples one forward pass in k and only records the outcome on the device (see raise_if_nan)
+        self.check_nan = check_nan
+        self.nan_detected = None
+        self.num_forward = 0
         self.dataset = dataset
+        if packed and irc_safe:
+            raise NotImplementedError("The irc_safe option is not supported for packed batches")
         
 
         if dropout:
@@ -63,7 +74,8 @@ class PELICANClassifier(nn.Module):
         self.rank2_dim = self.ginvariants.rank2_dim
 
         self.num_scalars = {'qg': 12, 'jc': 12, '': 0}[dataset]
-        if self.method.startswith('s'):
+        # add_spurions labels the spurions with a one-hot (with a slot for the particles), which doesn't happen for so13
+        if self.method.startswith('s') and self.num_spurions() > 0:
             self.num_scalars += 1 + self.num_spurions()
 
         if (len(num_channels_m) > 0) and (len(num_channels_m[0]) > 0):
@@ -99,9 +111,8 @@ class PELICANClassifier(nn.Module):
         mode = 'angle' if self.irc_safe else 'slog'
         self.input_encoder = InputEncoder(rank1_dim_multiplier, embedding_dim, 
                                           rank1_in_dim = self.rank1_dim, rank2_in_dim=self.rank2_dim, 
-                                          mode=mode, device = device, dtype = dtype)
+                                          mode=mode, symmetric=symmetric, device = device, dtype = dtype)
         
-        self.input_proj = None 
 
 
         # This is the main part of the network -- a sequence of permutation-equivariant 2->2 blocks
@@ -109,7 +120,12 @@ class PELICANClassifier(nn.Module):
         self.net2to2 = Net2to2(num_channels_2to2 + [num_channels_m_out[0]], num_channels_m, 
                                activate_agg=activate_agg, activate_lin=activate_lin, activation = activation, 
                                dropout=dropout, drop_rate=drop_rate, batchnorm = batchnorm, config=config, 
-                               average_nobj=average_nobj, factorize=factorize, masked=masked, device = device, dtype = dtype)
+                               average_nobj=average_nobj, factorize=factorize, masked=masked, fused=fused,
+                               activation_checkpoint=activation_checkpoint, checkpoint_memory=checkpoint_memory, device = device, dtype = dtype)
+
+        # The input of Net2to2 (the rank 2 embedding and the eq1to2 features) is mixed up to the width of its first message layer
+        input_channels = (1 if self.rank2_dim > 0 else 0) + (num_channels_scalar if self.num_scalars > 0 else 0)
+        self.input_proj = nn.Linear(input_channels, self.net2to2.in_dim, device=device, dtype=dtype) if input_channels != self.net2to2.in_dim else None
 
         # The final equivariant block is 2->1 and is defined here manually as a messaging layer followed by the 2->1 aggregation layer
         self.msg_2to0 = MessageNet(num_channels_m_out, activation=activation, 
@@ -144,80 +160,43 @@ class PELICANClassifier(nn.Module):
         Runs a forward pass of the network.
         """
         # Get and prepare the data
-        particle_scalars, particle_mask, edge_mask, event_momenta = self.prepare_input(data)
-        rank1_inputs, rank2_inputs, irc_weight = self.ginvariants(event_momenta)
+        particle_scalars, particle_mask, edge_mask, event_momenta, packing = self.prepare_input(data)
+        rank1_inputs, rank2_inputs, irc_weight = self.ginvariants(event_momenta, packing=packing)
 
         # regular multiplicity
-        nobj = particle_mask.sum(-1, keepdim=True)
-        # If the aggregation option is set to means, we replace N with the SoftDrop multiplicity (NB: THIS IS EXTREMELY SLOW)
-        # TODO: pre-compute SoftDrop Multiplicities before training and safe it into a data file instead of re-computing at each epoch.
+        nobj = particle_mask.sum(-1, keepdim=True) if packing is None else packing.nobj.unsqueeze(-1)
+        # If the aggregation option is set to means, we replace N with the SoftDrop multiplicity
+        # (NB: computing it here is EXTREMELY SLOW, run precompute_nsd.py on the datafiles to store it as 'nSD' instead)
         if self.irc_safe:
             if ('m' in self.config or 'M' in self.config) or ('m' in self.config_out or 'M' in self.config_out):
-                nobj = SDMultiplicity(CATree(rank2_inputs, nobj, ycut=1000, eps=10e-8)).unsqueeze(-1).to(device=nobj.device)
+                if 'nSD' in data.keys():
+                    # Precomputed by precompute_nsd.py
+                    nobj = data['nSD'].to(device=nobj.device, dtype=torch.long).unsqueeze(-1)
+                else:
+                    nobj = SDMultiplicity(CATree(dot4(event_momenta.unsqueeze(1), event_momenta.unsqueeze(2)), nobj, ycut=1000, eps=10e-8)).unsqueeze(-1).to(device=nobj.device)
 
         # The first nonlinearity is the input encoder, which applies functions of the form ((1+x)^alpha-1)/alpha with trainable alphas.
         # In the C-safe case, this is still fine because inputs depends only on relative angles
         rank2_inputs = self.linear(rank2_inputs)
         rank1_inputs, rank2_inputs = self.input_encoder(rank1_inputs, rank2_inputs, 
-                                                        rank1_mask=particle_mask.unsqueeze(-1) ,rank2_mask=edge_mask.unsqueeze(-1))
-
-        inputs = self.apply_eq1to2(particle_scalars, rank1_inputs, rank2_inputs, edge_mask, nobj, irc_weight)
-
-
-        if inputs.shape[-1] != self.net2to2.in_dim:
-                input_shape = inputs.shape
-                last_dim = input_shape[-1]
-                out_dim = self.net2to2.in_dim
-
-                # Instantiate input_proj if not already done or shape changed
-                if (self.input_proj is None) or (self.input_proj.in_features != last_dim) or (self.input_proj.out_features != out_dim):
-                    self.input_proj = torch.nn.Linear(last_dim, out_dim).to(inputs.device)
-                    # Optionally, initialize weights similarly to your other layers
+                                                        rank1_mask=particle_mask.unsqueeze(-1) if packing is None else None, rank2_mask=edge_mask.unsqueeze(-1) if packing is None else None, packing=packing)
 
-                # Flatten all but last dimension, project, and reshape back
-                flat_inputs = inputs.view(-1, last_dim)
-                projected = self.input_proj(flat_inputs)
-                new_shape = input_shape[:-1] + (out_dim,)
-                inputs = projected.view(*new_shape)
+        # The rank 2 embedding has a single channel
+        rank2_inputs = rank2_inputs.unsqueeze(-1)
+        inputs = self.apply_eq1to2(particle_scalars, rank1_inputs, rank2_inputs, edge_mask, nobj, irc_weight, packing=packing)
+        if self.input_proj is not None:
+            inputs = self.input_proj(inputs)
 
-
-
-        # For Net2to2: check shape of inputs
-        if inputs.dim() == 3 and inputs.shape[1] == edge_mask.shape[1]:  # [batch, nobj, features]
-            # Only need a per-particle mask!
-            mask_for_net2to2 = particle_mask.unsqueeze(-1)  # [batch, nobj, 1]
-        else:
-            mask_for_net2to2 = edge_mask  # [batch, nobj, nobj, 1]
-        print("type(inputs):", type(inputs))
-        print("mask_for_net2to2.shape:", mask_for_net2to2.shape)
-
-        if inputs.dim() == 3:
-            B, N, F = inputs.shape
-            x_i = inputs.unsqueeze(2).expand(B, N, N, F)
-            x_j = inputs.unsqueeze(1).expand(B, N, N, F)
-            inputs = torch.cat([x_i, x_j], dim=-1)  # Now [B, N, N, 2F]
-
-        # Project to correct feature size if needed
-        if inputs.shape[-1] != self.net2to2.in_dim:
-            print(f"Projecting from {inputs.shape[-1]} to {self.net2to2.in_dim}")
-            input_shape = inputs.shape
-            last_dim = input_shape[-1]
-            out_dim = self.net2to2.in_dim
-            if (self.input_proj is None) or (self.input_proj.in_features != last_dim) or (self.input_proj.out_features != out_dim):
-                self.input_proj = torch.nn.Linear(last_dim, out_dim).to(inputs.device)
-            flat_inputs = inputs.view(-1, last_dim)
-            projected = self.input_proj(flat_inputs)
-            new_shape = input_shape[:-1] + (out_dim,)
-            inputs = projected.view(*new_shape)
-
-
-        act1 = self.net2to2(inputs, mask=mask_for_net2to2, nobj=nobj, irc_weight=irc_weight if self.irc_safe else None)
+        # Only a rank 2 input made of the pairwise invariants alone is symmetric (the eq1to2 features are not)
+        symmetric = self.symmetric and self.num_scalars == 0 and self.rank1_dim == 0
+        act1 = self.net2to2(inputs, mask=edge_mask, nobj=nobj, irc_weight=irc_weight if self.irc_safe else None, packing=packing, symmetric=symmetric)
 
         # The last equivariant 2->0 block is constructed here by hand: message layer, dropout, and Eq2to0.
-        act2 = self.msg_2to0(act1, mask=edge_mask) 
-        if self.dropout:
-            act2 = self.dropout_layer(act2)
-        act3 = self.agg_2to0(act2, nobj = nobj, irc_weight = irc_weight if self.irc_safe else None)
+        # It is checkpointed together with the Net2to2 blocks.
+        if self.net2to2.activation_checkpoint is not None and self.training and torch.is_grad_enabled():
+            act2, act3 = checkpoint_module(self.head_2to0, self.msg_2to0, act1, edge_mask, nobj, irc_weight, packing)
+        else:
+            act2, act3 = self.head_2to0(act1, edge_mask, nobj, irc_weight, packing)
 
         # The output layer applies dropout and an MLP.
         if self.dropout:
@@ -227,22 +206,49 @@ class PELICANClassifier(nn.Module):
         else:
             prediction = act3
 
-        check_nan = torch.isnan(prediction).any()
-        if check_nan:
-            logging.info(torch.isnan(act1).sum(1,2,3))
-            logging.info(f"inputs has NaNs: {torch.isnan(inputs).any()}")
-            logging.info(f"rank1_inputs: {torch.isnan(rank1_inputs).any()}")
-            logging.info(f"rank2_inputs: {torch.isnan(rank2_inputs).any()}")
-            logging.info(f"act1 has NaNs: {torch.isnan(act1).any()}")
-            logging.info(f"act2 has NaNs: {torch.isnan(act2).any()}")
-            logging.info(f"prediction has NaNs: {check_nan}")
-        assert not check_nan, "There are NaN entries in the output! Evaluation terminated."
+        # The per-pass NaN check syncs with the device, it is skipped with check_nan=False (e.g. under torch.compile)
+        if self.check_nan > 1:
+            self.sample_nan(prediction)
+        elif self.check_nan:
+            check_nan = torch.isnan(prediction).any()
+            if check_nan:
+                logging.info(torch.isnan(act1).flatten(1).sum(1))
+                logging.info(f"inputs has NaNs: {torch.isnan(inputs).any()}")
+                logging.info(f"rank1_inputs: {torch.isnan(rank1_inputs).any()}")
+                logging.info(f"rank2_inputs: {torch.isnan(rank2_inputs).any()}")
+                logging.info(f"act1 has NaNs: {torch.isnan(act1).any()}")
+                logging.info(f"act2 has NaNs: {torch.isnan(act2).any()}")
+                logging.info(f"prediction has NaNs: {check_nan}")
+            assert not check_nan, "There are NaN entries in the output! Evaluation terminated."
 
         if covariance_test:
             return {'predict': prediction, 'inputs': inputs, 'act1': act1, 'act2': act2, 'act3': act3}
         else:
             return {'predict': prediction}
 
+    @torch.compiler.disable
+    def sample_nan(self, prediction):
+        # Records whether one forward pass in check_nan has NaNs, without syncing. It runs eager under torch.compile,
+        # where the pass counter would otherwise be baked into the graph and force a recompilation on every pass.
+        if self.num_forward % self.check_nan == 0:
+            nan_detected = torch.isnan(prediction.detach()).any()
+            self.nan_detected = nan_detected if self.nan_detected is None else self.nan_detected | nan_detected
+        self.num_forward += 1
+
+    def raise_if_nan(self):
+        """
+        Raises if one of the forward passes sampled by check_nan > 1 since the last call produced NaNs.
+        This is the only point where those checks synchronize with the device.
+        """
+        nan_detected, self.nan_detected = self.nan_detected, None
+        assert nan_detected is None or not nan_detected, "There are NaN entries in the output! Evaluation terminated."
+
+    def head_2to0(self, act1, edge_mask, nobj, irc_weight, packing):
+        act2 = self.msg_2to0(act1, mask=edge_mask, packing=packing) 
+        if self.dropout:
+            act2 = self.dropout_layer(act2)
+        return act2, self.agg_2to0(act2, nobj = nobj, irc_weight = irc_weight if self.irc_safe else None, packing=packing)
+
     def prepare_input(self, data):
         """
         Extracts input from data class
@@ -257,11 +263,13 @@ class PELICANClassifier(nn.Module):
         scalars : :obj:`torch.Tensor`
             Tensor of scalars for each particle.
         particle_mask : :obj:`torch.Tensor`
-            Mask used for batching data.
+            Mask used for batching data (None for packed batches).
         edge_mask: :obj:`torch.Tensor`
-            Mask used for batching data.
+            Mask used for batching data (None for packed batches).
         event_momenta: :obj:`torch.Tensor`
             4-momenta of the particles
+        packing: :obj:`Packing`
+            Index bookkeeping of a packed batch (None for padded batches).
         """
         device, dtype = self.device, self.dtype
 
@@ -274,14 +282,19 @@ class PELICANClassifier(nn.Module):
 
         event_momenta = data['Pmu'].to(device, dtype)
         # event_momenta.requires_grad_(True)
-        particle_mask = data['particle_mask'].to(device, torch.bool)
-        edge_mask = data['edge_mask'].to(device, torch.bool)
+        if self.packed:
+            packing = Packing(data['Nobj'].to(device))
+            particle_mask = edge_mask = None
+        else:
+            packing = None
+            particle_mask = data['particle_mask'].to(device, torch.bool)
+            edge_mask = data['edge_mask'].to(device, torch.bool)
 
         if 'scalars' in data.keys():
             scalars = data['scalars'].to(device, dtype)
         else:
             scalars = None
-        return scalars, particle_mask, edge_mask, event_momenta
+        return scalars, particle_mask, edge_mask, event_momenta, packing
     
     def num_spurions(self):
         if self.method.startswith('i'):
@@ -318,6 +331,8 @@ class PELICANClassifier(nn.Module):
             spurions = torch.tensor([[[1,0,0,0],[0,1,0,0],[0,0,1,0],[0,0,0,1]]], dtype=dtype, device=device)
         elif stabilizer in ['1_0','11_0']:
             spurions = torch.tensor([[[1,0,0,1],[1,1,0,0],[1,0,1,0],[1,0,0,-1]]], dtype=dtype, device=device)
+        if self.packed:
+            return add_spurions_packed(data, spurions[0])
         spurions = spurions.expand((batch_size, -1, -1))
 
         num_spurions = spurions.shape[1]
@@ -337,7 +352,7 @@ class PELICANClassifier(nn.Module):
             data['scalars'] = spurion_label_onehot
         return data
     
-    def apply_eq1to2(self, particle_scalars, rank1_inputs, rank2_inputs, edge_mask, nobj, irc_weight):
+    def apply_eq1to2(self, particle_scalars, rank1_inputs, rank2_inputs, edge_mask, nobj, irc_weight, packing=None):
         # First concatenate particle scalar inputs with rank 1 momentum features (if any)
         if self.num_scalars > 0:
             if rank1_inputs is None:
@@ -346,7 +361,7 @@ class PELICANClassifier(nn.Module):
                 rank1_inputs = torch.cat([particle_scalars, rank1_inputs], dim=-1)
         # Now promore all rank 1 data to rank 2 using Eq1to2
         if rank1_inputs is not None:
-            rank2_particle_scalars = self.eq1to2(rank1_inputs, mask=edge_mask.unsqueeze(-1), nobj=nobj, irc_weight = irc_weight if self.irc_safe else None)
+            rank2_particle_scalars = self.eq1to2(rank1_inputs, mask=edge_mask.unsqueeze(-1) if packing is None else None, nobj=nobj, irc_weight = irc_weight if self.irc_safe else None, packing=packing)
         else:
             rank2_particle_scalars = None
         # Concatenate all rank 2 data together
@@ -355,9 +370,6 @@ class PELICANClassifier(nn.Module):
         elif rank2_particle_scalars is None:
             inputs = rank2_inputs
         else:
-            if rank2_inputs is not None and rank2_inputs.dim() == 3:
-                rank2_inputs = rank2_inputs.unsqueeze(-1)
-
             inputs = torch.cat([rank2_inputs, rank2_particle_scalars], dim=-1)
         return inputs
     
@@ -55,6 +55,8 @@ def setup_argparse():
                         help='Number of epochs of exponential LR cooldown (default: 3)')
     parser.add_argument('--batch-size', '-bs', type=int, default=16, metavar='N',
                         help='Mini-batch size (default: 16)')
+    parser.add_argument('--pair-budget', type=int, default=-1, metavar='N',
+                        help='Instead of --batch-size, group training jets of similar multiplicity into batches with batch_size*Nmax^2 <= pair_budget, and trim each batch to its own Nmax (-1 to disable) (default: -1)')
     parser.add_argument('--save-every', type=int, default=0, metavar='N',
                         help='Save checkpoint during training every save_every minibatches (default: 0)')
     parser.add_argument('--log-every', type=int, default=1, metavar='N',
@@ -79,6 +81,12 @@ def setup_argparse():
                         help='Set optimizer. (SGD, AMSgrad, Adam, AdamW, RMSprop)')
     parser.add_argument('--weight-decay', type=float, default=0, metavar='N',
                         help='Set the weight decay used in optimizer (default: 0)')
+    parser.add_argument('--optim-foreach', action=argparse.BooleanOptionalAction, default=False,
+                        help='Update all the parameters at once with torch._foreach_* ops in the custom optimizers (--optim demon). (default = False)')
+    parser.add_argument('--optim-flat-state', action=argparse.BooleanOptionalAction, default=False,
+                        help='Keep the moments and the lookahead cache of the custom optimizers (--optim demon) in flat contiguous buffers. (default = False)')
+    parser.add_argument('--optim-state-dtype', type=str, default=None, metavar='str',
+                        help='Dtype in which --optim-flat-state stores the moments. (bfloat16 | float16) (default: dtype of the parameters)')
     parser.add_argument('--summarize', action=argparse.BooleanOptionalAction, default=False,
                         help='Use a TensorBoard SummaryWriter() to log metrics.')
     parser.add_argument('--summarize-csv', type=str, default='test', metavar='str',
@@ -87,6 +95,13 @@ def setup_argparse():
     # Dataloader and randomness options
     parser.add_argument('--RAMdataset', action=argparse.BooleanOptionalAction, default=True,
                         help='Load datasets into RAM before training.')
+    parser.add_argument('--RAM-max-memory', type=int, default=256, metavar='N',
+                        help='Peak memory in MB of the temporary buffers used while reading a subset of a file into RAM (default: 256)')
+    parser.add_argument('--RAM-threads', type=int, default=1, metavar='N',
+                        help='Number of threads reading the keys of a file into RAM in parallel (default: 1)')
+    parser.add_argument('--RAM-distributed', type=str, default='replicate', choices=['replicate', 'shard', 'shared'],
+                        help='What each process of a DDP run holds in RAM: all the events (replicate), only the events it visits (shard, with the training events dealt out to the processes anew every epoch when shuffled), '
+                             'or all the events in shared memory loaded once per node (shared) (default: replicate)')
     parser.add_argument('--shuffle', action=argparse.BooleanOptionalAction, default=True,
                         help='Shuffle minibatches.')
     parser.add_argument('--seed', type=int, default=-1, metavar='N',
@@ -198,9 +213,13 @@ def setup_argparse():
     parser.add_argument('--double', dest='dtype', action='store_const', const='double',
                         help='Use doubles.')
     parser.set_defaults(dtype='float')
+    parser.add_argument('--cpu-threads', type=int, default=0,
+                        help='Intra-op threads per process when running on CPU under torchrun (0 to split the cores of the node evenly among its ranks) (default = 0)')
+    parser.add_argument('--pin-cpus', action=argparse.BooleanOptionalAction, default=True,
+                        help='Pin each process to its share of the cores when running on CPU under torchrun. (default = True)')
     parser.add_argument('--num-workers', type=int, default=0,
                         help='Set number of workers in dataloader. (Default: 0)')
-    parser.add_argument('--distribute-eval', action=argparse.BooleanOptionalAction, default=False, help='Distribute final testing (evaluation) among all GPUs. (default: False)')
+    parser.add_argument('--distribute-eval', action=argparse.BooleanOptionalAction, default=True, help='Distribute final testing (evaluation) among all processes, the predictions keep the order of the dataset. (default: True)')
 
 
     # Model options
@@ -289,6 +308,30 @@ def setup_argparse():
                     help='Apply an activation function right after the linear mixing following Eq2to0 aggregation (default = False)')
     parser.add_argument('--factorize', action=argparse.BooleanOptionalAction, default=True,
                     help='Use this option to significantly reduce the number of weights used in Eq2to2 layers (default = True)')
+    parser.add_argument('--fused', action=argparse.BooleanOptionalAction, default=False,
+                    help='Contract the Eq2to2 coefficients with the low-rank aggregates directly instead of stacking all basis operators (saves memory, same outputs) (default = False)')
+    parser.add_argument('--packed', action=argparse.BooleanOptionalAction, default=False,
+                    help='Concatenate the jets of a batch without zero padding and run the network on the valid particles and pairs only (default = False)')
+    parser.add_argument('--activation-checkpoint', type=str, default=None, metavar='POLICY',
+                    help='Recompute the activations of the equivariant blocks during the backward pass instead of storing them: "all", an integer k (every k-th block), or "auto" (default = None)')
+    parser.add_argument('--checkpoint-memory', type=int, default=1024, metavar='MB',
+                    help='Target for the stored activations of the equivariant blocks with --activation-checkpoint auto, in MB (default = 1024)')
+    parser.add_argument('--compile', action=argparse.BooleanOptionalAction, default=False,
+                    help='Compile the model with torch.compile (padded batches, best with a fixed batch size or with --nobj-buckets) (default = False)')
+    parser.add_argument('--sync-free', action=argparse.BooleanOptionalAction, default=False,
+                    help='Keep the training losses and predictions on the device and move them to the host in one transfer per --log-every interval (100 minibatches if --log-every is 1 or 0), so that the training step does not wait for the device (minibatch logs only use the local share of the batch) (default = False)')
+    parser.add_argument('--streaming-metrics', action=argparse.BooleanOptionalAction, default=False,
+                    help='Compute the training and validation metrics of every epoch from summaries updated after each minibatch (score histograms for binary classification, quantile sketches for regression) instead of keeping all the predictions, which are then not saved (not for multiclass classification) (default = False)')
+    parser.add_argument('--roc-csv', action=argparse.BooleanOptionalAction, default=False,
+                    help='Besides the downsampled binary <prefix>_ROC.npy, also write the ROC curves as text to <prefix>_ROC.csv (in full for the exact metrics) (default = False)')
+    parser.add_argument('--out-of-core-eval', action=argparse.BooleanOptionalAction, default=False,
+                    help='Evaluate the final checkpoints with bounded memory: the predictions, targets and dataset indices are appended batch by batch to chunked HDF5 files (<predictfile>.<checkpoint>.<split>.h5, with --predict, which also get the downsampled ROC curve as roc) and the metrics come from the streaming engines of --streaming-metrics, which it requires (default = False)')
+    parser.add_argument('--nan-check-every', type=int, default=1, metavar='N',
+                    help='Check the model outputs for NaNs on every forward pass (1), never (0), or on one pass in N without waiting for the device, reporting at the next log interval or the end of the epoch (N > 1); with --compile, only N > 1 checks anything (default = 1)')
+    parser.add_argument('--nobj-buckets', nargs='*', type=int, default=None, metavar='N',
+                    help='Trim the padding of every batch to the smallest of these numbers of particles that fits it, to bound the number of distinct shapes (default = None)')
+    parser.add_argument('--symmetric', action=argparse.BooleanOptionalAction, default=False,
+                    help='Use the i<->j symmetry of the pairwise invariants to only embed the pairs i<=j and skip the column aggregations of the first 2->2 layer (default = False)')
     parser.add_argument('--masked', action=argparse.BooleanOptionalAction, default=True,
                     help='Use a masked version of Batchnorm (has no effect if --batchnorm is False) (default = True)')
 
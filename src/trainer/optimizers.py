@@ -1,9 +1,282 @@
 from torch.optim.optimizer import Optimizer, required
 import torch
 import math
+import bisect
+import types
 import numpy as np
 
 
+def _foreach_buckets(optimizer, group):
+    """
+    The parameters of a param group that have a gradient, with their gradients (p.grad.data.float(), as in the
+    per-parameter loops) and states, split into lists that share the device, dtype and step count, so that each list is
+    updated with torch._foreach_* ops and the same step-dependent scalars. New states are filled by optimizer._init_state.
+    """
+    buckets = {}
+    for p in group['params']:
+        if p.grad is None:
+            continue
+        grad = p.grad.data.float()
+        if grad.is_sparse:
+            raise RuntimeError(
+                '{} does not support sparse gradients'.format(type(optimizer).__name__))
+        state = optimizer.state[p]
+        if len(state) == 0:
+            optimizer._init_state(p, grad, group, state)
+        params, grads, states = buckets.setdefault((p.device, p.dtype, state['step']), ([], [], []))
+        params.append(p.data)
+        grads.append(grad)
+        states.append(state)
+    return list(buckets.values())
+
+
+def _centralize(grads):
+    # Gradient centralization of the multi-dimensional gradients
+    for grad in grads:
+        if grad.dim() > 1:
+            grad.add_(-grad.mean(dim=tuple(range(1, grad.dim())), keepdim=True))
+
+
+def _normal_like(tensors, std):
+    # Gaussian noise for a list of tensors, drawn at once as one flat tensor
+    sizes = [t.numel() for t in tensors]
+    noise = torch.empty(sum(sizes), dtype=tensors[0].dtype, device=tensors[0].device).normal_(mean=0.0, std=std)
+    return [n.view_as(t) for n, t in zip(noise.split(sizes), tensors)]
+
+
+def _diffgrad(exp_avgs, grads, states):
+    # diffGrad: exp_avg * sigmoid(|previous_grad - grad|) as a new list (the stored moments are unchanged)
+    dfc = torch._foreach_sub([state['previous_grad'] for state in states], grads)
+    torch._foreach_abs_(dfc)
+    torch._foreach_neg_(dfc)
+    torch._foreach_exp_(dfc)
+    torch._foreach_add_(dfc, 1.)
+    torch._foreach_reciprocal_(dfc)
+    for state, grad in zip(states, grads):
+        state['previous_grad'].copy_(grad)
+    return torch._foreach_mul(exp_avgs, dfc)
+
+
+def _foreach_dot(xs, ys):
+    # Dot products of the pairs of 1D tensors of two lists, as one vector
+    products = torch.cat(torch._foreach_mul(xs, ys))
+    segments = torch.repeat_interleave(torch.arange(len(xs), device=products.device),
+                                       torch.tensor([len(x) for x in xs], device=products.device))
+    return products.new_zeros(len(xs)).index_add_(0, segments, products)
+
+
+def _stack(values, like):
+    # Per-parameter scalars of the states (floats or 0-dimensional tensors) as one vector
+    return torch.stack([torch.as_tensor(value, dtype=like.dtype, device=like.device) for value in values])
+
+
+def _scalars(values):
+    # Per-parameter scalars of the states as Python floats (with one device sync), for the fast path of the foreach ops
+    return torch.stack([torch.as_tensor(value, dtype=torch.float64) for value in values]).tolist()
+
+
+def _foreach_AdaMod(n_avgs, n, beta3, step, bias_correct):
+    # apply_AdaMod on lists: n is bounded by the (bias corrected) running average of n
+    torch._foreach_mul_(n_avgs, beta3)
+    torch._foreach_add_(n_avgs, n, alpha=1 - beta3)
+    if bias_correct:
+        torch._foreach_minimum_(n, torch._foreach_div(n_avgs, 1 - (beta3 ** step)))
+    else:
+        torch._foreach_minimum_(n, n_avgs)
+
+def _hyperupdate(values, grads, grad_comps, hypergrad_lr, eps, HDM, grad_norms=None):
+    """
+    Hypergradient descent on per-parameter scalars (e.g. the learning rates): values - hypergrad_lr * <grad, grad_comp>,
+    or with HDM the multiplicative rule values * (1 - hypergrad_lr * <grad, grad_comp> / (|grad| |grad_comp| + eps)).
+    grads and grad_comps are lists of flat tensors; returns the new values as one vector.
+    """
+    h = _foreach_dot(grads, grad_comps)
+    values = _stack(values, h)
+    if HDM:
+        if grad_norms is None:
+            grad_norms = torch.stack(torch._foreach_norm(grads))
+        norm_denom = grad_norms * torch.stack(torch._foreach_norm(grad_comps))
+        norm_denom.add_(eps)
+        return values * (1 - hypergrad_lr * (h / norm_denom))
+    return values - hypergrad_lr * h
+
+def _averaging_steps(optimizer, step, activate_IA):
+    # (lookahead_step, do_IA) of the per-parameter loops
+    if getattr(optimizer, 'IA', False) and activate_IA:
+        return False, step % optimizer.IA_cycle == 0
+    return optimizer.k != 0 and step % optimizer.k == 0, False
+
+
+def _foreach_average(params, states, lookahead_step, do_IA, alpha):
+    # Lookahead (interpolation with the cached parameters) or iterate averaging, as in the per-parameter loops
+    if not (lookahead_step or do_IA):
+        return
+    cached = [state['cached_params'] for state in states]
+    if lookahead_step:
+        torch._foreach_mul_(params, alpha)
+        torch._foreach_add_(params, cached, alpha=1.0 - alpha)
+    else:
+        num_models = states[0]['num_models']
+        torch._foreach_add_(params, cached, alpha=num_models)
+        torch._foreach_div_(params, num_models + 1.0)
+        for state in states:
+            state['num_models'] += 1
+    torch._foreach_copy_(cached, params)
+
+
+
+# State tensors that the optimizers only update in place, which flat_state keeps in flat buffers
+_FLAT_KEYS = ('exp_avg', 'exp_avg_sq', 'max_exp_avg_sq', 'n_avg', 'previous_grad', 'cached_params')
+# The moments, which flat_state can store in state_dtype
+_MOMENT_KEYS = ('exp_avg', 'exp_avg_sq', 'max_exp_avg_sq', 'n_avg')
+# Number of elements per moment that flat_state with state_dtype holds in the dtype of the update during a step
+_FLAT_CHUNK_NUMEL = 1 << 22
+
+
+def _init_flat_state(optimizer, flat_state, state_dtype):
+    """
+    With flat_state, the states of _FLAT_KEYS are views into one flat buffer per key, dtype and device, created at the
+    first step for all the parameters that require a gradient. The moments are stored in state_dtype (e.g. torch.bfloat16)
+    between the steps and in the checkpoints, and updated in the dtype of the parameters chunk by chunk (see _flat_state_step).
+    """
+    if state_dtype is not None and not flat_state:
+        raise NotImplementedError("state_dtype requires flat_state")
+    optimizer.flat_state = flat_state
+    optimizer.state_dtype = state_dtype
+    optimizer._flat_buckets = None
+    optimizer._flat_chunks = None
+    # Stochastic rounding draws from its own generators (one per device), so that it does not shift the global random
+    # stream of dropout and gradient noise, and rounds identically on all the processes
+    optimizer._round_generators = {}
+    if flat_state:
+        # An instance method (rather than step hooks), since the step runs once per chunk; LR schedulers wrap it as usual
+        optimizer.step = types.MethodType(_flat_state_step, optimizer)
+        optimizer.register_load_state_dict_post_hook(_flat_state_load)
+
+
+def _point(states, key, buffer, shapes):
+    # Replaces state[key] of each state with its view into buffer
+    sizes = [math.prod(shape) for shape in shapes]
+    for state, view, shape in zip(states, buffer.split(sizes), shapes):
+        state[key] = view.view(shape)
+
+
+def _flatten_states(optimizer):
+    """
+    The flat buffers, initializing the missing states, and the chunks of the step: (start, end) ranges of the parameters
+    whose moments have at most _FLAT_CHUNK_NUMEL elements (or a single larger parameter). Each buffer is a dict with the
+    key, the buffer, the dtype of the update, the states and shapes of its parameters with their indices and offsets, and
+    the scratch buffer (in the dtype of the update, reused at every step) of the moments stored in a reduced precision.
+    """
+    buckets, params = {}, []
+    for group in optimizer.param_groups:
+        for p in group['params']:
+            if not p.requires_grad:
+                continue
+            state = optimizer.state[p]
+            if len(state) == 0:
+                optimizer._init_state(p, p.data.float(), group, state)
+            for key in _FLAT_KEYS:
+                if key in state:
+                    value = state[key]
+                    dtype = optimizer.state_dtype if key in _MOMENT_KEYS and optimizer.state_dtype is not None else value.dtype
+                    buckets.setdefault((key, dtype, value.dtype, value.device), []).append((state, value, len(params)))
+            params.append(p)
+
+    chunks, start, numel = [], 0, 0
+    for idx, p in enumerate(params):
+        if numel > 0 and numel + p.numel() > _FLAT_CHUNK_NUMEL:
+            chunks.append((start, idx))
+            start, numel = idx, 0
+        numel += p.numel()
+    chunks.append((start, len(params)))
+
+    flat = []
+    for (key, dtype, update_dtype, device), entries in buckets.items():
+        states = [state for state, _, _ in entries]
+        shapes = [value.shape for _, value, _ in entries]
+        buffer = torch.cat([value.reshape(-1).to(dtype) for _, value, _ in entries])
+        _point(states, key, buffer, shapes)
+        bucket = dict(key=key, buffer=buffer, dtype=update_dtype, states=states, shapes=shapes,
+                      indices=[idx for _, _, idx in entries], offsets=np.cumsum([0] + [value.numel() for _, value, _ in entries]).tolist(), scratch=None)
+        if dtype != update_dtype:
+            offsets = bucket['offsets']
+            size = max(offsets[last] - offsets[first] for first, last in (_chunk_entries(bucket, chunk) for chunk in chunks))
+            bucket['scratch'] = torch.empty(size, dtype=update_dtype, device=device)
+        flat.append(bucket)
+    return flat, chunks
+
+
+def _chunk_entries(bucket, chunk):
+    # (first, last) of the entries of a bucket that belong to a chunk of parameters
+    return tuple(bisect.bisect_left(bucket['indices'], idx) for idx in chunk)
+
+
+def _stochastic_round_(work, out, generator):
+    # Copies float32 work to bfloat16 out with stochastic rounding (overwriting work), so that the small updates of the moments are not lost on average
+    if work.dtype != torch.float32 or out.dtype != torch.bfloat16:
+        out.copy_(work)
+        return
+    bits = work.view(torch.int32)
+    bits.add_(torch.randint(1 << 16, work.shape, dtype=torch.int32, device=work.device, generator=generator)).bitwise_and_(-(1 << 16))
+    out.copy_(bits.view(torch.float32))
+
+
+def _flat_state_step(optimizer, *args, **kwargs):
+    """
+    step with flat_state: flattens the states at the first step (and after load_state_dict). With moments stored in a
+    reduced precision, the step runs on one chunk of the parameters at a time: the moments of the chunk are copied to the
+    scratch buffers, updated there and rounded back into the buffers, so that the step holds at most _FLAT_CHUNK_NUMEL
+    elements per moment in the dtype of the update. The closure is evaluated once.
+    """
+    step = type(optimizer).step
+    if optimizer._flat_buckets is None:
+        optimizer._flat_buckets, optimizer._flat_chunks = _flatten_states(optimizer)
+    reduced = [bucket for bucket in optimizer._flat_buckets if bucket['scratch'] is not None]
+    if not reduced:
+        return step(optimizer, *args, **kwargs)
+
+    loss = None
+    closure = kwargs.pop('closure', None)
+    if closure is not None:
+        with torch.enable_grad():
+            loss = closure()
+
+    all_params = [group['params'] for group in optimizer.param_groups]
+    flat_params = [p for params in all_params for p in params if p.requires_grad]
+    try:
+        for chunk in optimizer._flat_chunks:
+            ids = {id(p) for p in flat_params[chunk[0]:chunk[1]]}
+            for group, params in zip(optimizer.param_groups, all_params):
+                group['params'] = [p for p in params if id(p) in ids]
+            work = []
+            for bucket in reduced:
+                first, last = _chunk_entries(bucket, chunk)
+                if first == last:
+                    continue
+                start, end = bucket['offsets'][first], bucket['offsets'][last]
+                stored, scratch = bucket['buffer'][start:end], bucket['scratch'][:end - start]
+                scratch.copy_(stored)
+                _point(bucket['states'][first:last], bucket['key'], scratch, bucket['shapes'][first:last])
+                work.append((bucket, first, last, stored, scratch))
+            step(optimizer, *args, **kwargs)
+            for bucket, first, last, stored, scratch in work:
+                device = stored.device
+                if device not in optimizer._round_generators:
+                    optimizer._round_generators[device] = torch.Generator(device=device).manual_seed(torch.initial_seed())
+                _stochastic_round_(scratch, stored, optimizer._round_generators[device])
+                _point(bucket['states'][first:last], bucket['key'], stored, bucket['shapes'][first:last])
+    finally:
+        for group, params in zip(optimizer.param_groups, all_params):
+            group['params'] = params
+    return loss
+
+
+def _flat_state_load(optimizer):
+    # load_state_dict replaces the states (and casts them to the dtype of the parameters), which are flattened again at the next step
+    optimizer._flat_buckets = None
+
+
 class LRangerMod(Optimizer):
 
     # AMSGrad/Adam + AdaMod + QH Momentum + Iterate Averaging + Lookahead + Rule of Thumb Linear Warmup (instead of RAdam Rectification) + P from PAdam
@@ -24,7 +297,10 @@ class LRangerMod(Optimizer):
                  IA_cycle=1000,
                  epochs=100,
                  step_per_epoch=None,
-                 weight_decay=0):
+                 weight_decay=0,
+                 foreach=False,
+                 flat_state=False,
+                 state_dtype=None):
 
         # betas = (beta1 for first order moments, beta2 for second order moments, beta3 for ema over adaptive learning rates (AdaMod))
         # nus = (nu1,nu2) (for quasi hyperbolic momentum)
@@ -38,6 +314,9 @@ class LRangerMod(Optimizer):
         # epochs = No. of epochs you plan to use (Only relevant if using DEMON)
         # step_per_epoch = No. of iterations in an epoch (only relevant if using DEMON)
         # weight decay = decorrelated weight decay value
+        # foreach = bool to decide whether to update all the parameters at once with torch._foreach_* ops (same update, fewer kernel launches)
+        # flat_state = bool to decide whether to keep the moments and the lookahead cache in flat contiguous buffers
+        # state_dtype = dtype in which flat_state stores the moments (e.g. torch.bfloat16), None for the dtype of the parameters
 
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
@@ -63,6 +342,7 @@ class LRangerMod(Optimizer):
         if not 0.0 <= alpha <= 1.0:
             raise ValueError("Invalid alpha parameter: {}".format(alpha))
 
+        self.foreach = foreach
         self.k = k
         self.epochs = epochs
         self.amsgrad = amsgrad
@@ -88,6 +368,7 @@ class LRangerMod(Optimizer):
                         alpha=alpha,
                         weight_decay=weight_decay)
         super(LRangerMod, self).__init__(params, defaults)
+        _init_flat_state(self, flat_state, state_dtype)
 
     def __setstate__(self, state):
         super(LRangerMod, self).__setstate__(state)
@@ -102,12 +383,28 @@ class LRangerMod(Optimizer):
             torch.min(n, n_avg, out=n)
         return n
 
+    def _init_state(self, p, grad, group, state):
+        state['step'] = 0
+        state['exp_avg'] = torch.zeros_like(p.data)
+        state['exp_avg_sq'] = torch.zeros_like(p.data)
+        state['num_models'] = 0
+        if self.IA or (self.k > 0):
+            state['cached_params'] = p.data.clone()
+        if self.amsgrad:
+            state['max_exp_avg_sq'] = torch.zeros_like(p.data)
+        if self.AdaMod:
+            state['n_avg'] = torch.zeros_like(p.data)
+
     def step(self, activate_IA=False, closure=None):
 
         loss = None
         if closure is not None:
             loss = closure()
 
+        if self.foreach:
+            self._step_foreach(activate_IA)
+            return loss
+
         for group in self.param_groups:
 
             for p in group['params']:
@@ -121,15 +418,7 @@ class LRangerMod(Optimizer):
                 state = self.state[p]
 
                 if len(state) == 0:
-                    state['step'] = 0
-                    state['exp_avg'] = torch.zeros_like(p.data)
-                    state['exp_avg_sq'] = torch.zeros_like(p.data)
-                    state['num_models'] = 0
-                    state['cached_params'] = p.data.clone()
-                    if self.amsgrad:
-                        state['max_exp_avg_sq'] = torch.zeros_like(p.data)
-                    if self.AdaMod:
-                        state['n_avg'] = torch.zeros_like(p.data)
+                    self._init_state(p, grad, group, state)
 
                 state['step'] += 1
 
@@ -211,6 +500,62 @@ class LRangerMod(Optimizer):
         return loss
 
 
+    def _step_foreach(self, activate_IA):
+        # The update of step with torch._foreach_* ops, for all the parameters that share a step count at once
+        for group in self.param_groups:
+            beta1, beta2, beta3 = group['betas']
+            nu1, nu2 = group['nus']
+            wd = group['weight_decay']
+
+            for params, grads, states in _foreach_buckets(self, group):
+                for state in states:
+                    state['step'] += 1
+                step = states[0]['step']
+                w = min([1.0, step / self.warmup_period])
+                lr = w * group['lr'] if self.warmup else group['lr']
+                lookahead_step, do_IA = _averaging_steps(self, step, activate_IA)
+
+                if self.use_gc:
+                    for grad in grads:
+                        if grad.view(-1).size(0) > 1:
+                            grad.add_(-grad.mean(dim=tuple(range(1, len(list(grad.size())))), keepdim=True))
+
+                exp_avgs = [state['exp_avg'] for state in states]
+                exp_avg_sqs = [state['exp_avg_sq'] for state in states]
+                torch._foreach_mul_(exp_avg_sqs, beta2)
+                torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+                torch._foreach_mul_(exp_avgs, beta1)
+                torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+
+                momentum = torch._foreach_div(exp_avgs, 1 - (beta1 ** step))
+                torch._foreach_mul_(momentum, nu1)
+                torch._foreach_add_(momentum, grads, alpha=1 - nu1)
+
+                if wd != 0:
+                    torch._foreach_add_(params, params, alpha=-wd * lr)
+
+                if self.amsgrad and step > 1:
+                    max_exp_avg_sqs = [state['max_exp_avg_sq'] for state in states]
+                    torch._foreach_maximum_(max_exp_avg_sqs, exp_avg_sqs)
+                    vt = torch._foreach_div(max_exp_avg_sqs, 1 - beta2 ** step)
+                else:
+                    vt = torch._foreach_div(exp_avg_sqs, 1 - beta2 ** step)
+                if nu2 != 1.0:
+                    torch._foreach_mul_(vt, nu2)
+                    torch._foreach_addcmul_(vt, grads, grads, value=1 - nu2)
+                torch._foreach_pow_(vt, group['p'])
+                torch._foreach_add_(vt, group['eps'])
+                n = torch._foreach_reciprocal(vt)
+                torch._foreach_mul_(n, lr)
+                if self.AdaMod:
+                    _foreach_AdaMod([state['n_avg'] for state in states], n, beta3, step, self.AdaMod_bias_correct)
+
+                torch._foreach_mul_(n, momentum)
+                torch._foreach_sub_(params, n)
+
+                _foreach_average(params, states, lookahead_step, do_IA, group['alpha'])
+
+
 class DemonRanger(Optimizer):
 
     # Rectified-AMSGrad/RAdam + AdaMod + QH Momentum + Iterat Averaging + Lookahead + DEMON (decaying Momentum) + gradient centralization + grad noise
@@ -235,7 +580,10 @@ class DemonRanger(Optimizer):
                  use_gc=True,
                  use_grad_noise=False,
                  use_diffgrad=False,
-                 dropout=0.0):
+                 dropout=0.0,
+                 foreach=False,
+                 flat_state=False,
+                 state_dtype=None):
 
         # betas = (beta1 for first order moments, beta2 for second order moments, beta3 for ema over adaptive learning rates (AdaMod))
         # nus = (nu1,nu2) (for quasi hyperbolic momentum)
@@ -256,6 +604,9 @@ class DemonRanger(Optimizer):
         # use_grad_noise = bool to determine whether to use gradient noise or not.
         # use_diffgrad = bool to determine whether to use diffgrad or not.
         # dropout = learning rate dropout, probability of setting learning rate to zero
+        # foreach = bool to decide whether to update all the parameters at once with torch._foreach_* ops (same update, fewer kernel launches)
+        # flat_state = bool to decide whether to keep the moments and the lookahead cache in flat contiguous buffers
+        # state_dtype = dtype in which flat_state stores the moments (e.g. torch.bfloat16), None for the dtype of the parameters
 
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
@@ -284,6 +635,7 @@ class DemonRanger(Optimizer):
         self.use_gc = use_gc
         self.use_grad_noise = use_grad_noise
         self.use_diffgrad = use_diffgrad
+        self.foreach = foreach
         self.k = k
         self.epochs = epochs
         self.amsgrad = amsgrad
@@ -309,6 +661,7 @@ class DemonRanger(Optimizer):
                         weight_decay=weight_decay,
                         dropout=dropout)
         super(DemonRanger, self).__init__(params, defaults)
+        _init_flat_state(self, flat_state, state_dtype)
 
     def __setstate__(self, state):
         super(DemonRanger, self).__setstate__(state)
@@ -323,12 +676,30 @@ class DemonRanger(Optimizer):
             torch.min(n, n_avg, out=n)
         return n
 
+    def _init_state(self, p, grad, group, state):
+        state['step'] = 0
+        state['exp_avg'] = torch.zeros_like(p.data)
+        state['exp_avg_sq'] = torch.zeros_like(p.data)
+        if self.use_diffgrad:
+            state['previous_grad'] = torch.zeros_like(p.data)
+        state['num_models'] = 0
+        if self.IA or (self.k > 0):
+            state['cached_params'] = p.data.clone()
+        if self.amsgrad:
+            state['max_exp_avg_sq'] = torch.zeros_like(p.data)
+        if self.AdaMod:
+            state['n_avg'] = torch.zeros_like(p.data)
+
     def step(self, activate_IA=False, closure=None):
 
         loss = None
         if closure is not None:
             loss = closure()
 
+        if self.foreach:
+            self._step_foreach(activate_IA)
+            return loss
+
         for group in self.param_groups:
 
             for p in group['params']:
@@ -342,17 +713,7 @@ class DemonRanger(Optimizer):
                 state = self.state[p]
 
                 if len(state) == 0:
-                    state['step'] = 0
-                    state['exp_avg'] = torch.zeros_like(p.data)
-                    state['exp_avg_sq'] = torch.zeros_like(p.data)
-                    if self.use_diffgrad:
-                        state['previous_grad'] = torch.zeros_like(p.data)
-                    state['num_models'] = 0
-                    state['cached_params'] = p.data.clone()
-                    if self.amsgrad:
-                        state['max_exp_avg_sq'] = torch.zeros_like(p.data)
-                    if self.AdaMod:
-                        state['n_avg'] = torch.zeros_like(p.data)
+                    self._init_state(p, grad, group, state)
 
                 state['step'] += 1
                 exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
@@ -402,7 +763,7 @@ class DemonRanger(Optimizer):
                     previous_grad = state['previous_grad']
                     diff = abs(previous_grad - grad)
                     dfc = 1. / (1. + torch.exp(-diff))
-                    state['previous_grad'] = grad.clone()
+                    state['previous_grad'].copy_(grad)
                     exp_avg = exp_avg * dfc
 
                 momentum = exp_avg.clone()
@@ -487,6 +848,98 @@ class DemonRanger(Optimizer):
         return loss
 
 
+    def _step_foreach(self, activate_IA):
+        # The update of step with torch._foreach_* ops, for all the parameters that share a step count at once.
+        # The gradient noise and the learning rate dropout masks are drawn for all of them at once.
+        for group in self.param_groups:
+            beta1_init, beta2, beta3 = group['betas']
+            rho_inf = (2 / (1 - beta2)) - 1
+            nu1, nu2 = group['nus']
+            lr = group['lr']
+            wd = group['weight_decay']
+            gamma = group['gamma']
+
+            for params, grads, states in _foreach_buckets(self, group):
+                for state in states:
+                    state['step'] += 1
+                step = states[0]['step']
+                lookahead_step, do_IA = _averaging_steps(self, step, activate_IA)
+
+                if self.use_demon:
+                    temp = 1 - (step / self.T)
+                    beta1 = beta1_init * temp / \
+                        ((1 - beta1_init) + beta1_init * temp)
+                else:
+                    beta1 = beta1_init
+
+                if self.use_grad_noise:
+                    grad_var = lr / ((1 + step)**gamma)
+                    torch._foreach_add_(grads, _normal_like(grads, math.sqrt(grad_var)))
+
+                if self.use_gc:
+                    _centralize(grads)
+
+                exp_avgs = [state['exp_avg'] for state in states]
+                exp_avg_sqs = [state['exp_avg_sq'] for state in states]
+                torch._foreach_mul_(exp_avg_sqs, beta2)
+                torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+                torch._foreach_mul_(exp_avgs, beta1)
+                torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+
+                if self.use_diffgrad:
+                    exp_avgs = _diffgrad(exp_avgs, grads, states)
+
+                momentum = torch._foreach_div(exp_avgs, 1 - (beta1 ** step))
+                torch._foreach_mul_(momentum, nu1)
+                torch._foreach_add_(momentum, grads, alpha=1 - nu1)
+
+                if wd != 0:
+                    torch._foreach_add_(params, params, alpha=-wd * lr)
+
+                beta2_t = beta2 ** step
+
+                if self.amsgrad and step > 1:
+                    vt = [state['max_exp_avg_sq'] for state in states]
+                    torch._foreach_maximum_(vt, exp_avg_sqs)
+                else:
+                    vt = exp_avg_sqs
+
+                R = 1.
+                if self.rectify:
+                    rho_t = rho_inf - 2 * step * beta2_t / (1 - beta2_t)
+                    if rho_t >= 5:
+                        R = math.sqrt(((rho_t - 4) * (rho_t - 2) * rho_inf) /
+                                      ((rho_inf - 4) * (rho_inf - 2) * rho_t))
+
+                if self.rectify and rho_t < 5:
+                    if self.AdaMod:
+                        n_avgs = [state['n_avg'] for state in states]
+                        torch._foreach_mul_(n_avgs, beta3)
+                        torch._foreach_add_(n_avgs, (1 - beta3) * lr)
+                    torch._foreach_add_(params, momentum, alpha=-lr)
+                else:
+                    vt = torch._foreach_div(vt, 1 - beta2_t)
+                    if nu2 != 1.0:
+                        torch._foreach_mul_(vt, nu2)
+                        torch._foreach_addcmul_(vt, grads, grads, value=1 - nu2)
+                    torch._foreach_sqrt_(vt)
+                    torch._foreach_add_(vt, group['eps'])
+                    n = torch._foreach_reciprocal(vt)
+                    torch._foreach_mul_(n, lr * R)
+                    if self.AdaMod:
+                        _foreach_AdaMod([state['n_avg'] for state in states], n, beta3, step, self.AdaMod_bias_correct)
+
+                    if group['dropout'] > 0.0:
+                        sizes = [p.numel() for p in params]
+                        masks = torch.bernoulli(torch.full((sum(sizes),), 1 - group['dropout'], dtype=params[0].dtype, device=params[0].device))
+                        torch._foreach_mul_(n, [mask.view_as(p) for mask, p in zip(masks.split(sizes), params)])
+
+                    torch._foreach_mul_(n, momentum)
+                    torch._foreach_sub_(params, n)
+
+                _foreach_average(params, states, lookahead_step, do_IA, group['alpha'])
+
+
 class HyperRanger(Optimizer):
 
     # Nostalgic PAdam + QH Momentum + Iterate Averaging + Lookahead + DEMON (decaying Momentum) + gradient centralization + hypergradient descent on lr and nu1
@@ -510,7 +963,10 @@ class HyperRanger(Optimizer):
                  step_per_epoch=None,
                  weight_decay=0,
                  use_gc=True,
-                 use_diffgrad=False):
+                 use_diffgrad=False,
+                 foreach=False,
+                 flat_state=False,
+                 state_dtype=None):
 
         # betas = (beta1 for first order moments, beta2 for second order moments)
         # nus = (nu1,nu2) (for quasi hyperbolic momentum)
@@ -531,6 +987,9 @@ class HyperRanger(Optimizer):
         # weight decay = decorrelated weight decay value
         # use_gc = bool to determine whether to use gradient centralization or not.
         # use_diffgrad = bool to determine whether to use diffgrad or not.
+        # foreach = bool to decide whether to update all the parameters at once with torch._foreach_* ops (same update, fewer kernel launches)
+        # flat_state = bool to decide whether to keep the moments and the lookahead cache in flat contiguous buffers
+        # state_dtype = dtype in which flat_state stores the moments (e.g. torch.bfloat16), None for the dtype of the parameters
 
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
@@ -558,6 +1017,7 @@ class HyperRanger(Optimizer):
 
         self.nostalgia = nostalgia
         self.use_demon = use_demon
+        self.foreach = foreach
         self.k = k
         self.IA = IA
         self.IA_cycle = IA_cycle
@@ -583,16 +1043,45 @@ class HyperRanger(Optimizer):
                         hypergrad_lr=hypergrad_lr,
                         weight_decay=weight_decay)
         super(HyperRanger, self).__init__(params, defaults)
+        _init_flat_state(self, flat_state, state_dtype)
 
     def __setstate__(self, state):
         super(HyperRanger, self).__setstate__(state)
 
+    def _init_state(self, p, grad, group, state):
+        hypergrad_lr = group['hypergrad_lr']
+        state['step'] = 0
+        state['exp_avg'] = torch.zeros_like(p.data)
+        state['exp_avg_sq'] = torch.zeros_like(p.data)
+        if self.use_diffgrad:
+            state['previous_grad'] = torch.zeros_like(p.data)
+        state['lr'] = group['lr']
+
+        if self.IA:
+            state['num_models'] = 0
+        if self.IA or (self.k > 0):
+            state['cached_params'] = p.data.clone()
+        if self.nostalgia:
+            state['B_old'] = 0
+            state['B_new'] = 1
+        if hypergrad_lr > 0.0:
+            state['nu1'] = group['nu1']
+            state['prev_lr_grad'] = torch.zeros_like(grad.view(-1))
+            if self.hypertune_nu1:
+
+                state['prev_nu_grad'] = torch.zeros_like(
+                    grad.view(-1))
+
     def step(self, activate_IA=False, display=False, closure=None):
 
         loss = None
         if closure is not None:
             loss = closure()
 
+        if self.foreach:
+            self._step_foreach(activate_IA, display)
+            return loss
+
         for group in self.param_groups:
 
             for p in group['params']:
@@ -612,27 +1101,7 @@ class HyperRanger(Optimizer):
                 gamma = group['gamma']
 
                 if len(state) == 0:
-                    state['step'] = 0
-                    state['exp_avg'] = torch.zeros_like(p.data)
-                    state['exp_avg_sq'] = torch.zeros_like(p.data)
-                    if self.use_diffgrad:
-                        state['previous_grad'] = torch.zeros_like(p.data)
-                    state['lr'] = group['lr']
-
-                    if self.IA:
-                        state['num_models'] = 0
-                    if self.IA or (self.k > 0):
-                        state['cached_params'] = p.data.clone()
-                    if self.nostalgia:
-                        state['B_old'] = 0
-                        state['B_new'] = 1
-                    if hypergrad_lr > 0.0:
-                        state['nu1'] = group['nu1']
-                        state['prev_lr_grad'] = torch.zeros_like(grad.view(-1))
-                        if self.hypertune_nu1:
-
-                            state['prev_nu_grad'] = torch.zeros_like(
-                                grad.view(-1))
+                    self._init_state(p, grad, group, state)
 
                 state['step'] += 1
                 exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
@@ -714,7 +1183,7 @@ class HyperRanger(Optimizer):
                     previous_grad = state['previous_grad']
                     diff = abs(previous_grad - grad)
                     dfc = 1. / (1. + torch.exp(-diff))
-                    state['previous_grad'] = grad.clone()
+                    state['previous_grad'].copy_(grad)
                     exp_avg = exp_avg * dfc
 
                 momentum = exp_avg.clone()
@@ -769,6 +1238,123 @@ class HyperRanger(Optimizer):
         return loss
 
 
+    def _step_foreach(self, activate_IA, display):
+        # The update of step with torch._foreach_* ops, for all the parameters that share a step count at once.
+        # The per-parameter learning rates (and nu1) are updated as one vector.
+        for group in self.param_groups:
+            hypergrad_lr = group['hypergrad_lr']
+            beta1_init, beta2 = group['betas']
+            wd = group['weight_decay']
+            alpha = group['alpha']
+            gamma = group['gamma']
+
+            for params, grads, states in _foreach_buckets(self, group):
+                for state in states:
+                    state['step'] += 1
+                step = states[0]['step']
+                exp_avgs = [state['exp_avg'] for state in states]
+                exp_avg_sqs = [state['exp_avg_sq'] for state in states]
+                flat_grads = [grad.view(-1) for grad in grads]
+
+                if self.use_demon:
+                    temp = 1 - (step / self.T)
+                    beta1 = beta1_init * temp / \
+                        ((1 - beta1_init) + beta1_init * temp)
+                else:
+                    beta1 = beta1_init
+
+                if self.nostalgia:
+                    beta2 = states[0]['B_old'] / states[0]['B_new']
+                    for state in states:
+                        state['B_old'] += math.pow(step, -gamma)
+                        state['B_new'] += math.pow(step + 1, -gamma)
+
+                lookahead_step, do_IA = _averaging_steps(self, step, activate_IA)
+
+                if step > 1 and hypergrad_lr > 0.0:
+                    grad_norms = torch.stack(torch._foreach_norm(flat_grads)) if self.HDM else None
+                    lrs = _hyperupdate([state['lr'] for state in states], flat_grads, [state['prev_lr_grad'] for state in states],
+                                       hypergrad_lr, group['eps'], self.HDM, grad_norms).clamp_(min=0)
+                    for state, lr in zip(states, lrs.unbind()):
+                        state['lr'] = lr
+
+                    if display:
+                        print("lr", lrs)
+
+                    if self.hypertune_nu1:
+                        nus = _hyperupdate([state['nu1'] for state in states], flat_grads, [state['prev_nu_grad'] for state in states],
+                                           hypergrad_lr, group['eps'], self.HDM, grad_norms).clamp_(0, 1)
+                        for state, nu1 in zip(states, nus.unbind()):
+                            state['nu1'] = nu1
+
+                    if display:
+                        print("nu", [state['nu1'] for state in states])
+
+                if self.use_gc:
+                    _centralize(grads)
+
+                lrs = _scalars([state['lr'] for state in states])
+                nu1s = _scalars([state['nu1'] for state in states])
+                nu2 = group['nu2']
+                torch._foreach_mul_(exp_avg_sqs, beta2)
+                torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+                torch._foreach_mul_(exp_avgs, beta1)
+                torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+
+                if self.use_diffgrad:
+                    exp_avgs = _diffgrad(exp_avgs, grads, states)
+
+                momentum = torch._foreach_div(exp_avgs, 1 - (beta1 ** step))
+
+                if not self.nostalgia:
+                    vt = torch._foreach_div(exp_avg_sqs, 1 - (beta2 ** step))
+                else:
+                    vt = [exp_avg_sq.clone() for exp_avg_sq in exp_avg_sqs]
+                if nu2 != 1.0:
+                    torch._foreach_mul_(vt, nu2)
+                    torch._foreach_addcmul_(vt, grads, grads, value=1 - nu2)
+
+                torch._foreach_pow_(vt, group['p'])
+                torch._foreach_add_(vt, group['eps'])
+                denom = vt
+
+                n = torch._foreach_reciprocal(denom)
+                torch._foreach_mul_(n, lrs)
+
+                if lookahead_step:
+                    dalpha = alpha
+                elif do_IA:
+                    dalpha = (1 / (states[0]["num_models"] + 1.0))
+                else:
+                    dalpha = 1.0
+
+                if hypergrad_lr > 0.0 and self.hypertune_nu1:
+                    prev_nu_grads = torch._foreach_mul(n, -dalpha)
+                    torch._foreach_mul_(prev_nu_grads, torch._foreach_sub(momentum, grads))
+                    for state, prev_nu_grad in zip(states, prev_nu_grads):
+                        state['prev_nu_grad'] = prev_nu_grad.view(-1)
+
+                # quasi hyperbolic momentum
+                torch._foreach_mul_(momentum, nu1s)
+                torch._foreach_add_(momentum, torch._foreach_mul(grads, [1 - nu1 for nu1 in nu1s]))
+
+                if hypergrad_lr > 0.0:
+                    temps = torch._foreach_div(momentum, denom)
+                    torch._foreach_neg_(temps)
+                    torch._foreach_sub_(temps, torch._foreach_mul(params, wd))
+                    torch._foreach_mul_(temps, dalpha)
+                    for state, temp in zip(states, temps):
+                        state['prev_lr_grad'] = temp.view(-1)
+
+                torch._foreach_mul_(n, momentum)
+                torch._foreach_sub_(params, n)
+
+                if wd != 0:
+                    torch._foreach_add_(params, torch._foreach_mul(params, [-wd * lr for lr in lrs]))
+
+                _foreach_average(params, states, lookahead_step, do_IA, alpha)
+
+
 class HyperRangerMod(Optimizer):
 
     # Different from HyperRanger integrates AdaMod, and hypergradient descent through it. Slower, however.
@@ -792,7 +1378,10 @@ class HyperRangerMod(Optimizer):
                  step_per_epoch=None,
                  weight_decay=0,
                  use_gc=True,
-                 use_diffgrad=False):
+                 use_diffgrad=False,
+                 foreach=False,
+                 flat_state=False,
+                 state_dtype=None):
 
         # betas = (beta1 for first order moments, beta2 for second order moments, beta3 for AdaMod) # set beta3 = 0 to disable AdaMod
         # nus = (nu1,nu2) (for quasi hyperbolic momentum)
@@ -814,6 +1403,9 @@ class HyperRangerMod(Optimizer):
         # weight decay = decorrelated weight decay value
         # use_gc = bool to determine whether to use gradient centralization or not.
         # use_diffgrad = bool to determine whether to use diffgrad or not.
+        # foreach = bool to decide whether to update all the parameters at once with torch._foreach_* ops (same update, fewer kernel launches)
+        # flat_state = bool to decide whether to keep the moments and the lookahead cache in flat contiguous buffers
+        # state_dtype = dtype in which flat_state stores the moments (e.g. torch.bfloat16), None for the dtype of the parameters
 
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
@@ -845,6 +1437,7 @@ class HyperRangerMod(Optimizer):
         self.AdaMod_bias_correct = AdaMod_bias_correct
         self.nostalgia = nostalgia
         self.use_demon = use_demon
+        self.foreach = foreach
         self.k = k
         self.IA = IA
         self.IA_cycle = IA_cycle
@@ -867,16 +1460,44 @@ class HyperRangerMod(Optimizer):
                         hypergrad_lr=hypergrad_lr,
                         weight_decay=weight_decay)
         super(HyperRangerMod, self).__init__(params, defaults)
+        _init_flat_state(self, flat_state, state_dtype)
 
     def __setstate__(self, state):
         super(HyperRangerMod, self).__setstate__(state)
 
+    def _init_state(self, p, grad, group, state):
+        hypergrad_lr = group['hypergrad_lr']
+        beta3 = group['betas'][2]
+        state['step'] = 0
+        state['exp_avg'] = torch.zeros_like(p.data)
+        state['exp_avg_sq'] = torch.zeros_like(p.data)
+        if self.use_diffgrad:
+            state['previous_grad'] = torch.zeros_like(p.data)
+        state['lr'] = group['lr']
+
+        if self.IA:
+            state['num_models'] = 0
+        if self.IA or self.k > 0:
+            state['cached_params'] = p.data.clone()
+        if beta3 > 0.0:
+            state['n_avg'] = torch.zeros_like(p.data)
+        if self.nostalgia:
+            state['B_old'] = 0
+            state['B_new'] = 1
+        if hypergrad_lr > 0.0:
+            state['cached_hypergrad_comp'] = torch.zeros_like(
+                grad.view(-1))
+
     def step(self, display=False, activate_IA=False, closure=None):
 
         loss = None
         if closure is not None:
             loss = closure()
 
+        if self.foreach:
+            self._step_foreach(activate_IA, display)
+            return loss
+
         for group in self.param_groups:
 
             for p in group['params']:
@@ -897,25 +1518,7 @@ class HyperRangerMod(Optimizer):
                 gamma = group['gamma']
 
                 if len(state) == 0:
-                    state['step'] = 0
-                    state['exp_avg'] = torch.zeros_like(p.data)
-                    state['exp_avg_sq'] = torch.zeros_like(p.data)
-                    if self.use_diffgrad:
-                        state['previous_grad'] = torch.zeros_like(p.data)
-                    state['lr'] = group['lr']
-
-                    if self.IA:
-                        state['num_models'] = 0
-                    if self.IA or self.k > 0:
-                        state['cached_params'] = p.data.clone()
-                    if beta3 > 0.0:
-                        state['n_avg'] = torch.zeros_like(p.data)
-                    if self.nostalgia:
-                        state['B_old'] = 0
-                        state['B_new'] = 1
-                    if hypergrad_lr > 0.0:
-                        state['cached_hypergrad_comp'] = torch.zeros_like(
-                            grad.view(-1))
+                    self._init_state(p, grad, group, state)
 
                 state['step'] += 1
                 exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
@@ -966,7 +1569,7 @@ class HyperRangerMod(Optimizer):
                     previous_grad = state['previous_grad']
                     diff = abs(previous_grad - grad)
                     dfc = 1. / (1. + torch.exp(-diff))
-                    state['previous_grad'] = grad.clone()
+                    state['previous_grad'].copy_(grad)
                     exp_avg = exp_avg * dfc
 
                 momentum = exp_avg.clone()
@@ -1045,6 +1648,122 @@ class HyperRangerMod(Optimizer):
         return loss
 
 
+    def _step_foreach(self, activate_IA, display):
+        # The update of step with torch._foreach_* ops, for all the parameters that share a step count at once.
+        # The per-parameter learning rates are updated as one vector.
+        for group in self.param_groups:
+            hypergrad_lr = group['hypergrad_lr']
+            beta1_init, beta2, beta3 = group['betas']
+            nu1, nu2 = group['nus']
+            wd = group['weight_decay']
+            alpha = group['alpha']
+            gamma = group['gamma']
+
+            for params, grads, states in _foreach_buckets(self, group):
+                for state in states:
+                    state['step'] += 1
+                step = states[0]['step']
+                exp_avgs = [state['exp_avg'] for state in states]
+                exp_avg_sqs = [state['exp_avg_sq'] for state in states]
+
+                if self.use_demon:
+                    temp = 1 - (step / self.T)
+                    beta1 = beta1_init * temp / \
+                        ((1 - beta1_init) + beta1_init * temp)
+                else:
+                    beta1 = beta1_init
+
+                if self.nostalgia:
+                    beta2 = states[0]['B_old'] / states[0]['B_new']
+                    for state in states:
+                        state['B_old'] += math.pow(step, -gamma)
+                        state['B_new'] += math.pow(step + 1, -gamma)
+
+                lookahead_step, do_IA = _averaging_steps(self, step, activate_IA)
+
+                if step > 1 and hypergrad_lr > 0.0:
+                    lrs = _hyperupdate([state['lr'] for state in states], [grad.view(-1) for grad in grads],
+                                       [state['cached_hypergrad_comp'] for state in states], hypergrad_lr, group['eps'], False).clamp_(min=0)
+                    for state, lr in zip(states, lrs.unbind()):
+                        state['lr'] = lr
+                    if display:
+                        print(lrs)
+
+                if self.use_gc:
+                    _centralize(grads)
+
+                torch._foreach_mul_(exp_avg_sqs, beta2)
+                torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+                torch._foreach_mul_(exp_avgs, beta1)
+                torch._foreach_add_(exp_avgs, grads, alpha=1 - beta1)
+
+                if self.use_diffgrad:
+                    exp_avgs = _diffgrad(exp_avgs, grads, states)
+
+                momentum = torch._foreach_div(exp_avgs, 1 - (beta1 ** step))
+                torch._foreach_mul_(momentum, nu1)
+                torch._foreach_add_(momentum, grads, alpha=1 - nu1)
+
+                if not self.nostalgia:
+                    vt = torch._foreach_div(exp_avg_sqs, 1 - (beta2 ** step))
+                else:
+                    vt = [exp_avg_sq.clone() for exp_avg_sq in exp_avg_sqs]
+                if nu2 != 1.0:
+                    torch._foreach_mul_(vt, nu2)
+                    torch._foreach_addcmul_(vt, grads, grads, value=1 - nu2)
+
+                torch._foreach_pow_(vt, group['p'])
+                torch._foreach_add_(vt, group['eps'])
+                denom = vt
+
+                lrs = _scalars([state['lr'] for state in states])
+                n = torch._foreach_reciprocal(denom)
+                torch._foreach_mul_(n, lrs)
+
+                if beta3 > 0.0:  # apply AdaMod
+                    n_avgs = [state['n_avg'] for state in states]
+                    torch._foreach_mul_(n_avgs, beta3)
+                    torch._foreach_add_(n_avgs, n, alpha=1 - beta3)
+                    if self.AdaMod_bias_correct:
+                        bias_correction3 = 1 - (beta3 ** step)
+                        n_avgs_ = torch._foreach_div(n_avgs, bias_correction3)
+                        torch._foreach_minimum_(n, n_avgs_)
+                    else:
+                        torch._foreach_minimum_(n, n_avgs)
+
+                torch._foreach_sub_(params, torch._foreach_mul(n, momentum))
+
+                if lookahead_step:
+                    dalpha = alpha
+                elif do_IA:
+                    dalpha = (1 / (states[0]["num_models"] + 1.0))
+                else:
+                    dalpha = 1.0
+
+                if hypergrad_lr > 0.0:
+                    # dalpha * (-c * (momentum / denom) - wd * p), with c = 1 for the learning rates that AdaMod did not bound
+                    ratio = torch._foreach_div(momentum, denom)
+                    decay = torch._foreach_mul(params, wd)
+                    grad_from_n = torch._foreach_neg(ratio)
+                    torch._foreach_sub_(grad_from_n, decay)
+                    torch._foreach_mul_(grad_from_n, dalpha)
+                    dus = grad_from_n
+                    if beta3 > 0.0:
+                        c = (1 - beta3) / bias_correction3 if self.AdaMod_bias_correct else 1 - beta3
+                        grad_from_n_avg = torch._foreach_mul(ratio, -c)
+                        torch._foreach_sub_(grad_from_n_avg, decay)
+                        torch._foreach_mul_(grad_from_n_avg, dalpha)
+                        bounds = n_avgs_ if self.AdaMod_bias_correct else n_avgs
+                        dus = [torch.where(bound < n_, from_avg, from_n) for bound, n_, from_avg, from_n in zip(bounds, n, grad_from_n_avg, grad_from_n)]
+                    for state, du in zip(states, dus):
+                        state['cached_hypergrad_comp'] = du.view(-1)
+
+                if wd != 0:
+                    torch._foreach_add_(params, torch._foreach_mul(params, [-wd * lr for lr in lrs]))
+
+                _foreach_average(params, states, lookahead_step, do_IA, alpha)
+
+
 class HDQHSGDW(Optimizer):
     def __init__(self, params, lr=1e-3,
                  beta=0.999,
@@ -1056,11 +1775,17 @@ class HDQHSGDW(Optimizer):
                  eps=1e-8,
                  weight_decay=0,
                  use_gc=True,
-                 use_diffgrad=False):
+                 use_diffgrad=False,
+                 foreach=False,
+                 flat_state=False,
+                 state_dtype=None):
 
         # BASIC SGD + Momentum but with QHMomentum and Hypergradient descent over all beta, lr, and nu + Lookahead and decorrelated weight decay
         # they say the best of them all is still SGD + Momentum?
         # use_diffgrad = bool to determine whether to use diffgrad or not.
+        # foreach = bool to decide whether to update all the parameters at once with torch._foreach_* ops (same update, fewer kernel launches)
+        # flat_state = bool to decide whether to keep the moments and the lookahead cache in flat contiguous buffers
+        # state_dtype = dtype in which flat_state stores the moments (e.g. torch.bfloat16), None for the dtype of the parameters
 
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
@@ -1074,6 +1799,7 @@ class HDQHSGDW(Optimizer):
         if not 0.0 <= alpha <= 1.0:
             raise ValueError("Invalid alpha parameter: {}".format(alpha))
 
+        self.foreach = foreach
         self.k = k
         self.use_gc = use_gc
         self.use_diffgrad = use_diffgrad
@@ -1087,6 +1813,7 @@ class HDQHSGDW(Optimizer):
                         eps=eps,
                         weight_decay=weight_decay)
         super(HDQHSGDW, self).__init__(params, defaults)
+        _init_flat_state(self, flat_state, state_dtype)
 
     def __setstate__(self, state):
         super(HDQHSGDW, self).__setstate__(state)
@@ -1104,12 +1831,33 @@ class HDQHSGDW(Optimizer):
 
         return update
 
+    def _init_state(self, p, grad, group, state):
+        hypergrad_lr = group['hypergrad_lr']
+        state['step'] = 0
+        state['lr'] = group['lr']
+        state['nu'] = group['nu']
+        state['beta'] = group['beta']
+        state['exp_avg'] = torch.zeros_like(p.data)
+        if self.use_diffgrad:
+            state['previous_grad'] = torch.zeros_like(p.data)
+        if self.k > 0:
+            state['cached_params'] = p.data.clone()
+        if hypergrad_lr > 0.0:
+            state['prev_lr_grad'] = torch.zeros_like(grad.view(-1))
+            state['prev_nu_grad'] = torch.zeros_like(grad.view(-1))
+            state['prev_beta_grad'] = torch.zeros_like(
+                grad.view(-1))
+
     def step(self, display=False, closure=None):
 
         loss = None
         if closure is not None:
             loss = closure()
 
+        if self.foreach:
+            self._step_foreach(display)
+            return loss
+
         for group in self.param_groups:
 
             for p in group['params']:
@@ -1127,20 +1875,7 @@ class HDQHSGDW(Optimizer):
                 alpha = group['alpha']
 
                 if len(state) == 0:
-                    state['step'] = 0
-                    state['lr'] = group['lr']
-                    state['nu'] = group['nu']
-                    state['beta'] = group['beta']
-                    state['exp_avg'] = torch.zeros_like(p.data)
-                    if self.use_diffgrad:
-                        state['previous_grad'] = torch.zeros_like(p.data)
-                    if self.k > 0:
-                        state['cached_params'] = p.data.clone()
-                    if hypergrad_lr > 0.0:
-                        state['prev_lr_grad'] = torch.zeros_like(grad.view(-1))
-                        state['prev_nu_grad'] = torch.zeros_like(grad.view(-1))
-                        state['prev_beta_grad'] = torch.zeros_like(
-                            grad.view(-1))
+                    self._init_state(p, grad, group, state)
 
                 state['step'] += 1
                 exp_avg = state['exp_avg']
@@ -1149,7 +1884,7 @@ class HDQHSGDW(Optimizer):
                     previous_grad = state['previous_grad']
                     diff = abs(previous_grad - grad)
                     dfc = 1. / (1. + torch.exp(-diff))
-                    state['previous_grad'] = grad.clone()
+                    state['previous_grad'].copy_(grad)
                     exp_avg = exp_avg * dfc
 
                 lookahead_step = False
@@ -1258,6 +1993,96 @@ class HDQHSGDW(Optimizer):
         return loss
 
 
+    def _step_foreach(self, display):
+        # The update of step with torch._foreach_* ops, for all the parameters that share a step count at once.
+        # The per-parameter lr, beta and nu are updated as vectors.
+        for group in self.param_groups:
+            hypergrad_lr = group['hypergrad_lr']
+            wd = group['weight_decay']
+            alpha = group['alpha']
+            eps = group['eps']
+
+            for params, grads, states in _foreach_buckets(self, group):
+                for state in states:
+                    state['step'] += 1
+                step = states[0]['step']
+                exp_avgs = [state['exp_avg'] for state in states]
+
+                if self.use_diffgrad:
+                    exp_avgs = _diffgrad(exp_avgs, grads, states)
+
+                lookahead_step, _ = _averaging_steps(self, step, False)
+
+                if step > 1 and hypergrad_lr > 0.0:
+                    flat_grads = [grad.view(-1) for grad in grads]
+                    grad_norms = torch.stack(torch._foreach_norm(flat_grads)) if self.HDM else None
+                    lrs = _hyperupdate([state['lr'] for state in states], flat_grads, [state['prev_lr_grad'] for state in states],
+                                       hypergrad_lr, eps, self.HDM, grad_norms).clamp_(min=0)
+                    if display:
+                        print("lr", lrs)
+                    betas = _hyperupdate([state['beta'] for state in states], flat_grads, [state['prev_beta_grad'] for state in states],
+                                         hypergrad_lr, eps, self.HDM, grad_norms).clamp_(0, 1)
+                    if display:
+                        print("beta", group['beta'])
+                    # As in step, nu is tuned with the hypergradient of beta
+                    nus = _hyperupdate([state['nu'] for state in states], flat_grads, [state['prev_beta_grad'] for state in states],
+                                       hypergrad_lr, eps, self.HDM, grad_norms).clamp_(0, 1)
+                    if display:
+                        print("nu", nus)
+                    for state, lr, beta, nu in zip(states, lrs.unbind(), betas.unbind(), nus.unbind()):
+                        state['lr'], state['beta'], state['nu'] = lr, beta, nu
+
+                if self.use_gc:
+                    _centralize(grads)
+
+                nus = _scalars([state['nu'] for state in states])
+                betas = _scalars([state['beta'] for state in states])
+                lrs = _scalars([state['lr'] for state in states])
+
+                dalpha = alpha if lookahead_step else 1.0
+
+                gx = [1 - (beta ** step) for beta in betas]
+                fx = torch._foreach_mul(exp_avgs, betas)
+                torch._foreach_add_(fx, torch._foreach_mul(grads, [1 - beta for beta in betas]))
+
+                if hypergrad_lr > 0.0:
+                    dbeta = torch._foreach_sub(exp_avgs, grads)
+                    torch._foreach_mul_(dbeta, gx)
+                    torch._foreach_add_(dbeta, torch._foreach_mul(fx, [- step * beta**(step - 1) for beta in betas]))
+                    torch._foreach_div_(dbeta, [math.pow(g, 2) + eps for g in gx])
+                    torch._foreach_mul_(dbeta, [- dalpha * lr * nu for lr, nu in zip(lrs, nus)])
+                    for state, d in zip(states, dbeta):
+                        state['prev_beta_grad'] = d.view(-1)
+
+                momentum = torch._foreach_div(fx, gx)
+                # As in step, the stored moments are not updated
+                group['exp_avg'] = fx[-1]
+
+                if hypergrad_lr > 0.0:
+                    prev_nu_grads = torch._foreach_sub(momentum, grads)
+                    torch._foreach_mul_(prev_nu_grads, [-dalpha * lr for lr in lrs])
+                    for state, prev_nu_grad in zip(states, prev_nu_grads):
+                        state['prev_nu_grad'] = prev_nu_grad.view(-1)
+
+                # quasi hyperbolic momentum
+                torch._foreach_mul_(momentum, nus)
+                torch._foreach_add_(momentum, torch._foreach_mul(grads, [1 - nu for nu in nus]))
+
+                if hypergrad_lr > 0.0:
+                    temps = torch._foreach_neg(momentum)
+                    torch._foreach_sub_(temps, torch._foreach_mul(params, wd))
+                    torch._foreach_mul_(temps, dalpha)
+                    for state, temp in zip(states, temps):
+                        state['prev_lr_grad'] = temp.view(-1)
+
+                torch._foreach_add_(params, torch._foreach_mul(momentum, -group['lr']))
+
+                if wd != 0:
+                    torch._foreach_add_(params, torch._foreach_mul(params, -wd * group['lr']))
+
+                _foreach_average(params, states, lookahead_step, False, alpha)
+
+
 class HyperProp(Optimizer):
 
     # LaProp + hypergradient descent on lr and nu (for QH momentum) + QH Momentum + Decaying Momentum (DEMON) + Lookahead + Iterate Averaging + Nostalgia (from NosAdam) + P from PAdam
@@ -1281,7 +2106,10 @@ class HyperProp(Optimizer):
                  step_per_epoch=None,
                  weight_decay=0,
                  use_gc=True,
-                 use_diffgrad=False):
+                 use_diffgrad=False,
+                 foreach=False,
+                 flat_state=False,
+                 state_dtype=None):
 
         # betas = (beta1 for first order moments, beta2 for second order moments)
         # nu = for quasi hyperbolic momentum
@@ -1302,6 +2130,9 @@ class HyperProp(Optimizer):
         # weight decay = decorrelated weight decay value
         # use_gc = bool to determine whether to use gradient centralization or not.
         # use_diffgrad = bool to determine whether to use diffgrad or not.
+        # foreach = bool to decide whether to update all the parameters at once with torch._foreach_* ops (same update, fewer kernel launches)
+        # flat_state = bool to decide whether to keep the moments and the lookahead cache in flat contiguous buffers
+        # state_dtype = dtype in which flat_state stores the moments (e.g. torch.bfloat16), None for the dtype of the parameters
 
         if not 0.0 <= lr:
             raise ValueError("Invalid learning rate: {}".format(lr))
@@ -1325,6 +2156,7 @@ class HyperProp(Optimizer):
 
         self.nostalgia = nostalgia
         self.use_demon = use_demon
+        self.foreach = foreach
         self.k = k
         self.IA = IA
         self.IA_cycle = IA_cycle
@@ -1349,16 +2181,44 @@ class HyperProp(Optimizer):
                         hypergrad_lr=hypergrad_lr,
                         weight_decay=weight_decay)
         super(HyperProp, self).__init__(params, defaults)
+        _init_flat_state(self, flat_state, state_dtype)
 
     def __setstate__(self, state):
         super(HyperProp, self).__setstate__(state)
 
+    def _init_state(self, p, grad, group, state):
+        hypergrad_lr = group['hypergrad_lr']
+        state['lr'] = group['lr']
+        state['nu'] = group['nu']
+        state['step'] = 0
+        state['exp_avg'] = torch.zeros_like(p.data)
+        state['exp_avg_sq'] = torch.zeros_like(p.data)
+        if self.use_diffgrad:
+            state['previous_grad'] = torch.zeros_like(p.data)
+
+        if self.IA:
+            state['num_models'] = 0
+        if self.IA or (self.k > 0):
+            state['cached_params'] = p.data.clone()
+        if self.nostalgia:
+            state['B_old'] = 0
+            state['B_new'] = 1
+        if hypergrad_lr > 0.0:
+            state['prev_lr_grad'] = torch.zeros_like(grad.view(-1))
+            if self.hypertune_nu:
+                state['prev_nu_grad'] = torch.zeros_like(
+                    grad.view(-1))
+
     def step(self, activate_IA=False, display=False, closure=None):
 
         loss = None
         if closure is not None:
             loss = closure()
 
+        if self.foreach:
+            self._step_foreach(activate_IA, display)
+            return loss
+
         for group in self.param_groups:
 
             for p in group['params']:
@@ -1378,26 +2238,7 @@ class HyperProp(Optimizer):
                 gamma = group['gamma']
 
                 if len(state) == 0:
-                    state['lr'] = group['lr']
-                    state['nu'] = group['nu']
-                    state['step'] = 0
-                    state['exp_avg'] = torch.zeros_like(p.data)
-                    state['exp_avg_sq'] = torch.zeros_like(p.data)
-                    if self.use_diffgrad:
-                        state['previous_grad'] = torch.zeros_like(p.data)
-
-                    if self.IA:
-                        state['num_models'] = 0
-                    if self.IA or (self.k > 0):
-                        state['cached_params'] = p.data.clone()
-                    if self.nostalgia:
-                        state['B_old'] = 0
-                        state['B_new'] = 1
-                    if hypergrad_lr > 0.0:
-                        state['prev_lr_grad'] = torch.zeros_like(grad.view(-1))
-                        if self.hypertune_nu:
-                            state['prev_nu_grad'] = torch.zeros_like(
-                                grad.view(-1))
+                    self._init_state(p, grad, group, state)
 
                 state['step'] += 1
                 exp_avg, exp_avg_sq = state['exp_avg'], state['exp_avg_sq']
@@ -1486,7 +2327,7 @@ class HyperProp(Optimizer):
                     previous_grad = state['previous_grad']
                     diff = abs(previous_grad - grad)
                     dfc = 1. / (1. + torch.exp(-diff))
-                    state['previous_grad'] = grad.clone()
+                    state['previous_grad'].copy_(grad)
                     exp_avg = exp_avg * dfc
 
                 momentum = exp_avg.clone()
@@ -1529,4 +2370,110 @@ class HyperProp(Optimizer):
 
         return loss
 
+    def _step_foreach(self, activate_IA, display):
+        # The update of step with torch._foreach_* ops, for all the parameters that share a step count at once.
+        # The per-parameter lr and nu are updated as vectors.
+        for group in self.param_groups:
+            hypergrad_lr = group['hypergrad_lr']
+            beta1_init, beta2 = group['betas']
+            wd = group['weight_decay']
+            alpha = group['alpha']
+            gamma = group['gamma']
+
+            for params, grads, states in _foreach_buckets(self, group):
+                for state in states:
+                    state['step'] += 1
+                step = states[0]['step']
+                exp_avgs = [state['exp_avg'] for state in states]
+                exp_avg_sqs = [state['exp_avg_sq'] for state in states]
+
+                if self.use_demon:
+                    temp = 1 - (step / self.T)
+                    beta1 = beta1_init * temp / \
+                        ((1 - beta1_init) + beta1_init * temp)
+                else:
+                    beta1 = beta1_init
+
+                if self.nostalgia:
+                    beta2 = states[0]['B_old'] / states[0]['B_new']
+                    for state in states:
+                        state['B_old'] += math.pow(step, -gamma)
+                        state['B_new'] += math.pow(step + 1, -gamma)
+
+                lookahead_step, do_IA = _averaging_steps(self, step, activate_IA)
+
+                if step > 1 and hypergrad_lr > 0.0:
+                    flat_grads = [grad.view(-1) for grad in grads]
+                    grad_norms = torch.stack(torch._foreach_norm(flat_grads)) if self.HDM else None
+                    lrs = _hyperupdate([state['lr'] for state in states], flat_grads, [state['prev_lr_grad'] for state in states],
+                                       hypergrad_lr, group['eps'], self.HDM, grad_norms).clamp_(min=0)
+                    for state, lr in zip(states, lrs.unbind()):
+                        state['lr'] = lr
+                    if display:
+                        print("lr", lrs)
+
+                    if self.hypertune_nu:
+                        nus = _hyperupdate([state['nu'] for state in states], flat_grads, [state['prev_nu_grad'] for state in states],
+                                           hypergrad_lr, group['eps'], self.HDM, grad_norms).clamp_(0, 1)
+                        for state, nu in zip(states, nus.unbind()):
+                            state['nu'] = nu
+
+                    if display:
+                        print("nu", [state['nu'] for state in states])
+
+                if self.use_gc:
+                    _centralize(grads)
+
+                nus = _scalars([state['nu'] for state in states])
+                torch._foreach_mul_(exp_avg_sqs, beta2)
+                torch._foreach_addcmul_(exp_avg_sqs, grads, grads, value=1 - beta2)
+
+                vt = [exp_avg_sq.clone() for exp_avg_sq in exp_avg_sqs]
+                if not self.nostalgia:
+                    torch._foreach_div_(vt, 1 - (beta2 ** step))
+                torch._foreach_pow_(vt, group['p'])
+                torch._foreach_add_(vt, group['eps'])
+                denom = vt
+
+                torch._foreach_mul_(exp_avgs, beta1)
+                torch._foreach_addcdiv_(exp_avgs, grads, denom, value=1 - beta1)
+
+                if self.use_diffgrad:
+                    exp_avgs = _diffgrad(exp_avgs, grads, states)
+
+                momentum = torch._foreach_div(exp_avgs, 1 - (beta1 ** step))
+
+                if lookahead_step:
+                    dalpha = alpha
+                elif do_IA:
+                    dalpha = (1 / (states[0]["num_models"] + 1.0))
+                else:
+                    dalpha = 1.0
+
+                lrs = _scalars([state['lr'] for state in states])
+                if hypergrad_lr > 0.0 and self.hypertune_nu:
+                    prev_nu_grads = torch._foreach_sub(momentum, grads)
+                    torch._foreach_mul_(prev_nu_grads, [-dalpha * lr for lr in lrs])
+                    for state, prev_nu_grad in zip(states, prev_nu_grads):
+                        state['prev_nu_grad'] = prev_nu_grad.view(-1)
+
+                # quasi hyperbolic momentum
+                torch._foreach_mul_(momentum, nus)
+                torch._foreach_add_(momentum, torch._foreach_mul(grads, [1 - nu for nu in nus]))
+
+                if hypergrad_lr > 0.0:
+                    temps = torch._foreach_neg(momentum)
+                    torch._foreach_sub_(temps, torch._foreach_mul(params, wd))
+                    torch._foreach_mul_(temps, dalpha)
+                    for state, temp in zip(states, temps):
+                        state['prev_lr_grad'] = temp.view(-1)
+
+                torch._foreach_sub_(params, torch._foreach_mul(momentum, lrs))
+
+                if wd != 0:
+                    torch._foreach_mul_(params, [1 - lr * wd for lr in lrs])
+
+                _foreach_average(params, states, lookahead_step, do_IA, alpha)
+
+
 # new stuffs to try: https://arxiv.org/pdf/1607.04381.pdf
@@ -1,6 +1,9 @@
 import torch
-from .utils import all_gather, synchronize, get_world_size
+from torch.func import functional_call
+from torch.utils.data.distributed import DistributedSampler
+from .utils import all_gather, all_gather_uneven, synchronize, DeviceBuffer, H5Writer
 import numpy as np
+import h5py
 from itertools import islice
 #from .scheduler import GradualWarmupScheduler, GradualCooldownScheduler
 from torch.optim.lr_scheduler import OneCycleLR  #Dyanmic learning rate implementation
@@ -13,12 +16,15 @@ import logging
 logger = logging.getLogger(__name__)
 from src.trainer.utils import apply_mixup_cutmix
 
+# Log (and flush) interval of --sync-free when --log-every is 1 or 0: every flush waits for the device once
+SYNC_FREE_LOG_EVERY = 100
+
 class Trainer:
     """
     Class to train network. Includes checkpoints, optimizer, scheduler,
     """
     def __init__(self, args, dataloaders, model, loss_fn, metrics_fn, minibatch_metrics_fn, minibatch_metrics_string_fn, 
-                 optimizer, scheduler, restart_epochs, device_id, device, dtype, trial_number=None):
+                 optimizer, scheduler, restart_epochs, device_id, device, dtype, trial_number=None, streaming_metrics_fn=None):
         np.set_printoptions(precision=5)
         self.args = args
         self.dataloaders = dataloaders
@@ -27,6 +33,9 @@ class Trainer:
         self.metrics_fn = metrics_fn
         self.minibatch_metrics_fn = minibatch_metrics_fn
         self.minibatch_metrics_string_fn = minibatch_metrics_string_fn
+        # Optional streaming replacement of metrics_fn for the training and validation epochs: streaming_metrics_fn(loss_fn) returns an
+        # object with update(predict, targets, loss=None), all_reduce() and compute(prefix) (see metrics_classifier.StreamingMetrics)
+        self.streaming_metrics_fn = streaming_metrics_fn
         self.optimizer = optimizer
         self.scheduler = scheduler #For dyanmic scheduler
         self.restart_epochs = restart_epochs
@@ -58,6 +67,12 @@ class Trainer:
         self.best_acc_epoch = 0
         self.best_acc_metrics = None
 
+        # With --sync-free, logging a minibatch copies the device buffers to the host, so it can't happen after every minibatch
+        self.log_every = args.log_every
+        if getattr(args, 'sync_free', False) and args.log_every == 1:
+            logger.warning(f'--sync-free: logging every minibatch would wait for the device after every step, logging every {SYNC_FREE_LOG_EVERY} minibatches instead')
+            self.log_every = SYNC_FREE_LOG_EVERY
+
     def _wrap_scheduler(self):
         return OneCycleLR(
         self.optimizer, 
@@ -164,7 +179,7 @@ class Trainer:
         Evaluate model on splits (in practice used only for final testing).
 
         :splits: List of splits to include. Only valid splits are: 'train', 'valid', 'test'
-        :distributed: Evaluate using multiple GPUs. Off by default so that the order of datapoints is preserved.
+        :distributed: Evaluate using all the processes. The predictions are put back in the order of the dataset (see predict).
         :best: Evaluate best model as determined by minimum validation loss over evolution
         :final: Evaluate final model at end of training phase
         """
@@ -174,59 +189,65 @@ class Trainer:
         
         # make sure main process has finished writing to disk before proceeding
         synchronize()
-        if distributed:
-            logger.warning('Using distributed evaluation for the testing dataset (args.distribute_eval). Order of samples may not be preserved in the predict file.')
-        elif self.device_id > 0:
+        if not distributed and self.device_id > 0:
             logger.info(f'Evaluating only on device 0. Quitting on device {self.device_id}\n')
             return
 
-        # Evaluate final model
+        # Checkpoints to evaluate: (description, model state, log message). They are all evaluated in a single pass over
+        # each split, and the ones with the same weights as an earlier one are not evaluated again.
+        checkpoints = []
         if final:
-            # Load checkpoint model to make predictions
             checkpoint = torch.load(self.args.checkfile, map_location=self.device)
-            final_epoch = checkpoint['epoch']
-            self.model.load_state_dict(checkpoint['model_state'])
-            logger.info(f'Getting predictions for final model {self.args.checkfile} (epoch {final_epoch}).')
-
-            # Loop over splits, predict, and output/log predictions
-            for split in splits:
-                predict, targets = self.predict(set=split, distributed=distributed, ir_data=ir_data, c_data=c_data, expand_data=expand_data)
-                if self.device_id <= 0:
-                    best_metrics, logstring = self.log_predict(predict, targets, split, description='Final')
-                synchronize()
-        # Evaluate best model as determined by validation error
+            checkpoints.append(('Final', checkpoint['model_state'], f'final model {self.args.checkfile} (epoch {checkpoint["epoch"]})'))
         if best:
-            # Load best model to make predictions
             checkpoint = torch.load(self.args.bestfile, map_location=self.device)
-            best_epoch = checkpoint['epoch']
-            self.model.load_state_dict(checkpoint['model_state'])
-            if (not final) or (final and not best_epoch == final_epoch):
-                logger.info(f'Getting predictions for best model {self.args.bestfile} (epoch {best_epoch}, best validation metrics were {checkpoint["best_metrics"]}).')
-                # Loop over splits, predict, and output/log predictions
-                for split in splits:
-                    predict, targets = self.predict(split, distributed=distributed, ir_data=ir_data, c_data=c_data, expand_data=expand_data)
-                    if self.device_id <= 0:
-                        best_metrics, logstring = self.log_predict(predict, targets, split, description='Best')
-                    synchronize()
-
-            elif best_epoch == final_epoch:
-                logger.info('BEST MODEL IS SAME AS FINAL')
-                if self.device_id <= 0:
-                    self.log_predict(predict, targets, split, description='Best', repeat=[best_metrics, logstring])
-        logger.info('Inference phase complete!\n')
-
-        # Evaluate best accuracy model
+            checkpoints.append(('Best', checkpoint['model_state'], f'best model {self.args.bestfile} (epoch {checkpoint["epoch"]}, best validation metrics were {checkpoint["best_metrics"]})'))
         if hasattr(self.args, "bestaccfile") and os.path.exists(self.args.bestaccfile):
             checkpoint = torch.load(self.args.bestaccfile, map_location=self.device)
-            best_acc_epoch = checkpoint.get('best_acc_epoch', -1)
-            self.model.load_state_dict(checkpoint['model_state'])
-            logger.info(f"Getting predictions for best-accuracy model {self.args.bestaccfile} (epoch {best_acc_epoch}, best accuracy metrics were {checkpoint.get('best_acc_metrics', {})}).")
-            for split in splits:
-                predict, targets = self.predict(split, distributed=distributed, ir_data=ir_data, c_data=c_data, expand_data=expand_data)
-                if self.device_id <= 0:
-                    best_acc_metrics, logstring = self.log_predict(predict, targets, split, description='BestAcc')
-                synchronize()
-            # After best-accuracy evaluation:
+            checkpoints.append(('BestAcc', checkpoint['model_state'], f"best-accuracy model {self.args.bestaccfile} (epoch {checkpoint.get('best_acc_epoch', -1)}, best accuracy metrics were {checkpoint.get('best_acc_metrics', {})})"))
+        if not checkpoints:
+            return
+
+        same = [next((j for j in range(i) if _same_state(checkpoints[j][1], checkpoints[i][1])), None) for i in range(len(checkpoints))]
+        unique = [i for i, j in enumerate(same) if j is None]
+        for (description, _, message), j in zip(checkpoints, same):
+            if j is None:
+                logger.info(f'Getting predictions for {message}.')
+            else:
+                logger.info(f'{description.upper()} MODEL IS SAME AS {checkpoints[j][0].upper()}')
+
+        # With --out-of-core-eval, the predictions are written to HDF5 files batch by batch and the metrics are streamed
+        out_of_core = getattr(self.args, 'out_of_core_eval', False)
+        if out_of_core and self.streaming_metrics_fn is None:
+            raise NotImplementedError('Out-of-core evaluation computes the metrics with the streaming metrics engine')
+
+        # Loop over splits, predict with every distinct checkpoint, and output/log predictions
+        for split in splits:
+            states = [checkpoints[i][1] for i in unique]
+            if out_of_core:
+                streaming = [self.streaming_metrics_fn(self.loss_fn) for i in unique]
+                predict_files = [self._predict_prefix(split, description=checkpoints[i][0]) + '.h5' if self.args.predict else None for i in unique]
+                if self.args.predict and self.device_id <= 0:
+                    logger.info(f'Writing predictions to files: {predict_files}')
+                outputs = self.predict(split, distributed=distributed, ir_data=ir_data, c_data=c_data, expand_data=expand_data, model_states=states, streaming=streaming, predict_files=predict_files)
+            else:
+                outputs = self.predict(split, distributed=distributed, ir_data=ir_data, c_data=c_data, expand_data=expand_data, model_states=states)
+            if self.device_id <= 0:
+                outputs = dict(zip(unique, outputs))
+                results = {}
+                for i, j in enumerate(same):
+                    output = outputs[i if j is None else j]
+                    predict, targets, streaming = (None, None, output[0]) if out_of_core else (*output, None)
+                    if j is None:
+                        results[i] = self.log_predict(predict, targets, split, description=checkpoints[i][0], streaming=streaming)
+                    else:
+                        self.log_predict(predict, targets, split, description=checkpoints[i][0], repeat=list(results[j]), streaming=streaming)
+            synchronize()
+        # The model is left with the weights of the last checkpoint, as when they were evaluated one after another
+        self.model.load_state_dict(checkpoints[-1][1])
+        logger.info('Inference phase complete!\n')
+
+        if checkpoints[-1][0] == 'BestAcc':
             self.save_best_acc_metrics_csv()
 
 
@@ -313,8 +334,15 @@ class Trainer:
             self.epoch = epoch
             if epoch > start_epoch:
                 start_minibatch = 0
-            if get_world_size() > 1:
-                self.dataloaders['train'].batch_sampler.sampler.set_epoch(epoch)
+            if hasattr(self.dataloaders['train'].dataset, 'set_epoch'):
+                # With --RAM-distributed shard, the training events are dealt out to the processes anew every epoch
+                self.dataloaders['train'].dataset.set_epoch(epoch)
+            batch_sampler = self.dataloaders['train'].batch_sampler
+            if hasattr(batch_sampler, 'set_epoch'):
+                batch_sampler.set_epoch(epoch)
+            elif hasattr(batch_sampler.sampler, 'set_epoch'):
+                # DistributedSampler; with --RAM-distributed shard the shards are shuffled by a plain RandomSampler instead
+                batch_sampler.sampler.set_epoch(epoch)
             logger.info(f'STARTING Epoch {epoch} from minibatch {start_minibatch+1}')
 
             self._warm_restart(epoch)
@@ -322,13 +350,23 @@ class Trainer:
             train_predict, train_targets, epoch_t = self.train_epoch(start_minibatch)
             if self.device_id <= 0:
                 self._save_checkpoint()
-                train_metrics,_ = self.log_predict(train_predict, train_targets, 'train', epoch=epoch, epoch_t=epoch_t)
+                if self.streaming_metrics_fn is not None:
+                    # train_predict is the streaming metrics engine of the epoch
+                    train_metrics,_ = self.log_predict(None, None, 'train', epoch=epoch, epoch_t=epoch_t, streaming=train_predict)
+                else:
+                    train_metrics,_ = self.log_predict(train_predict, train_targets, 'train', epoch=epoch, epoch_t=epoch_t)
 
-            valid_predict, valid_targets = self.predict(set='valid', distributed=True)
+            if self.streaming_metrics_fn is not None:
+                valid_streaming = self.predict(set='valid', distributed=True, streaming=self.streaming_metrics_fn(self.loss_fn))[0]
+            else:
+                valid_predict, valid_targets = self.predict(set='valid', distributed=True)
 
             if self.device_id <= 0:
                 self._save_checkpoint()
-                valid_metrics, _ = self.log_predict(valid_predict, valid_targets, 'valid', epoch=epoch)
+                if self.streaming_metrics_fn is not None:
+                    valid_metrics, _ = self.log_predict(None, None, 'valid', epoch=epoch, streaming=valid_streaming)
+                else:
+                    valid_metrics, _ = self.log_predict(valid_predict, valid_targets, 'valid', epoch=epoch)
                 self._save_checkpoint(valid_metrics)
 
                 # Extract validation loss
@@ -411,20 +449,33 @@ class Trainer:
 
         return self.best_epoch, self.best_metrics
 
-    def _get_target(self, data):
+    def _get_target(self, data, non_blocking=False):
         """
         Get the learning target.
         If a stats dictionary is included, return a normalized learning target.
         """        
         target_type = torch.long if self.args.target=='is_signal' else self.dtype
-        targets = data[self.args.target].to(self.device, target_type)
+        targets = data[self.args.target].to(self.device, target_type, non_blocking=non_blocking)
         return targets
 
+    def _raise_if_nan(self):
+        # Reads the NaN record of a model built with check_nan > 1 (one host synchronization)
+        model = getattr(self.model, 'module', self.model)
+        if hasattr(model, 'raise_if_nan'):
+            model.raise_if_nan()
+
     def train_epoch(self, start_minibatch=0):
         dataloader = self.dataloaders['train']
 
         self.loss_val, self.alt_loss_val, self.batch_time = 0, 0, 0
         all_predict, all_targets = {}, []
+        # With --sync-free, the losses, targets and predictions stay in device buffers, which are copied to the host together with
+        # the logged minibatch once per log interval (see _flush_sync_free)
+        sync_free = getattr(self.args, 'sync_free', False)
+        flush_every = self.log_every if self.log_every > 0 else SYNC_FREE_LOG_EVERY
+        losses, buffers, logged = DeviceBuffer(), {}, None
+        # With streaming metrics, the predictions are not kept at all
+        streaming = self.streaming_metrics_fn(self.loss_fn) if self.streaming_metrics_fn is not None else None
 
         self.model.train()
         epoch_t = datetime.now()
@@ -441,8 +492,8 @@ class Trainer:
             self.minibatch = batch_idx
             batch_t = datetime.now()
 
-            inputs = data["Pmu"].to(self.device)
-            targets = self._get_target(data)
+            inputs = data["Pmu"].to(self.device, non_blocking=sync_free)
+            targets = self._get_target(data, non_blocking=sync_free)
 
             # Apply Mixup or CutMix if enabled
             if getattr(self.args, 'aug_mixcut', False):
@@ -473,16 +524,39 @@ class Trainer:
             self.scheduler.step()
 
             # Store loss and learning rate for plotting
-            self.loss_history.append(loss.item())
+            if sync_free:
+                losses.append(loss.detach().reshape(1))
+            else:
+                self.loss_history.append(loss.item())
             self.lr_history.append(self.scheduler.get_last_lr()[0])
 
-            if not self.args.quiet and not all(param.grad is not None for param in dict(self.model.named_parameters()).values()):
+            if not self.args.quiet and (not sync_free or batch_idx == start_minibatch) and not all(param.grad is not None for param in dict(self.model.named_parameters()).values()):
                 logger.warning("The following params have missing gradients at backward pass (they are probably not being used in output):\n", {key: '' for key, param in self.model.named_parameters() if param.grad is None})
             # Step optimizer and learning rate
             #self.optimizer.step()
             # self.model.apply(_max_norm)
             #self._step_lr_batch()
 
+            if streaming is not None:
+                streaming.update(predict['predict'], targets, loss)
+
+            if sync_free or streaming is not None:
+                if streaming is None:
+                    buffers.setdefault('targets', DeviceBuffer()).append(targets)
+                    for key, val in predict.items(): buffers.setdefault(key, DeviceBuffer()).append(val)
+                if self.device_id <= 0 and (self.args.save_every > 0) and (batch_idx + 1) % self.args.save_every == 0:
+                    self._save_checkpoint()
+                if sync_free:
+                    if (self.log_every > 0) and batch_idx % self.log_every == 0:
+                        logged = (batch_idx, loss.detach(), targets.detach(), predict['predict'].detach(), batch_t, fwd_t, bwd_t)
+                    if (batch_idx + 1) % flush_every == 0:
+                        self._flush_sync_free(losses, buffers, logged, all_targets, all_predict, epoch_t)
+                        logged = None
+                elif self.device_id <= 0 and (self.log_every > 0) and batch_idx % self.log_every == 0:
+                    # Minibatch metrics of this process's share of the batch (the predictions are never gathered)
+                    self._log_minibatch(batch_idx, loss, targets.cpu(), predict['predict'].detach().cpu(), batch_t, fwd_t, bwd_t, epoch_t)
+                continue
+
             targets = all_gather(targets).detach().cpu()
             predict = {key: all_gather(val).detach().cpu() for key, val in predict.items()}
             if self.device_id <= 0:
@@ -490,9 +564,16 @@ class Trainer:
                 for key, val in predict.items(): all_predict.setdefault(key,[]).append(val)
                 if (self.args.save_every > 0) and (batch_idx + 1) % self.args.save_every == 0:
                     self._save_checkpoint()
-                if (self.args.log_every > 0) and batch_idx % self.args.log_every == 0:
+                if (self.log_every > 0) and batch_idx % self.log_every == 0:
                     self._log_minibatch(batch_idx, loss, targets, predict['predict'], batch_t, fwd_t, bwd_t, epoch_t)
-        
+
+        if sync_free and (losses.size > 0 or logged is not None):
+            self._flush_sync_free(losses, buffers, logged, all_targets, all_predict, epoch_t)
+
+        if streaming is not None:
+            streaming.all_reduce()
+            return (streaming if self.device_id <= 0 else None), None, epoch_t
+
         if self.device_id > 0:
             return None, None, epoch_t
 
@@ -501,20 +582,63 @@ class Trainer:
 
         return all_predict, all_targets, epoch_t
 
-    def predict(self, set='valid', distributed=True, ir_data=None, c_data=None, expand_data=None):
+    def _flush_sync_free(self, losses, buffers, logged, all_targets, all_predict, epoch_t):
+        """
+        Moves the --sync-free device buffers of a log interval to the host and empties them: the losses and the logged
+        minibatch (batch_idx, loss, targets, predict, batch_t, fwd_t, bwd_t) come over in a single transfer, the buffered
+        targets and predictions are gathered from all the processes and appended to all_targets and all_predict.
+        """
+        tensors = [losses.values()] + (list(logged[1:4]) if logged is not None else [])
+        host = torch.cat([tensor.reshape(-1).double() for tensor in tensors]).cpu().split([tensor.numel() for tensor in tensors])
+        self.loss_history.extend(host[0].tolist())
+        losses.clear()
+        self._raise_if_nan()
+        if logged is not None and self.device_id <= 0:
+            # Minibatch metrics of this process's share of the batch
+            batch_idx, loss, targets, predict, batch_t, fwd_t, bwd_t = logged
+            self._log_minibatch(batch_idx, host[1].view(()), host[2].view(targets.shape).to(targets.dtype), host[3].view(predict.shape).to(predict.dtype), batch_t, fwd_t, bwd_t, epoch_t)
+        for key, buffer in buffers.items():
+            if buffer.size > 0:
+                values = all_gather_uneven(buffer.values()).cpu()
+                if self.device_id <= 0:
+                    (all_targets if key == 'targets' else all_predict.setdefault(key, [])).append(values)
+            buffer.clear()
+
+    def predict(self, set='valid', distributed=True, ir_data=None, c_data=None, expand_data=None, streaming=None, model_states=None, predict_files=None):
+        # streaming: a streaming metrics engine updated with each process's minibatches instead of gathering and keeping
+        # the predictions; it is returned in place of the predictions (with None targets)
+        # model_states: state dicts of self.model (e.g. several checkpoints), every batch is read once and goes through the
+        # model with each of them in turn; a list of (predict, targets), one per state, is returned
+        # (streaming and predict_files are then lists with one entry, possibly None, per state)
+        # predict_files: HDF5 file that the main process appends the gathered predictions, targets and dataset indices ('index')
+        # to batch by batch (see H5Writer); the predictions are then not kept in memory if streaming is also given
+        # With distributed, the padded duplicates of DistributedSampler are dropped and the gathered predictions are put back
+        # in the order of the dataset using the event indices that the datasets add to the batches ('index')
         dataloader = self.dataloaders[set]
 
         self.model.eval()
-        all_predict, all_targets = {}, []
+        if model_states is None:
+            models, streaming, predict_files = [self.model], [streaming], [predict_files]
+        else:
+            models = [lambda data, state=state: functional_call(self.model, state, (data,)) for state in model_states]
+            streaming, predict_files = streaming or [None] * len(models), predict_files or [None] * len(models)
+        all_predict, all_targets = [{} for _ in models], []
         start_time = datetime.now()
         logger.info('Starting testing on {} set: '.format(set))
 
         if not distributed:
             if self.device_id > 0:
-                return None, None
+                return (None, None) if model_states is None else [(None, None)] * len(models)
             gather = lambda x: x
         else:
             gather = all_gather
+        # DistributedSampler pads the shards of the processes to the same length with events from the start of the dataset:
+        # the events of this process past its first num_real ones are duplicates
+        sampler = getattr(dataloader, 'sampler', None)
+        num_real = len(range(sampler.rank, len(sampler.dataset), sampler.num_replicas)) if distributed and isinstance(sampler, DistributedSampler) and not sampler.drop_last else None
+        num_seen = 0
+        all_index = []
+        writers = [H5Writer(file) if file is not None and self.device_id <= 0 else None for file in predict_files]
         
         with torch.no_grad():
             for batch_idx, data in enumerate(dataloader):
@@ -525,48 +649,119 @@ class Trainer:
                 if c_data is not None:
                     data = c_data(data)
                 
-                targets = gather(self._get_target(data)).detach().cpu()
-                predict = self.model(data)
-                predict = {key: gather(val).detach().cpu() for key, val in predict.items()}
-                if self.device_id <= 0:
-                    all_targets.append(targets)
-                    for key, val in predict.items(): all_predict.setdefault(key, []).append(val)
-
+                targets = self._get_target(data)
+                # The event indices (unless expand_data changed the events), -1 for the padded duplicates
+                index = data.get('index') if expand_data is None else None
+                real = None
+                if num_real is not None:
+                    real = torch.arange(num_seen, num_seen + len(data['Nobj'])) < num_real
+                    num_seen += len(real)
+                    if index is not None:
+                        index = index.masked_fill(~real, -1)
+                elif distributed and index is not None and (index < 0).any():
+                    # Rank-sharded datasets (see JetDataset) mark their padding with index -1 themselves
+                    real = index >= 0
+                keep = any(engine is None for engine in streaming)
+                rows = None
+                if index is not None and (keep or any(predict_files)):
+                    index = gather(index.to(self.device)).cpu()
+                    if distributed:
+                        rows = _ordered_rows(index)
+                        index = index[rows]
+                    all_index.append(index)
+                else:
+                    index = None
+                if keep or any(predict_files):
+                    gathered_targets = _take(gather(targets).detach().cpu(), rows) if targets is not None else None
+                    if keep and self.device_id <= 0:
+                        all_targets.append(gathered_targets)
+                for model, engine, file, writer, model_predict in zip(models, streaming, predict_files, writers, all_predict):
+                    # The models add keys to the batch (e.g. add_spurions), so each of them gets its own copy
+                    predict = model(dict(data))
+                    if engine is not None:
+                        if real is None:
+                            engine.update(predict['predict'], targets)
+                        elif real.any():
+                            engine.update(predict['predict'][real.to(self.device)], targets[real.to(self.device)])
+                        if file is None:
+                            continue
+                    predict = {key: _take(gather(val).detach().cpu(), rows) for key, val in predict.items()}
+                    if self.device_id > 0:
+                        continue
+                    if writer is not None:
+                        writer.append(**predict, **({'targets': gathered_targets} if gathered_targets is not None else {}), **({'index': index} if index is not None else {}))
+                    if engine is None:
+                        for key, val in predict.items(): model_predict.setdefault(key, []).append(val)
+
+        self._raise_if_nan()
+        for engine in streaming:
+            if engine is not None and distributed:
+                engine.all_reduce()
+        for writer in writers:
+            if writer is not None:
+                writer.close()
         if self.device_id > 0:
-            return None, None
+            return (None, None) if model_states is None else [(None, None)] * len(models)
         
-        if all_targets[0] is not None:
-            all_targets = torch.cat(all_targets)
+        # Each gathered batch is in order, the batches themselves are in order unless the sampler shuffles
+        order = None
+        if distributed and all_index:
+            all_index = torch.cat(all_index)
+            if not (all_index[1:] > all_index[:-1]).all():
+                order = all_index.argsort()
+
+        if not any(engine is None for engine in streaming):
+            all_targets = None
+        elif all_targets[0] is not None:
+            all_targets = _take(torch.cat(all_targets), order)
         else:
             all_targets = None
-        all_predict = {key: torch.cat(val) for key, val in all_predict.items()}
+        outputs = [(engine, None) if engine is not None else ({key: _take(torch.cat(val), order) for key, val in model_predict.items()}, all_targets)
+                   for engine, model_predict in zip(streaming, all_predict)]
 
         dt = (datetime.now() - start_time).total_seconds()
         logger.info('Total evaluation time: {}s'.format(dt))
 
-        return all_predict, all_targets
-
-    def log_predict(self, predict, targets, dataset, epoch=-1, epoch_t=None, description='', repeat=None):
-
-        datastrings = {'train': 'Training  ', 'test': 'Testing   ', 'valid': 'Validation'}
+        if model_states is None:
+            return outputs[0]
+        return outputs
 
+    def _predict_prefix(self, dataset, epoch=-1, description=''):
+        # Prefix of the predictions, ROC and other output files of log_predict
         if epoch >= 0:
             suffix = 'final'
+        elif description in ['Final', 'BestAcc']:
+            # Checkpoints evaluated by evaluate() other than the best one get their own files
+            suffix = description.lower()
         else:
             suffix = 'best'
+        return self.args.predictfile + '.' + suffix + '.' + dataset
 
-        prefix = self.args.predictfile + '.' + suffix + '.' + dataset
-        metrics, logstring = None, 'Metrics skipped because target is None!'
+    def log_predict(self, predict, targets, dataset, epoch=-1, epoch_t=None, description='', repeat=None, streaming=None):
+        # streaming: a streaming metrics engine that replaces predict and targets (nothing is saved to the predictions file)
 
-        predict = {key: val.cpu().double() for key, val in predict.items()}
+        datastrings = {'train': 'Training  ', 'test': 'Testing   ', 'valid': 'Validation'}
 
-        if targets is not None:
-            targets = targets.cpu().double()
+        prefix = self._predict_prefix(dataset, epoch, description)
+        metrics, logstring = None, 'Metrics skipped because target is None!'
 
-            if repeat is None:
-                metrics, logstring = self.metrics_fn(predict['predict'], targets, self.loss_fn, prefix, logger)
-            else:
+        if streaming is None:
+            predict = {key: val.cpu().double() for key, val in predict.items()}
+
+        if targets is not None or streaming is not None:
+            if repeat is not None:
                 metrics, logstring = repeat[0], repeat[1]
+            elif streaming is not None:
+                metrics, logstring = streaming.compute(prefix, roc_csv=getattr(self.args, 'roc_csv', False))
+                # With --out-of-core-eval, the sampled ROC curve is also stored next to the predictions (see evaluate)
+                if getattr(self.args, 'out_of_core_eval', False) and self.args.predict and epoch < 0 and getattr(streaming, 'roc', None) is not None:
+                    with h5py.File(prefix + '.h5', mode='a') as file:
+                        if 'roc' in file:
+                            del file['roc']
+                        file.create_dataset('roc', data=streaming.roc)
+            else:
+                targets = targets.cpu().double()
+                metrics, logstring = self.metrics_fn(predict['predict'], targets, self.loss_fn, prefix, logger, roc_csv=getattr(self.args, 'roc_csv', False))
 
             if epoch >= 0:
                 logger.info(f'Epoch {epoch} {description} {datastrings[dataset]}'+logstring)
@@ -608,8 +803,8 @@ class Trainer:
                                 self.writer.add_scalar(dataset+'/'+name+'_'+str(i), m, epoch)
 
 
-        if self.args.predict and (repeat is None):
-            file = self.args.predictfile + '.' + suffix + '.' + dataset + '.pt'
+        if self.args.predict and (repeat is None) and (streaming is None):
+            file = prefix + '.pt'
             logger.info('Saving predictions to file: {}'.format(file))
             if targets is not None:
                 predict.update({'targets': targets})
@@ -621,3 +816,18 @@ class Trainer:
         return metrics, logstring
     
     
+
+
+def _ordered_rows(index):
+    # Rows of a gathered batch without the padded duplicates (index -1), sorted by event index
+    rows = (index >= 0).nonzero().squeeze(1)
+    return rows[index[rows].argsort()]
+
+
+def _take(tensor, rows):
+    return tensor if rows is None else tensor[rows]
+
+
+def _same_state(state1, state2):
+    # Whether two state dicts hold the same tensors
+    return state1.keys() == state2.keys() and all(torch.equal(state1[key], state2[key]) for key in state1)
@@ -5,6 +5,7 @@ import torch.optim.lr_scheduler as sched
 from .optimizers import DemonRanger
 import torch.distributed as dist
 import numpy as np
+import h5py
 import random
 import yaml
 from pathlib import Path
@@ -200,7 +201,10 @@ def init_optimizer(args, model, step_per_epoch=None):
                                 step_per_epoch=step_per_epoch,
                                 use_gc=False, # gradient centralization
                                 amsgrad=False, # use amsgrad instead of Adam as the underlying optimizer
-                                dropout = 0.
+                                dropout = 0.,
+                                foreach=args.optim_foreach,
+                                flat_state=args.optim_flat_state,
+                                state_dtype=None if args.optim_state_dtype is None else getattr(torch, args.optim_state_dtype)
                                 )
     else:
         raise ValueError('Incorrect choice of optimizer')
@@ -275,13 +279,15 @@ def init_cuda(args, device_id=-1):
         if not torch.cuda.is_available():
             logger.warning("CUDA is not available, Using CPU.")
             device = torch.device('cpu')
+            if device_id >= 0:
+                init_gloo(args, device_id)
         else:
             logger.info('Initializing CUDA/GPU! Device: {}'.format(torch.cuda.current_device()))
             if device_id < 0:
                 device = torch.device('cuda')
             else:
                 torch.cuda.set_device(device_id)
-                logger.warning('NCCL timeout is set to 2 hours to allow for single-GPU evaluation during multi-GPU sessions. To enable multi-GPU evaluation, set distributed=True in trainer.evaluate()')
+                logger.warning('NCCL timeout is set to 2 hours to allow for single-GPU evaluation during multi-GPU sessions (--no-distribute-eval)')
                 dist.init_process_group(backend='nccl', timeout=timedelta(hours=2))
                 logger.info(f"Setting cuda device = {device_id}")
                 device = torch.device(device_id)
@@ -291,6 +297,8 @@ def init_cuda(args, device_id=-1):
     else:
         logger.info('Initializing CPU!')
         device = torch.device('cpu')
+        if device_id >= 0:
+            init_gloo(args, device_id)
 
     if args.dtype == 'double':
         dtype = torch.double
@@ -301,6 +309,31 @@ def init_cuda(args, device_id=-1):
 
     return device, dtype
 
+def init_gloo(args, device_id):
+    """
+    Multi-process training on CPU under torchrun: a gloo process group, with the cores of the node split among its local ranks.
+    """
+    cores = partition_cpus(device_id, int(os.environ.get('LOCAL_WORLD_SIZE', 1)), num_threads=args.cpu_threads, pin=args.pin_cpus)
+    dist.init_process_group(backend='gloo', timeout=timedelta(hours=2))
+    logger.info(f'Initialized gloo process group: local rank {device_id} runs {torch.get_num_threads()} threads'
+                + (f' pinned to cores {cores}' if args.pin_cpus else ''))
+
+def partition_cpus(local_rank, local_world_size, num_threads=0, pin=True):
+    """
+    Gives the process of local_rank its block of the cores available to it (one contiguous block per local rank),
+    pins it to the block if pin=True, and sets the number of intra-op threads to the size of the block
+    (or num_threads if positive). PELICAN on CPU is mostly bandwidth-bound, so ranks sharing cores slow each other down.
+    Returns the cores of the block.
+    """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    size = max(len(cores) // local_world_size, 1)
+    start = (local_rank * size) % len(cores)
+    cores = cores[start:start + size]
+    if pin and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(num_threads if num_threads > 0 else len(cores))
+    return cores
+
 def init_weights(m):
     if type(m) == nn.Linear:
         torch.nn.init.kaiming_normal_(m.weight, a=0.01, mode='fan_in', nonlinearity='leaky_relu')
@@ -329,6 +362,87 @@ def all_gather(tensor):
     output_tensor=torch.cat(tensor_placeholder, dim=0)
     return output_tensor 
 
+def all_gather_uneven(tensor):
+    """
+    Same as all_gather, but the processes may hold different numbers of rows:
+    the tensors are padded to the longest one for the collective and trimmed afterwards.
+    """
+    world_size = get_world_size()
+    if world_size <= 1:
+        return tensor
+    length = torch.tensor([len(tensor)], device=tensor.device)
+    lengths = [torch.zeros_like(length) for _ in range(world_size)]
+    dist.all_gather(lengths, length)
+    lengths = torch.cat(lengths).tolist()
+    padded = tensor.new_zeros((max(lengths),) + tensor.shape[1:])
+    padded[:len(tensor)] = tensor
+    tensor_placeholder = [torch.zeros_like(padded) for _ in range(world_size)]
+    dist.all_gather(tensor_placeholder, padded)
+    return torch.cat([t[:n] for t, n in zip(tensor_placeholder, lengths)], dim=0)
+
+class DeviceBuffer:
+    """
+    Preallocated buffer that rows are appended to on their own device, so that per-minibatch values (losses, predictions)
+    can be accumulated without synchronizing with the host. The capacity doubles whenever it is exceeded, and clear()
+    empties the buffer but keeps its storage, so that a buffer flushed at regular intervals stays bounded.
+    """
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.data = None
+        self.size = 0
+
+    def append(self, rows):
+        rows = rows.detach()
+        if self.data is None:
+            self.data = rows.new_empty((max(self.capacity, len(rows)),) + rows.shape[1:])
+        elif self.size + len(rows) > len(self.data):
+            data = self.data.new_empty((max(2 * len(self.data), self.size + len(rows)),) + self.data.shape[1:])
+            data[:self.size] = self.data[:self.size]
+            self.data = data
+        self.data[self.size:self.size + len(rows)] = rows
+        self.size += len(rows)
+
+    def values(self):
+        return self.data[:self.size]
+
+    def clear(self):
+        # The storage is kept for the next rows
+        self.size = 0
+
+class H5Writer:
+    """
+    Appends batches of named tensors (e.g. predict=..., targets=...) to resizable, chunked datasets of an HDF5 file, so that
+    the predictions of a large dataset are written out incrementally. Rows are buffered on the host until a chunk of
+    chunk_rows is full, which bounds the memory to one chunk per key.
+    """
+    def __init__(self, filename, chunk_rows=2**16):
+        self.file = h5py.File(filename, mode='w')
+        self.chunk_rows = chunk_rows
+        self.buffers = {}
+
+    def append(self, **batch):
+        for key, rows in batch.items():
+            rows = rows.detach().cpu().numpy()
+            buffer = self.buffers.setdefault(key, [])
+            buffer.append(rows)
+            if sum(len(r) for r in buffer) >= self.chunk_rows:
+                self._flush(key)
+
+    def _flush(self, key):
+        rows = np.concatenate(self.buffers.pop(key))
+        if key not in self.file:
+            self.file.create_dataset(key, shape=(0,) + rows.shape[1:], maxshape=(None,) + rows.shape[1:], dtype=rows.dtype,
+                                     chunks=(min(self.chunk_rows, max(len(rows), 1)),) + rows.shape[1:])
+        dataset = self.file[key]
+        start = len(dataset)
+        dataset.resize(start + len(rows), axis=0)
+        dataset[start:] = rows
+
+    def close(self):
+        for key in list(self.buffers):
+            self._flush(key)
+        self.file.close()
+
 def get_world_size():
     """
     Get the size of the world.
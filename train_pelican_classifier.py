@@ -27,7 +27,7 @@ from src.trainer import Trainer
 from src.trainer import init_argparse, init_file_paths, init_logger, init_cuda, logging_printout, fix_args, set_seed, get_world_size
 from src.trainer import init_optimizer, init_scheduler
 
-from src.dataloaders import initialize_datasets, collate_fn
+from src.dataloaders import initialize_datasets, collate_fn, PairBudgetBatchSampler
 
 from src.models.dynamic_entropy_loss import DynamicEntropyLoss
 
@@ -100,9 +100,13 @@ def main():
 
     # Choose the right performance tracking tools based on the number of classes
     if args.num_classes<=2:
-        from src.models.metrics_classifier import metrics, minibatch_metrics, minibatch_metrics_string
+        from src.models.metrics_classifier import metrics, minibatch_metrics, minibatch_metrics_string, StreamingMetrics
     else:
         from src.models.metrics_multiclass import metrics, minibatch_metrics, minibatch_metrics_string
+        if args.streaming_metrics:
+            raise NotImplementedError("--streaming-metrics is only implemented for binary classification")
+    if args.out_of_core_eval and not args.streaming_metrics:
+        raise NotImplementedError("--out-of-core-eval computes the metrics with the engines of --streaming-metrics")
 
     # Initialize file paths
     args = init_file_paths(args)
@@ -144,17 +148,23 @@ def main():
         torch.manual_seed(165937750084982)
     # Initialize dataloder(Prepares data sets and specifies data location)
     args.datadir = "data/sample_data/run12"
-    args, datasets = initialize_datasets(args, args.datadir, num_pts=None, testfile=args.testfile, balance=(args.num_classes==2), RAMdataset=args.RAMdataset)
+    args, datasets = initialize_datasets(args, args.datadir, num_pts=None, testfile=args.testfile, balance=(args.num_classes==2), RAMdataset=args.RAMdataset, RAM_max_memory=args.RAM_max_memory * 2**20, RAM_threads=args.RAM_threads, RAM_distributed=args.RAM_distributed)
 
     # Construct PyTorch dataloaders from datasets(Function to format data into batches)
-    collate = lambda data: collate_fn(data, scale=args.scale, nobj=args.nobj)
+    collate = lambda data: collate_fn(data, scale=args.scale, nobj=args.nobj, packed=args.packed, trim=args.pair_budget > 0 or bool(args.nobj_buckets), buckets=args.nobj_buckets)
     
     # Whether testing set evaluation should be distributed
     print("Datasets keys:", datasets.keys())
     distribute_eval=args.distribute_eval
 
     # Set up how data will be loaded
-    if distributed:
+    # With --RAM-distributed shard, every process only holds its own events: they are read in order, or shuffled for training
+    sharded = distributed and args.RAM_distributed == 'shard'
+    if sharded and args.pair_budget > 0:
+        raise NotImplementedError("--pair-budget splits the batches of the whole training set among the processes, it can't be combined with --RAM-distributed shard")
+    if sharded and not distribute_eval:
+        raise NotImplementedError("--RAM-distributed shard requires --distribute-eval, since no process holds the whole testing set")
+    if distributed and not sharded:
         samplers = {'train': DistributedSampler(datasets['train'], shuffle=args.shuffle),
                     'valid': DistributedSampler(datasets['valid'], shuffle=False),
                     'test': DistributedSampler(datasets['test'], shuffle=False) if distribute_eval else None}
@@ -162,23 +172,36 @@ def main():
         samplers = {split: None for split in datasets.keys()}
 
     # Create data loaders to fetch batches of data for training
+    batching = {split: {'batch_size': args.batch_size,
+                         'shuffle': args.shuffle if (split == 'train' and samplers[split] is None) else False,
+                         'sampler': samplers[split]}
+                for split in datasets.keys()}
+    # With a pair budget, training batches group jets of similar multiplicity instead of having a fixed size
+    if args.pair_budget > 0:
+        batching['train'] = {'batch_sampler': PairBudgetBatchSampler(datasets['train'].column('Nobj'), args.pair_budget, labels=datasets['train'].column('is_signal') if args.num_classes == 2 else None, nobj_cap=args.nobj,
+                                                                     shuffle=args.shuffle, seed=args.seed)}
+
     dataloaders = {split: DataLoader(dataset,
-                                     batch_size = args.batch_size,
-                                     shuffle = args.shuffle if (split == 'train' and not distributed) else False,
                                      num_workers = args.num_workers,
-                                     pin_memory=True,
+                                     pin_memory=(device.type == 'cuda'),
                                      worker_init_fn = seed_worker,
                                      collate_fn =collate,
-                                     sampler = samplers[split]
+                                     **batching[split]
                                      )
                    for split, dataset in datasets.items()}
 
+    # Under --compile, only the sampled NaN check is kept: checking every pass syncs with the device and splits the compiled graph
+    check_nan = 0 if args.compile and args.nan_check_every == 1 else args.nan_check_every
+    if check_nan != args.nan_check_every:
+        logger.warning('The NaN check of every forward pass is disabled with --compile, use --nan-check-every N > 1 to sample one pass in N instead')
+
     # Initialize model
     model = PELICANClassifier(args.rank1_width_multiplier, args.num_channels_scalar, args.num_channels_m, args.num_channels_2to2, args.num_channels_out, args.num_channels_m_out, 
                               stabilizer=args.stabilizer, method = args.method, num_classes=args.num_classes,
                               activate_agg=args.activate_agg, activate_lin=args.activate_lin,
                               activation=args.activation, config=args.config, config_out=args.config_out, average_nobj=args.nobj_avg,
-                              factorize=args.factorize, masked=args.masked,
+                              factorize=args.factorize, masked=args.masked, fused=args.fused, packed=args.packed, symmetric=args.symmetric,
+                              activation_checkpoint=args.activation_checkpoint, checkpoint_memory=args.checkpoint_memory * 2**20, check_nan=check_nan,
                               activate_agg_out=args.activate_agg_out, activate_lin_out=args.activate_lin_out, mlp_out=args.mlp_out,
                               scale=args.scale, irc_safe=args.irc_safe, dropout = args.dropout, drop_rate=args.drop_rate, drop_rate_out=args.drop_rate_out, batchnorm=args.batchnorm,
                               dataset=args.dataset, device=device, dtype=dtype)
@@ -186,7 +209,12 @@ def main():
     model.to(device)
 
     if distributed:
-        model = DistributedDataParallel(model, device_ids=[device_id])
+        # On CPU (gloo), DistributedDataParallel takes no device_ids
+        model = DistributedDataParallel(model, device_ids=[device_id] if device.type == 'cuda' else None)
+
+    # Batches of a fixed size have a single shape (or one per --nobj-buckets size), the pair budget makes the batch size vary
+    if args.compile:
+        model.compile(dynamic=None if args.pair_budget > 0 else False)
 
     restart_epochs = []
 
@@ -215,7 +243,7 @@ def main():
     # Instantiate the training class
     trainer = Trainer(args, dataloaders, model, loss_fn, metrics,
                       minibatch_metrics, minibatch_metrics_string, optimizer, scheduler,
-                      restart_epochs, device_id, device, dtype)
+                      restart_epochs, device_id, device, dtype, streaming_metrics_fn=StreamingMetrics if args.streaming_metrics else None)
     
     if not args.task.startswith('eval'):
         # Load from checkpoint file (if one exists)
@@ -243,8 +271,7 @@ def main():
         trainer.train()
 
     # Test predictions on best model and also last checkpointed model.
-    # If distributed==False, only one GPU will do this during DDP sessions 
-    # so that the order  of batches is preserved in the output file.
+    # With --no-distribute-eval, only one GPU will do this during DDP sessions.
     trainer.evaluate(splits=['test'], distributed=distributed and distribute_eval)
     if distributed:
         dist.destroy_process_group()